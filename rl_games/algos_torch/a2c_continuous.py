@@ -5,7 +5,6 @@ from rl_games.algos_torch import central_value
 from rl_games.common import common_losses
 from rl_games.common import datasets
 
-from torch import optim
 import torch 
 from torch import nn
 import numpy as np
@@ -30,7 +29,9 @@ class A2CAgent(a2c_common.ContinuousA2CBase):
         self.init_rnn_from_model(self.model)
         self.last_lr = float(self.last_lr)
         self.bound_loss_type = self.config.get('bound_loss_type', 'bound') # 'regularisation' or 'bound'
-        self.optimizer = optim.Adam(self.model.parameters(), float(self.last_lr), eps=1e-08, weight_decay=self.weight_decay)
+        self.optimizer = self.create_optimizer(self.model.parameters(), float(self.last_lr))
+        self.init_flat_params()
+        self.init_grad_bucketer()
 
         if self.has_central_value:
             cv_config = {
@@ -47,9 +48,11 @@ class A2CAgent(a2c_common.ContinuousA2CBase):
                 'config' : self.central_value_config, 
                 'writter' : self.writer,
                 'max_epochs' : self.max_epochs,
-                'multi_gpu' : self.multi_gpu,
+                'multi_gpu' : self.multi_gpu and not self.local_sgd,
+                'zero_optimizer' : self.zero_optimizer,
             }
             self.central_value_net = central_value.CentralValueTrain(**cv_config).to(self.ppo_device)
+        self.init_param_averager()
 
         self.use_experimental_cv = self.config.get('use_experimental_cv', True)
         self.dataset = datasets.PPODataset(self.batch_size, self.minibatch_size, self.is_discrete, self.is_rnn, self.ppo_device, self.seq_len)
@@ -65,6 +68,9 @@ class A2CAgent(a2c_common.ContinuousA2CBase):
         return self.epoch_num
         
     def save(self, fn):
+        if self.zero_optimizer:
+            self.deferred_saves.append(fn)
+            return
         state = self.get_full_state_weights()
         torch_ext.save_checkpoint(fn, state)
 
@@ -126,11 +132,7 @@ class A2CAgent(a2c_common.ContinuousA2CBase):
 
             loss = a_loss + 0.5 * c_loss * self.critic_coef - entropy * self.entropy_coef + b_loss * self.bounds_loss_coef
             
-            if self.multi_gpu:
-                self.optimizer.zero_grad()
-            else:
-                for param in self.model.parameters():
-                    param.grad = None
+            self.zero_grads()
 
         self.scaler.scale(loss).backward()
         #TODO: Refactor this ugliest code of they year
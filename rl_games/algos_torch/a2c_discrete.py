@@ -6,7 +6,6 @@ from rl_games.algos_torch import central_value
 from rl_games.common import common_losses
 from rl_games.common import datasets
 
-from torch import optim
 import torch 
 from torch import nn
 import numpy as np
@@ -31,7 +30,9 @@ class DiscreteA2CAgent(a2c_common.DiscreteA2CBase):
         self.init_rnn_from_model(self.model)
 
         self.last_lr = float(self.last_lr)
-        self.optimizer = optim.Adam(self.model.parameters(), float(self.last_lr), eps=1e-08, weight_decay=self.weight_decay)
+        self.optimizer = self.create_optimizer(self.model.parameters(), float(self.last_lr))
+        self.init_flat_params()
+        self.init_grad_bucketer()
 
         if self.has_central_value:
             cv_config = {
@@ -48,9 +49,11 @@ class DiscreteA2CAgent(a2c_common.DiscreteA2CBase):
                 'config' : self.central_value_config, 
                 'writter' : self.writer,
                 'max_epochs' : self.max_epochs,
-                'multi_gpu' : self.multi_gpu,
+                'multi_gpu' : self.multi_gpu and not self.local_sgd,
+                'zero_optimizer' : self.zero_optimizer,
             }
             self.central_value_net = central_value.CentralValueTrain(**cv_config).to(self.ppo_device)
+        self.init_param_averager()
 
         self.use_experimental_cv = self.config.get('use_experimental_cv', False)        
         self.dataset = datasets.PPODataset(self.batch_size, self.minibatch_size, self.is_discrete, self.is_rnn, self.ppo_device, self.seq_len)
@@ -66,6 +69,9 @@ class DiscreteA2CAgent(a2c_common.DiscreteA2CBase):
         return self.epoch_num
 
     def save(self, fn):
+        if self.zero_optimizer:
+            self.deferred_saves.append(fn)
+            return
         state = self.get_full_state_weights()
         torch_ext.save_checkpoint(fn, state)
 
@@ -75,7 +81,7 @@ class DiscreteA2CAgent(a2c_common.DiscreteA2CBase):
 
     def get_masked_action_values(self, obs, action_masks):
         processed_obs = self._preproc_obs(obs['obs'])
-        action_masks = torch.BoolTensor(action_masks).to(self.ppo_device)
+        action_masks = torch.as_tensor(action_masks, dtype=torch.bool).to(self.ppo_device)
         input_dict = {
             'is_train': False,
             'prev_actions': None, 
@@ -151,11 +157,7 @@ class DiscreteA2CAgent(a2c_common.DiscreteA2CBase):
             a_loss, c_loss, entropy = losses[0], losses[1], losses[2]
             loss = a_loss + 0.5 *c_loss * self.critic_coef - entropy * self.entropy_coef
 
-            if self.multi_gpu:
-                self.optimizer.zero_grad()
-            else:
-                for param in self.model.parameters():
-                    param.grad = None
+            self.zero_grads()
 
         self.scaler.scale(loss).backward()
         self.trancate_gradients_and_step()
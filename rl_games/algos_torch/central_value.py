@@ -8,9 +8,10 @@ from rl_games.algos_torch.running_mean_std import RunningMeanStd, RunningMeanStd
 from rl_games.common  import common_losses
 from rl_games.common import datasets
 from rl_games.common import schedulers
+from rl_games.distributed.zero import ZeroRedundancyAdam
 
 class CentralValueTrain(nn.Module):
-    def __init__(self, state_shape, value_size, ppo_device, num_agents, horizon_length, num_actors, num_actions, seq_len, normalize_value,network, config, writter, max_epochs, multi_gpu):
+    def __init__(self, state_shape, value_size, ppo_device, num_agents, horizon_length, num_actors, num_actions, seq_len, normalize_value,network, config, writter, max_epochs, multi_gpu, zero_optimizer=False):
         nn.Module.__init__(self)
         self.ppo_device = ppo_device
         self.num_agents, self.horizon_length, self.num_actors, self.seq_len = num_agents, horizon_length, num_actors, seq_len
@@ -20,6 +21,7 @@ class CentralValueTrain(nn.Module):
         self.value_size = value_size
         self.max_epochs = max_epochs
         self.multi_gpu = multi_gpu
+        self.zero_optimizer = zero_optimizer
         self.truncate_grads = config.get('truncate_grads', False)
         self.config = config
         self.normalize_input = config['normalize_input']
@@ -53,12 +55,17 @@ class CentralValueTrain(nn.Module):
 
         self.writter = writter
         self.weight_decay = config.get('weight_decay', 0.0)
-        self.optimizer = torch.optim.Adam(self.model.parameters(), float(self.lr), eps=1e-08, weight_decay=self.weight_decay)
         self.frame = 0
         self.epoch_num = 0
         self.running_mean_std = None
         self.grad_norm = config.get('grad_norm', 1)
         self.truncate_grads = config.get('truncate_grads', False)
+        if self.zero_optimizer:
+            self.model.to(self.ppo_device)
+            max_grad_norm = self.grad_norm if self.truncate_grads else None
+            self.optimizer = ZeroRedundancyAdam(self.model.parameters(), float(self.lr), eps=1e-08, weight_decay=self.weight_decay, max_grad_norm=max_grad_norm)
+        else:
+            self.optimizer = torch.optim.Adam(self.model.parameters(), float(self.lr), eps=1e-08, weight_decay=self.weight_decay)
         self.e_clip = config.get('e_clip', 0.2)
         self.truncate_grad = self.config.get('truncate_grads', False)
 
@@ -224,6 +231,13 @@ class CentralValueTrain(nn.Module):
         loss = common_losses.critic_loss(value_preds_batch, values, self.e_clip, returns_batch, self.clip_value)
         losses, _ = torch_ext.apply_masks([loss], rnn_masks_batch)
         loss = losses[0]
+        if self.zero_optimizer:
+            # the sharded optimizer reduces and clips the gradients
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+            return loss
+
         if self.multi_gpu:
             self.optimizer.zero_grad()
         else:
@@ -0,0 +1,86 @@
+import threading
+
+
+class AsyncDAggerTrainer(threading.Thread):
+    '''
+    Trains the student on the aggregate DAgger dataset in a background thread while the player keeps collecting
+    and labelling rollouts.
+
+    update_fn: callable(batch) -> loss, runs one optimizer step on a sampled minibatch
+    update_to_data_ratio: number of student updates allowed per collected sample, None trains without throttling
+    '''
+    def __init__(self, student, dataset, update_fn, minibatch_size, update_to_data_ratio=None, preproc_fn=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.student = student
+        self.dataset = dataset
+        self.update_fn = update_fn
+        self.minibatch_size = minibatch_size
+        self.update_to_data_ratio = update_to_data_ratio
+        self.preproc_fn = preproc_fn
+
+        self.dataset_lock = threading.Lock()
+        self.weights_lock = threading.Lock()
+        self.data_cond = threading.Condition()
+        self.stop_event = threading.Event()
+        self.num_samples = 0
+        self.num_updates = 0
+        self.last_loss = None
+        self.error = None
+
+    def _can_update(self):
+        if self.num_samples == 0:
+            return False
+        if self.update_to_data_ratio is None:
+            return True
+        return self.num_updates < self.num_samples * self.update_to_data_ratio
+
+    def add(self, values, clear=False):
+        '''
+        clear: replaces the dataset by values instead of aggregating
+        '''
+        num_samples = next(iter(values.values())).shape[0]
+        with self.dataset_lock:
+            if clear:
+                self.dataset.clear()
+            self.dataset.add(values)
+        with self.data_cond:
+            self.num_samples += num_samples
+            self.data_cond.notify()
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                with self.data_cond:
+                    while not self._can_update() and not self.stop_event.is_set():
+                        self.data_cond.wait(timeout=0.1)
+                if self.stop_event.is_set():
+                    break
+                with self.dataset_lock:
+                    batch = self.dataset.sample(self.minibatch_size)
+                if self.preproc_fn is not None:
+                    batch = self.preproc_fn(batch)
+                with self.weights_lock:
+                    loss = self.update_fn(batch)
+                self.last_loss = loss.detach()
+                self.num_updates += 1
+        except Exception as e:
+            self.error = e
+            raise
+
+    def check_error(self):
+        if self.error is not None:
+            raise RuntimeError('dagger trainer thread failed') from self.error
+
+    def copy_weights_to(self, module):
+        with self.weights_lock:
+            module.load_state_dict(self.student.state_dict())
+
+    def get_weights(self):
+        with self.weights_lock:
+            return {k: v.clone() for k, v in self.student.state_dict().items()}
+
+    def stop(self):
+        self.stop_event.set()
+        with self.data_cond:
+            self.data_cond.notify()
+        self.join()
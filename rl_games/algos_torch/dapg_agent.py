@@ -1,5 +1,8 @@
 import numpy as np
 import os
+import queue
+import threading
+from contextlib import contextmanager
 from rl_games.algos_torch.a2c_continuous import A2CAgent
 from rl_games.common import common_losses
 from rl_games.algos_torch import torch_ext
@@ -20,6 +23,83 @@ def dict_to_device(input_dict: Dict[str, Any],
     return input_dict
 
 
+def first_frame_batch(demo_dict: Dict[str, Any]) -> Tuple[torch.Tensor, torch.Tensor]:
+    return demo_dict['obs']['obs'][:, 0], demo_dict['actions'][:, 0]
+
+
+class DemoCache:
+    """First frames of a demo split, loaded once into contiguous tensors.
+
+    Minibatches are sampled with torch.randint on the storage device, storage is either the
+    training device or pinned host memory.
+    """
+    def __init__(self, loader: DataLoader, device: torch.device, batch_size: int,
+                 pin_memory: bool = False, max_samples: Optional[int] = None) -> None:
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        obs_list, actions_list = [], []
+        num_samples = 0
+        for demo_dict in loader:
+            obs, actions = first_frame_batch(demo_dict)
+            obs_list.append(obs)
+            actions_list.append(actions)
+            num_samples += obs.shape[0]
+            if max_samples is not None and num_samples >= max_samples:
+                break
+        self.obs = torch.cat(obs_list)[:max_samples]
+        self.actions = torch.cat(actions_list)[:max_samples]
+        if pin_memory:
+            self.obs = self.obs.pin_memory()
+            self.actions = self.actions.pin_memory()
+        else:
+            self.obs = self.obs.to(self.device)
+            self.actions = self.actions.to(self.device)
+
+    def __len__(self) -> int:
+        return self.obs.shape[0]
+
+    def sample(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        idx = torch.randint(0, len(self), (self.batch_size,), device=self.obs.device)
+        obs, actions = self.obs[idx], self.actions[idx]
+        if obs.device != self.device:
+            obs = obs.pin_memory().to(self.device, non_blocking=True)
+            actions = actions.pin_memory().to(self.device, non_blocking=True)
+        return obs, actions
+
+    def iterate(self, batch_size: int) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        for start in range(0, len(self), batch_size):
+            obs = self.obs[start:start + batch_size].to(self.device, non_blocking=True)
+            actions = self.actions[start:start + batch_size].to(self.device, non_blocking=True)
+            yield obs, actions
+
+
+class DemoPrefetcher:
+    """Double-buffered background loading of demo minibatches.
+
+    Used when the demos do not fit into a DemoCache: a thread iterates the DataLoader and
+    keeps up to num_buffers first-frame minibatches ready in pinned memory.
+    """
+    def __init__(self, loader: DataLoader, device: torch.device, num_buffers: int = 2) -> None:
+        self.loader = loader
+        self.device = torch.device(device)
+        self.pin_memory = self.device.type == 'cuda'
+        self.queue = queue.Queue(maxsize=num_buffers)
+        self.thread = threading.Thread(target=self._load, daemon=True)
+        self.thread.start()
+
+    def _load(self) -> None:
+        while True:
+            for demo_dict in self.loader:
+                obs, actions = first_frame_batch(demo_dict)
+                if self.pin_memory:
+                    obs, actions = obs.pin_memory(), actions.pin_memory()
+                self.queue.put((obs, actions))
+
+    def sample(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        obs, actions = self.queue.get()
+        return obs.to(self.device, non_blocking=True), actions.to(self.device, non_blocking=True)
+
+
 class DAPGAgent(A2CAgent):
     def __init__(self, base_name: str, params: Dict[str, Any]) -> None:
         super().__init__(base_name, params)
@@ -31,6 +111,8 @@ class DAPGAgent(A2CAgent):
         self.bc_coef_decay = params['config']['bc_coef_decay']
         self.l1_loss_weight = params['config']['l1_loss_weight']
         self.l2_loss_weight = params['config']['l2_loss_weight']
+        # the bc loss on the cached validation demos is evaluated every bc_valid_every epochs
+        self.bc_valid_every = self.demo_cfg.get('valid_every', 10)
         self.load_demo_data()
         self.current_epoch = 0
 
@@ -43,79 +125,88 @@ class DAPGAgent(A2CAgent):
                                         filter_by_attribute='train')
         valid_dataset = SequenceDataset(**self.demo_cfg['dataset'],
                                         filter_by_attribute='valid')
-
-        train_sampler = train_dataset.get_dataset_sampler()
-        valid_sampler = valid_dataset.get_dataset_sampler()
-
-        self.demo_train_loader = DataLoader(
-            dataset=train_dataset,
-            sampler=train_sampler,
-            batch_size=self.demo_cfg['dataloader']['batch_size'],
-            shuffle=(train_sampler is None),
-            num_workers=self.demo_cfg['dataloader']['num_workers'],
+        self.demo_train = self.create_demo_source(train_dataset)
+        self.demo_valid = self.create_demo_source(valid_dataset, always_cache=True)
+
+    def create_demo_source(self, dataset: SequenceDataset, always_cache: bool = False) -> Union[DemoCache, DemoPrefetcher]:
+        cache_cfg = self.demo_cfg.get('cache', {})
+        batch_size = self.demo_cfg['dataloader']['batch_size']
+        num_workers = self.demo_cfg['dataloader']['num_workers']
+
+        # demos are cached on the training device, or in pinned host memory with cache device 'pinned'.
+        # always_cache keeps a fixed subset of at most max_bytes when the split is too large.
+        if cache_cfg.get('enabled', True) or always_cache:
+            demo = dataset[0]
+            first_frame_bytes = sum(np.asarray(v[0]).nbytes for v in (demo['obs']['obs'], demo['actions']))
+            cache_bytes = len(dataset) * first_frame_bytes
+            max_bytes = cache_cfg.get('max_bytes', 4 * 1024 ** 3)
+            if cache_bytes <= max_bytes or always_cache:
+                loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False,
+                                    num_workers=num_workers, drop_last=False)
+                try:
+                    cache = DemoCache(loader, self.ppo_device, batch_size,
+                                      pin_memory=cache_cfg.get('device', 'cuda') == 'pinned',
+                                      max_samples=max_bytes // first_frame_bytes)
+                    print('demo cache:', len(cache), 'samples,', len(cache) * first_frame_bytes / 1024 ** 2, 'MB')
+                    return cache
+                except RuntimeError as e:
+                    # the validation split is iterated in full and cannot fall back to the prefetcher
+                    if 'out of memory' not in str(e) or always_cache:
+                        raise
+            print('demo cache: demos do not fit in memory, using background prefetching')
+
+        sampler = dataset.get_dataset_sampler()
+        loader = DataLoader(
+            dataset=dataset,
+            sampler=sampler,
+            batch_size=batch_size,
+            shuffle=(sampler is None),
+            num_workers=num_workers,
             drop_last=True
         )
-        self.demo_valid_loader = DataLoader(
-            dataset=valid_dataset,
-            sampler=valid_sampler,
-            batch_size=self.demo_cfg['dataloader']['batch_size'],
-            shuffle=(valid_sampler is None),
-            num_workers=self.demo_cfg['dataloader']['num_workers'],
-            drop_last=True
-        )
-
-        self.demo_train_iter = iter(self.demo_train_loader)
-        self.demo_valid_iter = iter(self.demo_valid_loader)
+        return DemoPrefetcher(loader, self.ppo_device, cache_cfg.get('num_buffers', 2))
 
     def sample_demo_dict(self, valid: bool = False) -> Dict[str, Any]:
-        demo_iter = self.demo_valid_iter if valid else self.demo_train_iter
+        demo_source = self.demo_valid if valid else self.demo_train
+        obs, actions = demo_source.sample()
+        return {
+            'is_train': not valid,
+            'prev_actions': actions,
+            'obs': self._preproc_obs(obs),
+        }
+
+    def get_demo_actions(self, demo_train_dict: Dict[str, Any]) -> torch.Tensor:
+        with self.frozen_normalizer():
+            demo_train_res_dict = self.model(demo_train_dict)
+        return demo_train_res_dict['mus']
+
+    @contextmanager
+    def frozen_normalizer(self):
+        # demo observations must not change the input normalization statistics
+        training = self.normalize_input and self.model.running_mean_std.training
+        if training:
+            self.model.running_mean_std.eval()
         try:
-            demo_dict = next(demo_iter)
-        except StopIteration:
-            if valid:
-                self.demo_valid_iter = iter(self.demo_valid_loader)
-                demo_dict = next(self.demo_valid_iter)
-            else:
-                self.demo_train_iter = iter(self.demo_train_loader)
-                demo_dict = next(self.demo_train_iter)
-        return demo_dict
+            yield
+        finally:
+            if training:
+                self.model.running_mean_std.train()
 
-    def sample_demo_train_valid(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-        # demo train data
-        demo_train_dict = self.sample_demo_dict()
-        train_obs = self._preproc_obs(demo_train_dict['obs']['obs'])[:, 0]
-        train_actions = demo_train_dict['actions'][:, 0]
-        demo_train_dict = dict_to_device({
-            'is_train': True,
-            'prev_actions': train_actions,
-            'obs': train_obs,
-        }, device=self.ppo_device)
-
-        # demo valid data
-        demo_valid_dict = self.sample_demo_dict(valid=True)
-        valid_obs = self._preproc_obs(demo_valid_dict['obs']['obs'])[:, 0]
-        valid_actions = demo_valid_dict['actions'][:, 0]
-        demo_valid_dict = dict_to_device({
-            'is_train': False,
-            'prev_actions': valid_actions,
-            'obs': valid_obs,
-        }, device=self.ppo_device)
-        return demo_train_dict, demo_valid_dict
-
-    def get_demo_actions(self, demo_train_dict: Dict[str, Any],
-                         demo_valid_dict: Dict[str, Any] = None
-                         ) -> Tuple[torch.Tensor, torch.Tensor]:
-        demo_train_res_dict = self.model(demo_train_dict)
-        train_mu = demo_train_res_dict['mus']
-        train_sigma = demo_train_res_dict['sigmas']
-
-        if demo_valid_dict:
-            with torch.no_grad():
-                demo_valid_res_dict = self.model(demo_valid_dict)
-                valid_mu = demo_valid_res_dict['mus']
-                valid_sigma = demo_valid_res_dict['sigmas']
-            return train_mu, valid_mu
-        return train_mu
+    def evaluate_bc_valid(self) -> float:
+        """BC loss over the whole cached validation set."""
+        self.set_eval()
+        batch_size = self.demo_cfg['dataloader']['batch_size']
+        sum_loss = torch.zeros((), device=self.ppo_device)
+        with torch.no_grad(), torch.cuda.amp.autocast(enabled=self.mixed_precision):
+            for obs, actions in self.demo_valid.iterate(batch_size):
+                res_dict = self.model({
+                    'is_train': False,
+                    'prev_actions': actions,
+                    'obs': self._preproc_obs(obs),
+                })
+                sum_loss += self.bc_loss(res_dict['mus'], actions).float() * actions.shape[0]
+        self.set_train()
+        return (sum_loss / len(self.demo_valid)).item()
 
     def bc_loss(self, actions: torch.Tensor,
                 target_actions: torch.Tensor) -> torch.Tensor:
@@ -147,7 +238,8 @@ class DAPGAgent(A2CAgent):
         }
 
         # sample demonstration data
-        demo_train_dict, demo_valid_dict = self.sample_demo_train_valid()
+        demo_train_dict = self.sample_demo_dict()
+        demo_train_actions = demo_train_dict['prev_actions']
 
         rnn_masks = None
         if self.is_rnn:
@@ -155,10 +247,29 @@ class DAPGAgent(A2CAgent):
             batch_dict['rnn_states'] = input_dict['rnn_states']
             batch_dict['seq_length'] = self.seq_len
 
+        # PPO and demo minibatches go through a single forward unless sequences or dict observations prevent it
+        fused_forward = not self.is_rnn and isinstance(obs_batch, torch.Tensor)
+        num_ppo = actions_batch.shape[0]
+
         with torch.cuda.amp.autocast(enabled=self.mixed_precision):
-            # regular PPO losses
-            res_dict = self.model(batch_dict)
+            if fused_forward:
+                if self.normalize_input and self.model.running_mean_std.training:
+                    # update the normalization statistics with the PPO observations only
+                    with torch.no_grad():
+                        self.model.running_mean_std(obs_batch)
+                with self.frozen_normalizer():
+                    res_dict = self.model({
+                        'is_train': True,
+                        'prev_actions': torch.cat([actions_batch, demo_train_actions]),
+                        'obs': torch.cat([obs_batch, demo_train_dict['obs']]),
+                    })
+                demo_mu = res_dict['mus'][num_ppo:]
+                res_dict = {k: res_dict[k][:num_ppo] for k in ['prev_neglogp', 'values', 'entropy', 'mus', 'sigmas']}
+            else:
+                res_dict = self.model(batch_dict)
+                demo_mu = self.get_demo_actions(demo_train_dict)
 
+            # regular PPO losses
             action_log_probs = res_dict['prev_neglogp']
             values = res_dict['values']
             entropy = res_dict['entropy']
@@ -190,22 +301,12 @@ class DAPGAgent(A2CAgent):
             ppo_loss = a_loss + 0.5 * c_loss * self.critic_coef - entropy * self.entropy_coef + b_loss * self.bounds_loss_coef
 
             # Imitation loss
-            demo_train_actions, demo_valid_actions = self.get_demo_actions(
-                demo_train_dict, demo_valid_dict)
-
-            bc_train_loss = self.bc_loss(demo_train_actions,
-                                         demo_train_dict['prev_actions'])
-            bc_valid_loss = self.bc_loss(demo_valid_actions,
-                                         demo_valid_dict['prev_actions'])
+            bc_train_loss = self.bc_loss(demo_mu, demo_train_actions)
 
             # Sum up bc and ppo loss
             loss = self.ppo_coef * ppo_loss + self.bc_coef * bc_train_loss
 
-            if self.multi_gpu:
-                self.optimizer.zero_grad()
-            else:
-                for param in self.model.parameters():
-                    param.grad = None
+            self.zero_grads()
 
         self.scaler.scale(loss).backward()
         # TODO: Refactor this ugliest code of they year
@@ -232,7 +333,7 @@ class DAPGAgent(A2CAgent):
         self.train_result = (a_loss, c_loss, entropy, \
                              kl_dist, self.last_lr, lr_mul, \
                              mu.detach(), sigma.detach(), b_loss,
-                             bc_train_loss, bc_valid_loss)
+                             bc_train_loss)
 
     def train(self):
         self.init_tensors()
@@ -245,19 +346,18 @@ class DAPGAgent(A2CAgent):
 
         if self.multi_gpu:
             print("====================broadcasting parameters")
-            model_params = [self.model.state_dict()]
-            dist.broadcast_object_list(model_params, 0)
-            self.model.load_state_dict(model_params[0])
+            self.init_distributed_models()
 
         while True:
             epoch_num = self.update_epoch()
             self.current_epoch = epoch_num
-            step_time, play_time, update_time, sum_time, a_losses, c_losses, b_losses, bc_train_losses, bc_valid_losses, entropies, kls, last_lr, lr_mul = self.train_epoch()
+            step_time, play_time, update_time, sum_time, a_losses, c_losses, b_losses, bc_train_losses, entropies, kls, last_lr, lr_mul = self.train_epoch()
             total_time += sum_time
             frame = self.frame // self.num_agents
 
             # cleaning memory to optimize space
             self.dataset.update_values_dict(None)
+            self.sync_local_models()
             should_exit = False
 
             if self.rank == 0:
@@ -277,13 +377,14 @@ class DAPGAgent(A2CAgent):
 
                 self.write_stats(total_time, epoch_num, step_time, play_time, update_time, a_losses, c_losses, entropies, kls, last_lr, lr_mul, frame, scaled_time, scaled_play_time, curr_frames)
                 if len(b_losses) > 0:
-                    self.writer.add_scalar('losses/bounds_loss', torch_ext.mean_list(b_losses).item(), frame)
+                    self.writer.add_scalar('losses/bounds_loss', torch_ext.mean_list(b_losses), frame)
 
                 if self.has_soft_aug:
                     self.writer.add_scalar('losses/aug_loss', np.mean(aug_losses), frame)
 
-                self.writer.add_scalar('losses/bc_train_loss', torch_ext.mean_list(bc_train_losses).item(), frame)
-                self.writer.add_scalar('losses/bc_valid_loss', torch_ext.mean_list(bc_valid_losses).item(), frame)
+                self.writer.add_scalar('losses/bc_train_loss', torch_ext.mean_list(bc_train_losses), frame)
+                if epoch_num % self.bc_valid_every == 0:
+                    self.writer.add_scalar('losses/bc_valid_loss', self.evaluate_bc_valid(), frame)
                 self.writer.add_scalar('info/bc_coef', self.bc_coef, frame)
 
                 if self.game_rewards.current_size > 0:
@@ -330,11 +431,10 @@ class DAPGAgent(A2CAgent):
                     should_exit = True
 
                 update_time = 0
+                self.writer.flush()
 
             if self.multi_gpu:
-                should_exit_t = torch.tensor(should_exit, device=self.device).float()
-                dist.broadcast(should_exit_t, 0)
-                should_exit = should_exit_t.float().item()
+                should_exit = self.broadcast_exit_and_saves(should_exit)
             if should_exit:
                 return self.last_mean_rewards, epoch_num
 
@@ -349,6 +449,8 @@ class DAPGAgent(A2CAgent):
         with torch.no_grad():
             if self.is_rnn:
                 batch_dict = self.play_steps_rnn()
+            elif self.pingpong:
+                batch_dict = self.play_steps_pingpong()
             else:
                 batch_dict = self.play_steps()
 
@@ -367,18 +469,16 @@ class DAPGAgent(A2CAgent):
         c_losses = []
         b_losses = []
         bc_train_losses = []
-        bc_valid_losses = []
         entropies = []
         kls = []
 
         for mini_ep in range(0, self.mini_epochs_num):
             ep_kls = []
             for i in range(len(self.dataset)):
-                a_loss, c_loss, entropy, kl, last_lr, lr_mul, cmu, csigma, b_loss, bc_train_loss, bc_valid_loss = self.train_actor_critic(self.dataset[i])
+                a_loss, c_loss, entropy, kl, last_lr, lr_mul, cmu, csigma, b_loss, bc_train_loss = self.train_actor_critic(self.dataset[i])
                 a_losses.append(a_loss)
                 c_losses.append(c_loss)
                 bc_train_losses.append(bc_train_loss)
-                bc_valid_losses.append(bc_valid_loss)
                 ep_kls.append(kl)
                 entropies.append(entropy)
                 if self.bounds_loss_coef is not None:
@@ -387,7 +487,7 @@ class DAPGAgent(A2CAgent):
                 self.dataset.update_mu_sigma(cmu, csigma)
                 if self.schedule_type == 'legacy':
                     av_kls = kl
-                    if self.multi_gpu:
+                    if self.multi_gpu and not self.local_sgd:
                         dist.all_reduce(kl, op=dist.ReduceOp.SUM)
                         av_kls /= self.rank_size
                     self.last_lr, self.entropy_coef = self.scheduler.update(self.last_lr, self.entropy_coef, self.epoch_num, 0, av_kls.item())
@@ -411,4 +511,4 @@ class DAPGAgent(A2CAgent):
         update_time = update_time_end - update_time_start
         total_time = update_time_end - play_time_start
 
-        return batch_dict['step_time'], play_time, update_time, total_time, a_losses, c_losses, b_losses, bc_train_losses, bc_valid_losses, entropies, kls, last_lr, lr_mul
\ No newline at end of file
+        return batch_dict['step_time'], play_time, update_time, total_time, a_losses, c_losses, b_losses, bc_train_losses, entropies, kls, last_lr, lr_mul
\ No newline at end of file
@@ -0,0 +1,330 @@
+import queue
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from rl_games.algos_torch import a2c_continuous
+from rl_games.algos_torch import a2c_discrete
+from rl_games.common.a2c_common import rescale_actions, swap_and_flatten01
+from rl_games.common.vecenv import RayWorker
+
+'''
+IMPALA style decoupled acting and learning.
+Actor processes hold a cpu copy of the policy, step their envs next to it and ship complete trajectory segments
+with the behaviour log-probs to the learner through a torch.multiprocessing queue (tensors go through shared
+memory). The learner corrects for the policy lag with V-trace and publishes versioned weights to shared memory,
+actors pick up the latest version at the start of every segment.
+
+impala_config:
+    num_processes: number of actor processes, num_actors envs are split between them
+    queue_size: segments an actor may have in flight before it blocks, bounds the policy lag
+    rho_clip, c_clip: V-trace truncation levels of the importance weights
+    vtrace_lambda: trace coefficient multiplied into the truncated c weights, defaults to the GAE tau of the config
+'''
+
+
+def _actor_loop(actor_id, config_name, env_config, network, build_config, num_envs, horizon_length, action_bounds,
+                shared_weights, version, segment_queue, stop_event, seed, pre_reset_pool=0):
+    torch.set_num_threads(1)
+    envs = [RayWorker(config_name, env_config, pre_reset_pool) for _ in range(num_envs)]
+    if seed is not None:
+        for i, env in enumerate(envs):
+            env.seed(seed + i)
+
+    model = network.build(build_config)
+    model.eval()
+    local_version = -1
+
+    obs = np.stack([env.reset()[0] for env in envs])
+    dones = torch.ones(num_envs, dtype=torch.uint8)
+    current_rewards = np.zeros(num_envs, dtype=np.float32)
+    current_lengths = np.zeros(num_envs, dtype=np.float32)
+
+    while not stop_event.is_set():
+        with version.get_lock():
+            if version.value != local_version:
+                model.load_state_dict(shared_weights)
+                local_version = version.value
+
+        mb_obses, mb_actions, mb_neglogpacs, mb_rewards, mb_dones = [], [], [], [], []
+        episode_rewards, episode_lengths = [], []
+        for n in range(horizon_length):
+            obs_tensor = torch.from_numpy(obs)
+            processed_obs = obs_tensor.float() / 255.0 if obs_tensor.dtype == torch.uint8 else obs_tensor
+            with torch.no_grad():
+                res_dict = model({'is_train': False, 'prev_actions': None, 'obs': processed_obs, 'rnn_states': None})
+            actions = res_dict['actions']
+            env_actions = actions
+            if action_bounds is not None:
+                env_actions = rescale_actions(action_bounds[0], action_bounds[1], torch.clamp(actions, -1.0, 1.0))
+            env_actions = env_actions.numpy()
+
+            mb_obses.append(obs_tensor)
+            mb_actions.append(actions)
+            mb_neglogpacs.append(res_dict['neglogpacs'].reshape(num_envs))
+            mb_dones.append(dones)
+
+            next_obs, rewards, step_dones = [], np.zeros(num_envs, dtype=np.float32), np.zeros(num_envs, dtype=np.uint8)
+            for i, env in enumerate(envs):
+                o, r, d, _, _ = env.step(env_actions[i])
+                next_obs.append(o)
+                rewards[i] = r
+                step_dones[i] = d
+            obs = np.stack(next_obs)
+            dones = torch.from_numpy(step_dones)
+            mb_rewards.append(torch.from_numpy(rewards))
+
+            current_rewards += rewards
+            current_lengths += 1
+            for i in np.nonzero(step_dones)[0]:
+                episode_rewards.append(current_rewards[i])
+                episode_lengths.append(current_lengths[i])
+            current_rewards[step_dones > 0] = 0.0
+            current_lengths[step_dones > 0] = 0.0
+
+        segment = {
+            'actor_id': actor_id,
+            'version': local_version,
+            'obses': torch.stack(mb_obses),
+            'actions': torch.stack(mb_actions),
+            'neglogpacs': torch.stack(mb_neglogpacs),
+            'rewards': torch.stack(mb_rewards),
+            'dones': torch.stack(mb_dones),
+            'last_obs': torch.from_numpy(obs),
+            'last_dones': dones,
+            'episode_rewards': torch.tensor(episode_rewards, dtype=torch.float32),
+            'episode_lengths': torch.tensor(episode_lengths, dtype=torch.float32),
+        }
+        while not stop_event.is_set():
+            try:
+                segment_queue.put(segment, timeout=1.0)
+                break
+            except queue.Full:
+                continue
+
+
+def get_env_info(config_name, env_config):
+    env_config = dict(env_config)
+    env_config.pop('seed', None)
+    worker = RayWorker(config_name, env_config)
+    env_info = worker.get_env_info()
+    if hasattr(worker.env, 'close'):
+        worker.env.close()
+    return env_info
+
+
+class ImpalaActorPool:
+    '''
+    Takes the place of the vec env of the learner (config vec_env). It is not an IVecEnv: the envs live in the actor
+    processes and are only reached through get_segments() in ImpalaMixin.play_steps. The other methods are the
+    ones A2CBase calls on its vec env.
+    '''
+    def __init__(self, config_name, num_actors, num_processes, queue_size=2, **kwargs):
+        assert num_actors % num_processes == 0, 'num_actors must be divisible by impala_config num_processes'
+        self.config_name = config_name
+        self.num_actors = num_actors
+        self.num_processes = num_processes
+        self.envs_per_process = num_actors // num_processes
+        self.seed = kwargs.pop('seed', None)
+        self.pre_reset_pool = kwargs.pop('pre_reset_pool', 0)
+        self.env_config = kwargs
+        self.env_info = get_env_info(config_name, kwargs)
+
+        self.ctx = mp.get_context('spawn')
+        self.segment_queue = self.ctx.Queue(maxsize=queue_size * num_processes)
+        self.stop_event = self.ctx.Event()
+        self.version = self.ctx.Value('l', 0)
+        self.shared_weights = None
+        self.processes = []
+
+    def get_env_info(self):
+        return self.env_info
+
+    def get_number_of_agents(self):
+        return 1
+
+    def has_action_masks(self):
+        return False
+
+    def set_train_info(self, env_frames, *args, **kwargs):
+        # the envs of the actor processes do not receive training information
+        pass
+
+    def get_env_state(self):
+        return None
+
+    def set_env_state(self, env_state):
+        pass
+
+    def start(self, model, network, build_config, horizon_length, action_bounds=None):
+        self.shared_weights = {k: v.detach().cpu().clone().share_memory_() for k, v in model.state_dict().items()}
+        for i in range(self.num_processes):
+            seed = None if self.seed is None else self.seed + i * self.envs_per_process
+            process = self.ctx.Process(target=_actor_loop, args=(i, self.config_name, self.env_config, network, build_config,
+                self.envs_per_process, horizon_length, action_bounds, self.shared_weights, self.version,
+                self.segment_queue, self.stop_event, seed, self.pre_reset_pool), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def publish(self, model):
+        with self.version.get_lock():
+            for k, v in model.state_dict().items():
+                self.shared_weights[k].copy_(v.detach())
+            self.version.value += 1
+
+    def get_segments(self, num_segments):
+        segments = []
+        while len(segments) < num_segments:
+            try:
+                segments.append(self.segment_queue.get(timeout=10.0))
+            except queue.Empty:
+                assert all(p.is_alive() for p in self.processes), 'an impala actor process died'
+        return segments
+
+    def close(self):
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+
+class ImpalaMixin:
+    '''
+    Replaces play_steps of the PPO agents: rollouts come from ImpalaActorPool, advantages and value targets are
+    V-trace corrected for the lag between the behaviour and the learner policy. Log-probs and values of the
+    learner policy are used as old values, so the PPO ratio is taken with respect to the current learner policy.
+    '''
+    def __init__(self, base_name, params):
+        config = params['config']
+        self.impala_config = config.get('impala_config', {})
+        pool = ImpalaActorPool(config['env_name'], config['num_actors'], self.impala_config.get('num_processes', 2),
+            self.impala_config.get('queue_size', 2), **config.get('env_config', {}))
+        config['env_info'] = pool.get_env_info()
+        config['vec_env'] = pool
+        super().__init__(base_name, params)
+        assert not self.is_rnn, 'impala does not support rnn models'
+        assert not self.has_central_value, 'impala does not support central value'
+        assert not self.use_action_masks, 'impala does not support action masks'
+        assert not self.multi_gpu, 'impala does not support multi gpu training'
+        assert self.num_agents == 1 and self.value_size == 1, 'impala supports single agent envs with one value'
+        assert not self.value_bootstrap, 'impala does not support value_bootstrap'
+        assert not isinstance(self.obs_shape, dict), 'impala does not support dict observations'
+        self.actor_pool = pool
+        self.rho_clip = self.impala_config.get('rho_clip', 1.0)
+        self.c_clip = self.impala_config.get('c_clip', 1.0)
+        self.vtrace_lambda = self.impala_config.get('vtrace_lambda', self.tau)
+        self.actors_started = False
+
+    def env_reset(self):
+        if not self.actors_started:
+            build_config = {
+                'actions_num' : self.actions_num,
+                'input_shape' : self.obs_shape,
+                'num_seqs' : self.num_actors * self.num_agents,
+                'value_size': self.value_size,
+                'normalize_value' : self.normalize_value,
+                'normalize_input': self.normalize_input,
+            }
+            action_bounds = None
+            if not self.is_discrete and self.clip_actions:
+                action_bounds = (self.actions_low.cpu(), self.actions_high.cpu())
+            self.actor_pool.start(self.model, self.network, build_config, self.horizon_length, action_bounds)
+            self.actors_started = True
+        return None
+
+    def train_epoch(self):
+        res = super().train_epoch()
+        self.actor_pool.publish(self.model)
+        return res
+
+    def vtrace(self, values, last_values, rewards, dones, last_dones, log_rhos):
+        '''
+        returns V-trace value targets and policy gradient advantages, all tensors are time major
+        '''
+        rhos = torch.exp(log_rhos).unsqueeze(-1)
+        clipped_rhos = torch.clamp(rhos, max=self.rho_clip)
+        cs = self.vtrace_lambda * torch.clamp(rhos, max=self.c_clip)
+
+        vs_minus_values = torch.zeros_like(values)
+        acc = torch.zeros_like(last_values)
+        for t in reversed(range(self.horizon_length)):
+            if t == self.horizon_length - 1:
+                nextnonterminal = 1.0 - last_dones.float()
+                nextvalues = last_values
+            else:
+                nextnonterminal = 1.0 - dones[t + 1].float()
+                nextvalues = values[t + 1]
+            nextnonterminal = nextnonterminal.unsqueeze(1)
+            delta = clipped_rhos[t] * (rewards[t] + self.gamma * nextvalues * nextnonterminal - values[t])
+            acc = delta + self.gamma * cs[t] * nextnonterminal * acc
+            vs_minus_values[t] = acc
+        vs = values + vs_minus_values
+
+        next_vs = torch.cat([vs[1:], last_values.unsqueeze(0)])
+        next_nonterminal = 1.0 - torch.cat([dones[1:], last_dones.unsqueeze(0)]).float().unsqueeze(-1)
+        pg_advantages = clipped_rhos * (rewards + self.gamma * next_vs * next_nonterminal - values)
+        return vs, pg_advantages
+
+    def play_steps(self):
+        step_time_start = time.time()
+        segments = self.actor_pool.get_segments(self.actor_pool.num_processes)
+        step_time = time.time() - step_time_start
+
+        def gather(key, dim=1):
+            return torch.cat([s[key] for s in segments], dim=dim).to(self.ppo_device)
+
+        obses = gather('obses')
+        actions = gather('actions')
+        behaviour_neglogpacs = gather('neglogpacs')
+        rewards = self.rewards_shaper(gather('rewards').unsqueeze(-1))
+        dones = gather('dones')
+        last_obs = gather('last_obs', 0)
+        last_dones = gather('last_dones', 0)
+
+        for s in segments:
+            self.game_rewards.update(s['episode_rewards'].unsqueeze(1).to(self.ppo_device))
+            self.game_lengths.update(s['episode_lengths'].unsqueeze(1).to(self.ppo_device))
+        policy_lag = np.mean([self.actor_pool.version.value - s['version'] for s in segments])
+        self.writer.add_scalar('impala/policy_lag', policy_lag, self.frame)
+
+        t, n = obses.shape[:2]
+        self.model.eval()
+        res_dict = self.model({
+            'is_train': True,
+            'prev_actions': actions.flatten(0, 1),
+            'obs': self._preproc_obs(obses.flatten(0, 1)),
+            'rnn_states': None,
+        })
+        values = self.model.unnorm_value(res_dict['values']).view(t, n, 1)
+        neglogpacs = res_dict['prev_neglogp'].view(t, n)
+        last_values = self.get_values({'obs': last_obs})
+
+        vs, advantages = self.vtrace(values, last_values, rewards, dones, last_dones, behaviour_neglogpacs - neglogpacs)
+
+        batch_dict = {
+            'obses': swap_and_flatten01(obses),
+            'actions': swap_and_flatten01(actions),
+            'neglogpacs': swap_and_flatten01(neglogpacs),
+            'values': swap_and_flatten01(values),
+            'dones': swap_and_flatten01(dones),
+            'returns': swap_and_flatten01(vs),
+            'advantages': swap_and_flatten01(advantages),
+            'played_frames': t * n,
+            'step_time': step_time,
+        }
+        if not self.is_discrete:
+            batch_dict['mus'] = swap_and_flatten01(res_dict['mus'].view(t, n, -1))
+            batch_dict['sigmas'] = swap_and_flatten01(res_dict['sigmas'].view(t, n, -1))
+        return batch_dict
+
+
+class ImpalaAgent(ImpalaMixin, a2c_continuous.A2CAgent):
+    pass
+
+
+class ImpalaDiscreteAgent(ImpalaMixin, a2c_discrete.DiscreteA2CAgent):
+    pass
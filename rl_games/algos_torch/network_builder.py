@@ -2012,6 +2012,56 @@ class DoubleQCritic(NetworkBuilder.BaseNetwork):
         return q1, q2
 
 
+class EnsembleLinear(nn.Module):
+    """ensemble_size independent linear layers with stacked weights, evaluated with a single batched matmul.
+    Maps (B, in_features) or (ensemble_size, B, in_features) inputs to (ensemble_size, B, out_features)."""
+    def __init__(self, ensemble_size, in_features, out_features):
+        super().__init__()
+        self.ensemble_size = ensemble_size
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.empty(ensemble_size, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(ensemble_size, 1, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        bound = 1.0 / math.sqrt(self.in_features)
+        with torch.no_grad():
+            for i in range(self.ensemble_size):
+                nn.init.kaiming_uniform_(self.weight[i], a=math.sqrt(5))
+            nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        if x.dim() == 2:
+            x = x.unsqueeze(0).expand(self.ensemble_size, -1, -1)
+        return torch.baddbmm(self.bias, x, self.weight.transpose(1, 2))
+
+
+class EnsembleQCritic(NetworkBuilder.BaseNetwork):
+    """Critic network with an ensemble of Q functions, all members are evaluated in one pass.
+    Returns Q values of shape (ensemble_size, B, output_dim)."""
+    def __init__(self, output_dim, ensemble_size, input_size, units, activation, d2rl=False, **mlp_args):
+        super().__init__()
+        assert not d2rl, 'd2rl is not supported by the ensemble critic'
+        assert ensemble_size >= 2, 'the critic ensemble needs at least two members'
+
+        self.ensemble_size = ensemble_size
+        layers = []
+        in_size = input_size
+        for unit in units:
+            layers.append(EnsembleLinear(ensemble_size, in_size, unit))
+            layers.append(self.activations_factory.create(activation))
+            in_size = unit
+        layers.append(EnsembleLinear(ensemble_size, in_size, output_dim))
+        self.Q = nn.Sequential(*layers)
+
+    def forward(self, obs, action):
+        assert obs.size(0) == action.size(0)
+
+        obs_action = torch.cat([obs, action], dim=-1)
+        return self.Q(obs_action)
+
+
 class SACBuilder(NetworkBuilder):
     def __init__(self, **kwargs):
         NetworkBuilder.__init__(self)
@@ -2074,8 +2124,18 @@ class SACBuilder(NetworkBuilder):
                     mlp_init(m.weight)
                     if getattr(m, "bias", None) is not None:
                         torch.nn.init.zeros_(m.bias)
+                if isinstance(m, EnsembleLinear):
+                    with torch.no_grad():
+                        for i in range(m.ensemble_size):
+                            mlp_init(m.weight[i])
+                    torch.nn.init.zeros_(m.bias)
+
+            if self.separate:
+                self.critic_target.load_state_dict(self.critic.state_dict())
 
         def _build_critic(self, output_dim, **mlp_args):
+            if self.critic_ensemble_size is not None:
+                return EnsembleQCritic(output_dim, self.critic_ensemble_size, **mlp_args)
             return DoubleQCritic(output_dim, **mlp_args)
 
         def _build_actor(self, output_dim, log_std_bounds, **mlp_args):
@@ -2104,6 +2164,8 @@ class SACBuilder(NetworkBuilder):
             self.central_value = params.get('central_value', False)
             self.joint_obs_actions_config = params.get('joint_obs_actions', None)
             self.log_std_bounds = params.get('log_std_bounds', None)
+            # number of Q functions of the critic, None builds the DoubleQCritic
+            self.critic_ensemble_size = params.get('critic_ensemble_size', None)
 
             if self.has_space:
                 self.is_discrete = 'discrete' in params['space']
@@ -0,0 +1,85 @@
+import copy
+
+import torch
+from torch import nn
+
+from rl_games.algos_torch.network_builder import A2CResnetBuilder
+
+'''
+int8 post-training quantization of trained models for CPU inference.
+
+dynamic: nn.Linear layers of the mlp stacks (layers living inside nn.Sequential/D2RLNet containers, i.e. built by
+         NetworkBuilder._build_mlp) get int8 weights and dynamically quantized activations.
+         Output heads (mu, value, logits, ...) are kept in fp32.
+static:  dynamic mlp quantization plus static int8 quantization of the A2CResnetBuilder conv stack.
+         Activation ranges are calibrated on observations recorded with the fp32 policy.
+'''
+
+QUANTIZATION_MODES = ['dynamic', 'static']
+
+
+def mlp_linear_names(model):
+    names = set()
+    for name, module in model.named_modules():
+        if not isinstance(module, nn.Linear):
+            continue
+        parent_name = name.rpartition('.')[0]
+        parent = model.get_submodule(parent_name) if parent_name else model
+        if isinstance(parent, nn.Sequential) or type(parent).__name__ == 'D2RLNet':
+            names.add(name)
+    return names
+
+
+def quantize_dynamic_mlp(model, inplace=False):
+    names = mlp_linear_names(model)
+    if len(names) == 0:
+        print('quantization: no mlp layers found, model is kept in fp32')
+        return model if inplace else copy.deepcopy(model)
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec=names, dtype=torch.qint8, inplace=inplace)
+
+
+def get_resnet_network(model):
+    network = getattr(model, 'a2c_network', None)
+    if isinstance(network, A2CResnetBuilder.Network):
+        return network
+    return None
+
+
+def prepare_static_cnn(model, example_input, backend='fbgemm'):
+    '''
+    inserts observers into the resnet conv stack, returns False if the model has no conv stack to quantize
+    example_input: input of the conv stack, see capture_cnn_input
+    '''
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx
+
+    network = get_resnet_network(model)
+    if network is None:
+        print('quantization: static quantization is supported only for resnet_actor_critic conv stacks')
+        return False
+    torch.backends.quantized.engine = backend
+    network.cnn = prepare_fx(network.cnn.eval(), get_default_qconfig_mapping(backend), (example_input,))
+    return True
+
+
+def convert_static_cnn(model):
+    from torch.ao.quantization.quantize_fx import convert_fx
+
+    network = get_resnet_network(model)
+    network.cnn = convert_fx(network.cnn)
+    return model
+
+
+def capture_cnn_input(model, forward_fn):
+    '''
+    returns the tensor the resnet conv stack receives when forward_fn runs the model
+    '''
+    captured = []
+    network = get_resnet_network(model)
+    handle = network.cnn.register_forward_pre_hook(lambda module, args: captured.append(args[0].detach()))
+    try:
+        forward_fn()
+    finally:
+        handle.remove()
+    return captured[0]
+
@@ -6,6 +6,10 @@ import numpy as np
 updates statistic from a full data
 '''
 class RunningMeanStd(nn.Module):
+    # set by distributed.utils.sync_normalizers, the batch moments are collected and combined over all ranks
+    # by distributed.utils.sync_normalizer_stats once per epoch
+    sync_stats = False
+
     def __init__(self, insize, epsilon=1e-05, per_channel=False, norm_only=False):
         super(RunningMeanStd, self).__init__()
         print('RunningMeanStd: ', insize)
@@ -29,6 +33,8 @@ class RunningMeanStd(nn.Module):
         self.register_buffer("running_mean", torch.zeros(in_size, dtype = torch.float64))
         self.register_buffer("running_var", torch.ones(in_size, dtype = torch.float64))
         self.register_buffer("count", torch.ones((), dtype = torch.float64))
+        self.pending_moments = None
+        self.synced_stats = None
 
     def _update_mean_var_count_from_moments(self, mean, var, count, batch_mean, batch_var, batch_count):
         delta = batch_mean - mean
@@ -42,6 +48,42 @@ class RunningMeanStd(nn.Module):
         new_count = tot_count
         return new_mean, new_var, new_count
 
+    def _accumulate_moments(self, mean, var, count):
+        mean, var = mean.double().reshape(-1), var.double().reshape(-1)
+        if self.pending_moments is None:
+            # statistics before the first local update since the last sync
+            self.synced_stats = (self.running_mean, self.running_var, self.count)
+            self.pending_moments = torch.zeros(2 * mean.numel() + 1, dtype=torch.float64, device=mean.device)
+        self.pending_moments += torch.cat([mean * count, (var + mean ** 2) * count, mean.new_full((1,), float(count))])
+
+    def pop_moments(self):
+        '''
+        returns the summed batch moments since the last sync: count * mean, count * E[x^2] and count
+        '''
+        moments = self.pending_moments
+        if moments is None:
+            moments = torch.zeros(2 * self.running_mean.numel() + 1, dtype=torch.float64, device=self.running_mean.device)
+        self.pending_moments = None
+        return moments
+
+    def apply_moments(self, moments):
+        '''
+        replaces the local updates since the last sync by one update with moments summed over all ranks
+        '''
+        n = self.running_mean.numel()
+        total_count = moments[-1]
+        # a zero count leaves the statistics unchanged
+        safe_count = total_count.clamp(min=1.0)
+        mean = (moments[:n] / safe_count).view_as(self.running_mean)
+        var = ((moments[n:2 * n] / safe_count).view_as(self.running_var) - mean ** 2).clamp(min=0.0)
+        if self.synced_stats is not None:
+            base_mean, base_var, base_count = self.synced_stats
+        else:
+            base_mean, base_var, base_count = self.running_mean, self.running_var, self.count
+        self.running_mean, self.running_var, self.count = self._update_mean_var_count_from_moments(base_mean, base_var, base_count,
+                                                mean, var, total_count)
+        self.synced_stats = None
+
     def forward(self, input, unnorm=False, mask=None):
         if self.training:
             if mask is not None:
@@ -49,8 +91,11 @@ class RunningMeanStd(nn.Module):
             else:
                 mean = input.mean(self.axis) # along channel axis
                 var = input.var(self.axis)
+            batch_count = input.size()[0]
+            if self.sync_stats:
+                self._accumulate_moments(mean, var, batch_count)
             self.running_mean, self.running_var, self.count = self._update_mean_var_count_from_moments(self.running_mean, self.running_var, self.count, 
-                                                    mean, var, input.size()[0] )
+                                                    mean, var, batch_count )
 
         # change shape
         if self.per_channel:
@@ -1,6 +1,7 @@
 from rl_games.algos_torch import torch_ext
 
 from rl_games.algos_torch.running_mean_std import RunningMeanStd
+from rl_games.algos_torch.sac_helper import ensemble_min
 
 from rl_games.common import vecenv
 from rl_games.common import schedulers
@@ -15,6 +16,8 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 import numpy as np
+import copy
+import gym
 import time
 import os
 
@@ -39,6 +42,20 @@ class SACAgent(BaseAlgorithm):
         self.normalize_input = config.get("normalize_input", False)
 
         self.max_env_steps = config.get("max_env_steps", 1000) # temporary, in future we will use other approach
+        # every env_steps_per_update env steps an update block of round(update_to_data_ratio * env_steps_per_update)
+        # updates runs on minibatches sampled in one pass
+        self.update_to_data_ratio = config.get("update_to_data_ratio", 1)
+        self.env_steps_per_update = config.get("env_steps_per_update", 1)
+        self.num_updates_per_block = max(1, int(round(self.update_to_data_ratio * self.env_steps_per_update)))
+        self.compile_updates = config.get("compile_updates", False)
+        # random shift augmentation of sampled uint8 images, 0 disables it
+        self.random_shift_pad = config.get("random_shift_pad", 0)
+        self.images_channels_last = config.get("images_channels_last", True)
+        # REDQ style targets: min over a random subset of the critic ensemble, None uses all members
+        self.critic_target_subset_size = config.get("critic_target_subset_size", None)
+        # 'min' or 'mean' over the ensemble Q values in the actor loss
+        self.actor_q_reduction = config.get("actor_q_reduction", "min")
+        assert self.actor_q_reduction in ['min', 'mean']
 
         print(self.batch_size, self.num_actors, self.num_agents)
 
@@ -54,12 +71,16 @@ class SACAgent(BaseAlgorithm):
             float(self.env_info['action_space'].high.max())
         ]
 
-        obs_shape = torch_ext.shape_whc_to_cwh(self.obs_shape)
+        # the SAC networks are MLPs, image and dict observations are flattened in preproc_obs after sampling
+        if isinstance(self.obs_shape, dict):
+            obs_dim = sum(int(np.prod(v)) for v in self.obs_shape.values())
+        else:
+            obs_dim = int(np.prod(self.obs_shape))
         net_config = {
-            'obs_dim': self.env_info["observation_space"].shape[0],
+            'obs_dim': obs_dim,
             'action_dim': self.env_info["action_space"].shape[0],
             'actions_num' : self.actions_num,
-            'input_shape' : obs_shape,
+            'input_shape' : (obs_dim,),
             'normalize_input' : self.normalize_input,
             'normalize_input': self.normalize_input,
         }
@@ -80,10 +101,35 @@ class SACAgent(BaseAlgorithm):
                                                     lr=float(self.config["alpha_lr"]),
                                                     betas=self.config.get("alphas_betas", [0.9, 0.999]))
 
-        self.replay_buffer = experience.VectorizedReplayBuffer(self.env_info['observation_space'].shape,
-        self.env_info['action_space'].shape,
-        self.replay_buffer_size,
-        self._device)
+        # critic and target weights in contiguous buffers, polyak averaging becomes one lerp per buffer
+        self.use_flat_params = config.get("flat_params", False)
+        if self.use_flat_params:
+            self.critic_flat_params = torch_ext.FlatParameters(self.model.sac_network.critic.parameters())
+            self.critic_target_flat_params = torch_ext.FlatParameters(self.model.sac_network.critic_target.parameters(), with_grads=False)
+
+        # 'transition' stores obs and next_obs per transition, 'trajectory' stores every observation once,
+        # 'memmap' keeps transitions in files under replay_buffer_dir which are reopened on restart
+        self.replay_buffer_type = config.get("replay_buffer_type", "transition")
+        if self.replay_buffer_type == 'memmap':
+            assert 'replay_buffer_dir' in config, 'memmap replay buffer needs replay_buffer_dir'
+            self.replay_buffer = experience.MemmapReplayBuffer(self.env_info['observation_space'],
+            self.env_info['action_space'].shape,
+            self.replay_buffer_size,
+            self._device,
+            config['replay_buffer_dir'],
+            hot_size=config.get("replay_hot_size", 1024),
+            num_prefetch=config.get("replay_num_prefetch", 2))
+        elif self.replay_buffer_type == 'trajectory':
+            self.replay_buffer = experience.TrajectoryReplayBuffer(self.env_info['observation_space'],
+            self.env_info['action_space'].shape,
+            self.replay_buffer_size,
+            self.num_actors * self.num_agents,
+            self._device)
+        else:
+            self.replay_buffer = experience.VectorizedReplayBuffer(self.env_info['observation_space'],
+            self.env_info['action_space'].shape,
+            self.replay_buffer_size,
+            self._device)
         self.target_entropy_coef = config.get("target_entropy_coef", 1.0)
         self.target_entropy = self.target_entropy_coef * -self.env_info['action_space'].shape[0]
         print("Target entropy", self.target_entropy)
@@ -91,6 +137,9 @@ class SACAgent(BaseAlgorithm):
         self.step = 0
         self.algo_observer = config['features']['observer']
 
+        self.update_step_fn = torch.compile(self.update_step) if self.compile_updates else self.update_step
+        self.env_steps_since_update = 0
+
         # TODO: Is there a better way to get the maximum number of episodes?
         self.max_episodes = torch.ones(self.num_actors, device=self._device)*self.num_steps_per_episode
         # self.episode_lengths = np.zeros(self.num_actors, dtype=int)
@@ -123,7 +172,8 @@ class SACAgent(BaseAlgorithm):
         #self.use_action_masks = config.get('use_action_masks', False)
         self.is_train = config.get('is_train', True)
 
-        self.c_loss = nn.MSELoss()
+        # elementwise, reduced per critic member in update_critic
+        self.c_loss = nn.MSELoss(reduction='none')
         # self.c2_loss = nn.SmoothL1Loss()
 
         self.save_best_after = config.get('save_best_after', 500)
@@ -136,7 +186,10 @@ class SACAgent(BaseAlgorithm):
         self.network = config['network']
         self.rewards_shaper = config['reward_shaper']
         self.num_agents = self.env_info.get('agents', 1)
-        self.obs_shape = self.observation_space.shape
+        if isinstance(self.observation_space, gym.spaces.Dict):
+            self.obs_shape = {k: v.shape for k, v in self.observation_space.spaces.items()}
+        else:
+            self.obs_shape = self.observation_space.shape
 
         self.games_to_track = self.config.get('games_to_track', 100)
         self.game_rewards = torch_ext.AverageMeter(1, self.games_to_track).to(self._device)
@@ -223,6 +276,8 @@ class SACAgent(BaseAlgorithm):
     def save(self, fn):
         state = self.get_full_state_weights()
         torch_ext.save_checkpoint(fn, state)
+        if hasattr(self.replay_buffer, 'flush'):
+            self.replay_buffer.flush()
 
     def set_weights(self, weights):
         self.model.sac_network.actor.load_state_dict(weights['actor'])
@@ -253,28 +308,39 @@ class SACAgent(BaseAlgorithm):
     def set_train(self):
         self.model.train()
 
+    def stack_q(self, q_values):
+        '''
+        returns Q values of all critic members as a (num_members, B, 1) tensor
+        '''
+        if isinstance(q_values, (tuple, list)):
+            return torch.stack(q_values)
+        return q_values
+
     def update_critic(self, obs, action, reward, next_obs, not_done, step):
         with torch.no_grad():
             dist = self.model.actor(next_obs)
             next_action = dist.rsample()
             log_prob = dist.log_prob(next_action).sum(-1, keepdim=True)
-            target_Q1, target_Q2 = self.model.critic_target(next_obs, next_action)
-            target_V = torch.min(target_Q1, target_Q2) - self.alpha * log_prob
+            target_Qs = self.stack_q(self.model.critic_target(next_obs, next_action))
+            target_V = ensemble_min(target_Qs, self.critic_target_subset_size) - self.alpha * log_prob
 
             target_Q = reward + (not_done * self.gamma * target_V)
             target_Q = target_Q.detach()
 
         # get current Q estimates
-        current_Q1, current_Q2 = self.model.critic(obs, action)
+        current_Qs = self.stack_q(self.model.critic(obs, action))
 
-        critic1_loss = self.c_loss(current_Q1, target_Q)
-        critic2_loss = self.c_loss(current_Q2, target_Q)
-        critic_loss = critic1_loss + critic2_loss 
-        self.critic_optimizer.zero_grad(set_to_none=True)
+        critic_losses = self.c_loss(current_Qs, target_Q.unsqueeze(0).expand_as(current_Qs)).mean(dim=(1, 2))
+        critic_loss = critic_losses.sum()
+        if self.use_flat_params:
+            self.critic_flat_params.zero_grad()
+        else:
+            self.critic_optimizer.zero_grad(set_to_none=True)
         critic_loss.backward()
         self.critic_optimizer.step()
 
-        return critic_loss.detach(), critic1_loss.detach(), critic2_loss.detach()
+        critic_losses = critic_losses.detach()
+        return critic_loss.detach(), critic_losses[0], critic_losses[1]
 
     def update_actor_and_alpha(self, obs, step):
         for p in self.model.sac_network.critic.parameters():
@@ -284,8 +350,11 @@ class SACAgent(BaseAlgorithm):
         action = dist.rsample()
         log_prob = dist.log_prob(action).sum(-1, keepdim=True)
         entropy = -log_prob.mean() #dist.entropy().sum(-1, keepdim=True).mean()
-        actor_Q1, actor_Q2 = self.model.critic(obs, action)
-        actor_Q = torch.min(actor_Q1, actor_Q2)
+        actor_Qs = self.stack_q(self.model.critic(obs, action))
+        if self.actor_q_reduction == 'min':
+            actor_Q = actor_Qs.min(dim=0)[0]
+        else:
+            actor_Q = actor_Qs.mean(dim=0)
 
         actor_loss = (torch.max(self.alpha.detach(), self.min_alpha) * log_prob - actor_Q)
         actor_loss = actor_loss.mean()
@@ -309,28 +378,82 @@ class SACAgent(BaseAlgorithm):
         return actor_loss.detach(), entropy.detach(), self.alpha.detach(), alpha_loss # TODO: maybe not self.alpha
 
     def soft_update_params(self, net, target_net, tau):
-        for param, target_param in zip(net.parameters(), target_net.parameters()):
-            target_param.data.copy_(tau * param.data +
-                                    (1 - tau) * target_param.data)
-
-    def update(self, step):
-        obs, action, reward, next_obs, done = self.replay_buffer.sample(self.batch_size)
-        not_done = ~done
+        params = list(net.parameters())
+        target_params = list(target_net.parameters())
+        with torch.no_grad():
+            if hasattr(torch, '_foreach_lerp_'):
+                torch._foreach_lerp_(target_params, params, tau)
+            else:
+                for param, target_param in zip(params, target_params):
+                    target_param.lerp_(param, tau)
 
-        obs = self.preproc_obs(obs)
-        next_obs = self.preproc_obs(next_obs)
+    def update_step(self, obs, action, reward, next_obs, not_done, step):
         critic_loss, critic1_loss, critic2_loss = self.update_critic(obs, action, reward, next_obs, not_done, step)
 
         actor_loss, entropy, alpha, alpha_loss = self.update_actor_and_alpha(obs, step)
 
         actor_loss_info = actor_loss, entropy, alpha, alpha_loss
-        self.soft_update_params(self.model.sac_network.critic, self.model.sac_network.critic_target,
-                                     self.critic_tau)
+        if self.use_flat_params:
+            self.critic_target_flat_params.lerp_(self.critic_flat_params, self.critic_tau)
+        else:
+            self.soft_update_params(self.model.sac_network.critic, self.model.sac_network.critic_target,
+                                         self.critic_tau)
         return actor_loss_info, critic1_loss, critic2_loss
 
-    def preproc_obs(self, obs):
-        if isinstance(obs, dict):
+    def update_block(self, num_updates, step):
+        # indices of all minibatches are drawn and gathered at once
+        obs, action, reward, next_obs, done = self.replay_buffer.sample(self.batch_size * num_updates)
+        not_done = ~done
+
+        obs = self.preproc_obs(obs, augment=True)
+        next_obs = self.preproc_obs(next_obs, augment=True)
+
+        results = []
+        for i in range(num_updates):
+            batch = slice(i * self.batch_size, (i + 1) * self.batch_size)
+            results.append(self.update_step_fn(experience.obs_get(obs, batch), action[batch], reward[batch],
+                                               experience.obs_get(next_obs, batch), not_done[batch], step))
+        return results
+
+    def update(self, step):
+        return self.update_block(1, step)[0]
+
+    def unwrap_obs(self, obs):
+        has_obs_key = isinstance(self.observation_space, gym.spaces.Dict) and 'obs' in self.observation_space.spaces
+        if isinstance(obs, dict) and 'obs' in obs and not has_obs_key:
             obs = obs['obs']
+        return obs
+
+    def random_shift(self, images):
+        if self.images_channels_last:
+            images = images.permute((0, 3, 1, 2))
+        images = torch_ext.random_shift(images, self.random_shift_pad)
+        if self.images_channels_last:
+            images = images.permute((0, 2, 3, 1))
+        return images
+
+    def _preproc_obs(self, obs_batch, augment=False):
+        if type(obs_batch) is dict:
+            obs_batch = copy.copy(obs_batch)
+            for k, v in obs_batch.items():
+                obs_batch[k] = self._preproc_obs(v, augment)
+        elif obs_batch.dtype == torch.uint8:
+            obs_batch = obs_batch.float() / 255.0
+            if augment and self.random_shift_pad > 0 and obs_batch.dim() == 4:
+                obs_batch = self.random_shift(obs_batch)
+        return obs_batch
+
+    def flatten_obs(self, obs):
+        if isinstance(obs, dict):
+            return torch.cat([obs[k].reshape(obs[k].shape[0], -1).float() for k in self.obs_shape], dim=1)
+        if obs.dim() > 2:
+            obs = obs.reshape(obs.shape[0], -1)
+        return obs
+
+    def preproc_obs(self, obs, augment=False):
+        obs = self.unwrap_obs(obs)
+        obs = self._preproc_obs(obs, augment)
+        obs = self.flatten_obs(obs)
         obs = self.model.norm_obs(obs)
         return obs
 
@@ -338,8 +461,8 @@ class SACAgent(BaseAlgorithm):
         if isinstance(obs, torch.Tensor):
             self.is_tensor_obses = True
         elif isinstance(obs, np.ndarray):
-            assert(self.observation_space.dtype != np.int8)
-            if self.observation_space.dtype == np.uint8:
+            assert(obs.dtype != np.int8)
+            if obs.dtype == np.uint8:
                 obs = torch.ByteTensor(obs).to(self._device)
             else:
                 obs = torch.FloatTensor(obs).to(self._device)
@@ -378,16 +501,17 @@ class SACAgent(BaseAlgorithm):
         obs, rewards, dones, infos = self.vec_env.step(actions) # (obs_space) -> (n, obs_space)
 
         self.step += self.num_actors
+        obs = self.unwrap_obs(self.obs_to_tensors(obs))
         if self.is_tensor_obses:
-            return self.obs_to_tensors(obs), rewards.to(self._device), dones.to(self._device), infos
+            return obs, rewards.to(self._device), dones.to(self._device), infos
         else:
-            return torch.from_numpy(obs).to(self._device), torch.from_numpy(rewards).to(self._device), torch.from_numpy(dones).to(self._device), infos
+            return obs, torch.from_numpy(rewards).to(self._device), torch.from_numpy(dones).to(self._device), infos
 
     def env_reset(self):
         with torch.no_grad():
             obs = self.vec_env.reset()
 
-        obs = self.obs_to_tensors(obs)
+        obs = self.unwrap_obs(self.obs_to_tensors(obs))
 
         return obs
 
@@ -435,7 +559,7 @@ class SACAgent(BaseAlgorithm):
                 action = torch.rand((self.num_actors, *self.env_info["action_space"].shape), device=self._device) * 2.0 - 1.0
             else:
                 with torch.no_grad():
-                    action = self.act(obs.float(), self.env_info["action_space"].shape, sample=True)
+                    action = self.act(obs, self.env_info["action_space"].shape, sample=True)
 
             step_start = time.time()
 
@@ -458,33 +582,33 @@ class SACAgent(BaseAlgorithm):
 
             self.algo_observer.process_infos(infos, done_indices)
 
+            # envs reset after done and after timeouts, only the former cut the bootstrap
+            terminals = dones.bool()
             no_timeouts = self.current_lengths != self.max_env_steps
             dones = dones * no_timeouts
 
             self.current_rewards = self.current_rewards * not_dones
             self.current_lengths = self.current_lengths * not_dones
 
-            if isinstance(obs, dict):
-                obs = obs['obs']
-            if isinstance(next_obs, dict):    
-                next_obs = next_obs['obs']
-
             rewards = self.rewards_shaper(rewards)
 
-            self.replay_buffer.add(obs, action, torch.unsqueeze(rewards, 1), next_obs, torch.unsqueeze(dones, 1))
+            self.replay_buffer.add(obs, action, torch.unsqueeze(rewards, 1), next_obs, torch.unsqueeze(dones, 1), terminals)
 
-            self.obs = obs = next_obs.clone()
+            self.obs = obs = experience.obs_map(next_obs, lambda v: v.clone())
 
-            if not random_exploration:
+            self.env_steps_since_update += 1
+            if not random_exploration and self.env_steps_since_update >= self.env_steps_per_update:
+                self.env_steps_since_update = 0
                 self.set_train()
                 update_time_start = time.time()
-                actor_loss_info, critic1_loss, critic2_loss = self.update(self.epoch_num)
+                update_results = self.update_block(self.num_updates_per_block, self.epoch_num)
                 update_time_end = time.time()
                 update_time = update_time_end - update_time_start
 
-                self.extract_actor_stats(actor_losses, entropies, alphas, alpha_losses, actor_loss_info)
-                critic1_losses.append(critic1_loss)
-                critic2_losses.append(critic2_loss)
+                for actor_loss_info, critic1_loss, critic2_loss in update_results:
+                    self.extract_actor_stats(actor_losses, entropies, alphas, alpha_losses, actor_loss_info)
+                    critic1_losses.append(critic1_loss)
+                    critic2_losses.append(critic2_loss)
             else:
                 update_time = 0
 
@@ -497,7 +621,9 @@ class SACAgent(BaseAlgorithm):
         return step_time, play_time, total_update_time, total_time, actor_losses, entropies, alphas, alpha_losses, critic1_losses, critic2_losses
 
     def train_epoch(self):
-        random_exploration = self.epoch_num < self.num_warmup_steps
+        # a reopened replay buffer which already holds the warmup data skips the random exploration
+        warmup_frames = self.num_warmup_steps * self.num_frames_per_epoch
+        random_exploration = self.epoch_num < self.num_warmup_steps and len(self.replay_buffer) < warmup_frames
         return self.play_steps(random_exploration)
 
     def train(self):
@@ -512,6 +638,7 @@ class SACAgent(BaseAlgorithm):
         while True:
             self.epoch_num += 1
             step_time, play_time, update_time, epoch_total_time, actor_losses, entropies, alphas, alpha_losses, critic1_losses, critic2_losses = self.train_epoch()
+            self.algo_observer.after_steps()
 
             total_time += epoch_total_time
 
@@ -532,7 +659,7 @@ class SACAgent(BaseAlgorithm):
             self.writer.add_scalar('performance/step_inference_time', play_time, self.frame)
             self.writer.add_scalar('performance/step_time', step_time, self.frame)
 
-            if self.epoch_num >= self.num_warmup_steps:
+            if len(actor_losses) > 0:
                 self.writer.add_scalar('losses/a_loss', torch_ext.mean_list(actor_losses).item(), self.frame)
                 self.writer.add_scalar('losses/c1_loss', torch_ext.mean_list(critic1_losses).item(), self.frame)
                 self.writer.add_scalar('losses/c2_loss', torch_ext.mean_list(critic2_losses).item(), self.frame)
@@ -1,3 +1,4 @@
+import torch
 from torch import distributions as pyd
 import math
 import torch.nn.functional as F
@@ -52,3 +53,15 @@ class SquashedNormal(pyd.transformed_distribution.TransformedDistribution):
 
     def entropy(self):
         return self.base_dist.entropy()
+
+
+def ensemble_min(q_values, subset_size=None):
+    '''
+    minimum over the critic members of (num_members, B, 1) Q values, with subset_size over a random subset of
+    the members (REDQ)
+    '''
+    num_members = q_values.size(0)
+    if subset_size is not None and subset_size < num_members:
+        subset = torch.randperm(num_members, device=q_values.device)[:subset_size]
+        q_values = q_values[subset]
+    return q_values.min(dim=0)[0]
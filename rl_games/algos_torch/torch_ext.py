@@ -1,5 +1,6 @@
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
@@ -124,6 +125,22 @@ def random_sample(obs_batch, prob):
     indices = permutation[start:end]
     return torch.index_select(obs_batch, 0, indices)
 
+def random_shift(images, pad):
+    '''
+    random shift augmentation of a NCHW image batch: replicate padding by pad pixels and a random crop per image
+    '''
+    n, _, h, w = images.size()
+    images = F.pad(images, (pad, pad, pad, pad), 'replicate')
+    eps_h = 1.0 / (h + 2 * pad)
+    eps_w = 1.0 / (w + 2 * pad)
+    ys = torch.linspace(-1.0 + eps_h, 1.0 - eps_h, h + 2 * pad, device=images.device, dtype=images.dtype)[:h]
+    xs = torch.linspace(-1.0 + eps_w, 1.0 - eps_w, w + 2 * pad, device=images.device, dtype=images.dtype)[:w]
+    grid_y, grid_x = torch.meshgrid(ys, xs, indexing='ij')
+    base_grid = torch.stack([grid_x, grid_y], dim=-1).unsqueeze(0)
+    shift = torch.randint(0, 2 * pad + 1, size=(n, 1, 1, 2), device=images.device).to(images.dtype)
+    shift = shift * torch.tensor([2.0 / (w + 2 * pad), 2.0 / (h + 2 * pad)], device=images.device, dtype=images.dtype)
+    return F.grid_sample(images, base_grid + shift, padding_mode='zeros', align_corners=False)
+
 def mean_list(val):
     return torch.mean(torch.stack(val))
 
@@ -270,6 +287,67 @@ def get_model_gradients(model):
         grad_list.append(param.grad)
     return grad_list
 
+class FlatParameters:
+    '''
+    Moves parameters and their gradients into one contiguous buffer per (dtype, device).
+    Parameters keep their identity (optimizers and state dicts are unaffected), but their data and grads
+    become views into the flat buffers, so all-reduce, gradient clipping and polyak averaging run as single
+    ops over the buffers. Grads have to be zeroed with zero_grad(), setting them to None detaches them
+    from the buffer. Create it after the module was moved to its device.
+    with_grads: allocate the gradient buffer, not needed for target networks
+    '''
+    def __init__(self, parameters, with_grads=True):
+        self.params = [p for p in parameters if p.requires_grad]
+        groups = {}
+        for p in self.params:
+            groups.setdefault((p.dtype, p.device), []).append(p)
+
+        self.flat_params = []
+        self.flat_grads = []
+        for (dtype, device), params in groups.items():
+            numel = sum(p.numel() for p in params)
+            flat_param = torch.empty(numel, dtype=dtype, device=device)
+            flat_grad = torch.zeros(numel, dtype=dtype, device=device) if with_grads else None
+            offset = 0
+            for p in params:
+                n = p.numel()
+                flat_param[offset:offset + n].copy_(p.data.view(-1))
+                p.data = flat_param[offset:offset + n].view_as(p)
+                if with_grads:
+                    p.grad = flat_grad[offset:offset + n].view_as(p)
+                offset += n
+            self.flat_params.append(flat_param)
+            if with_grads:
+                self.flat_grads.append(flat_grad)
+
+    def zero_grad(self):
+        for grad in self.flat_grads:
+            grad.zero_()
+
+    def all_reduce(self, world_size):
+        for grad in self.flat_grads:
+            dist.all_reduce(grad, op=dist.ReduceOp.SUM)
+            grad /= world_size
+
+    def grad_norm(self):
+        norms = torch.stack([grad.float().norm(2) for grad in self.flat_grads])
+        return norms.norm(2)
+
+    def clip_grad_norm_(self, max_norm):
+        total_norm = self.grad_norm()
+        clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+        for grad in self.flat_grads:
+            grad.mul_(clip_coef.to(grad.dtype))
+        return total_norm
+
+    @torch.no_grad()
+    def lerp_(self, source, weight):
+        '''
+        moves the parameters towards the ones of source, a FlatParameters of a module with the same layout
+        '''
+        for target_param, source_param in zip(self.flat_params, source.flat_params):
+            target_param.lerp_(source_param, weight)
+
 def get_mean(v):
     if len(v) > 0:
         mean = np.mean(v)
@@ -330,7 +408,14 @@ class AverageMeter(nn.Module):
         size = values.size()[0]
         if size == 0:
             return
-        new_mean = torch.mean(values.float(), dim=0)
+        self.update_mean(torch.mean(values.float(), dim=0), size)
+
+    def update_mean(self, new_mean, size):
+        '''
+        adds size values with mean new_mean, e.g. reduced on device
+        '''
+        if size == 0:
+            return
         size = np.clip(size, 0, self.max_size)
         old_size = min(self.max_size - size, self.current_size)
         size_sum = old_size + size
@@ -6,9 +6,15 @@ from rl_games.common import vecenv
 from rl_games.algos_torch.moving_mean_std import MovingMeanStd
 from rl_games.algos_torch.self_play_manager import SelfPlayManager
 from rl_games.algos_torch import torch_ext
+from rl_games.distributed import utils as distributed_utils
+from rl_games.distributed.buckets import GradientBucketer
+from rl_games.distributed.compression import create_compressor
+from rl_games.distributed.local_sgd import ParameterAverager
+from rl_games.distributed.zero import ZeroRedundancyAdam
 from rl_games.common import schedulers
 from rl_games.common.experience import ExperienceBuffer
 from rl_games.common.interval_summary_writer import IntervalSummaryWriter
+from rl_games.common.metrics import create_metrics_writer
 from rl_games.common.diagnostics import DefaultDiagnostics, PpoDiagnostics
 from rl_games.algos_torch import  model_builder
 from rl_games.interfaces.base_algorithm import  BaseAlgorithm
@@ -17,7 +23,6 @@ import time
 import gym
 
 from datetime import datetime
-from tensorboardX import SummaryWriter
 import torch 
 from torch import nn
 import torch.distributed as dist
@@ -36,6 +41,23 @@ def swap_and_flatten01(arr):
     s = arr.size()
     return arr.transpose(0, 1).reshape(s[0] * s[1], *s[2:])
 
+
+def slice_obs(obs, env_slice):
+    """
+    view of the envs env_slice of a (possibly nested) observation dict
+    """
+    if isinstance(obs, dict):
+        return {k: slice_obs(v, env_slice) for k, v in obs.items()}
+    return obs[env_slice]
+
+
+def assign_obs(obs, env_slice, new_obs):
+    if isinstance(obs, dict):
+        for k, v in obs.items():
+            assign_obs(v, env_slice, new_obs[k])
+    else:
+        obs[env_slice] = new_obs
+
 def rescale_actions(low, high, action):
     d = (high - low) / 2.0
     m = (high + low) / 2.0
@@ -65,18 +87,22 @@ class A2CBase(BaseAlgorithm):
         self.algo_observer = config['features']['observer']
         self.algo_observer.before_init(base_name, config, self.experiment_name)
         self.load_networks(params)
-        self.multi_gpu = config.get('multi_gpu', False)
+        # multi process data parallel training, 'multi_gpu' is the legacy name of the cuda only mode.
+        # With 'distributed' num_actors and minibatch_size are global and split between the ranks.
+        self.distributed = config.get('distributed', False)
+        self.multi_gpu = self.distributed or config.get('multi_gpu', False)
         self.rank = 0
         self.rank_size = 1
         self.curr_frames = 0
 
         if self.multi_gpu:
-            self.rank = int(os.getenv("LOCAL_RANK", "0"))
-            self.rank_size = int(os.getenv("WORLD_SIZE", "1"))
-            dist.init_process_group("nccl", rank=self.rank, world_size=self.rank_size)
-
-            self.device_name = 'cuda:' + str(self.rank)
+            device = config.get('device', 'cuda:0') if self.distributed else 'cuda:0'
+            self.rank, self.rank_size, self.device_name = distributed_utils.init_distributed(device, config.get('num_threads', None))
             config['device'] = self.device_name
+            if self.distributed:
+                config['num_actors'] = distributed_utils.split_per_rank(config['num_actors'], self.rank_size, 'num_actors')
+                if 'minibatch_size' in config:
+                    config['minibatch_size'] = distributed_utils.split_per_rank(config['minibatch_size'], self.rank_size, 'minibatch_size')
             if self.rank != 0:
                 config['print_stats'] = False
                 config['lr_schedule'] = None
@@ -162,6 +188,17 @@ class A2CBase(BaseAlgorithm):
         self.normalize_input = self.config['normalize_input']
         self.normalize_value = self.config.get('normalize_value', False)
         self.truncate_grads = self.config.get('truncate_grads', False)
+        # keep parameters and grads in contiguous buffers, see torch_ext.FlatParameters
+        self.use_flat_params = self.config.get('flat_params', False)
+        self.flat_params = None
+        # with multiple processes gradients are all-reduced in buckets of this size (MB) during backward
+        self.grad_bucket_size_mb = self.config.get('grad_bucket_size_mb', None)
+        self.grad_bucketer = None
+        # compressed gradient all-reduce, see distributed/compression.py
+        self.grad_compressor = None
+        if self.multi_gpu and self.config.get('grad_compression', None) is not None:
+            assert self.grad_bucket_size_mb is None, 'grad_compression and grad_bucket_size_mb can not be combined'
+            self.grad_compressor = create_compressor(self.config['grad_compression'])
         self.has_phasic_policy_gradients = False
 
         if isinstance(self.observation_space, gym.spaces.Dict):
@@ -192,6 +229,34 @@ class A2CBase(BaseAlgorithm):
         assert(self.batch_size % self.minibatch_size == 0)
 
         self.mixed_precision = self.config.get('mixed_precision', False)
+        # shard the Adam state across ranks (ZeRO-1), see distributed/zero.py
+        self.zero_optimizer = self.config.get('zero_optimizer', False)
+        if self.zero_optimizer:
+            assert self.multi_gpu, 'zero_optimizer needs multi process training'
+            assert not self.mixed_precision, 'zero_optimizer does not support mixed_precision'
+            assert not self.use_flat_params and self.grad_bucket_size_mb is None and self.grad_compressor is None, \
+                'zero_optimizer reduces the gradients itself'
+        # with zero_optimizer checkpoints of rank 0 are written in broadcast_exit_and_saves, after all ranks
+        # gathered the sharded optimizer state
+        self.deferred_saves = []
+        # local SGD: no gradient all-reduce, parameters are averaged every local_sgd_period minibatches
+        # (0: once per epoch), see distributed/local_sgd.py
+        self.local_sgd_period = self.config.get('local_sgd_period', None)
+        self.local_sgd = self.local_sgd_period is not None
+        self.param_averager = None
+        self.cv_param_averager = None
+        if self.local_sgd:
+            assert self.multi_gpu, 'local_sgd_period needs multi process training'
+            assert not self.zero_optimizer and self.grad_bucket_size_mb is None and self.grad_compressor is None, \
+                'local_sgd_period can not be combined with zero_optimizer, grad_bucket_size_mb or grad_compression'
+        # step half of the envs while the policy runs on the other half, see play_steps_pingpong
+        self.pingpong = self.config.get('pingpong', False)
+        if self.pingpong:
+            assert self.num_actors % 2 == 0, 'pingpong needs an even number of actors'
+            assert not self.has_central_value and not self.use_action_masks, \
+                'pingpong does not support central value and action masks'
+            assert self.vec_env is not None and getattr(self.vec_env, 'supports_step_async', lambda: False)(), \
+                'pingpong needs a vec env with step_async and step_wait (ray)'
         self.scaler = torch.cuda.amp.GradScaler(enabled=self.mixed_precision)
 
         self.last_lr = self.config['learning_rate']
@@ -219,8 +284,8 @@ class A2CBase(BaseAlgorithm):
         self.entropy_coef = self.config['entropy_coef']
 
         if self.rank == 0:
-            writer = SummaryWriter(self.summaries_dir)
-            if self.population_based_training:
+            writer = create_metrics_writer(self.summaries_dir, self.config)
+            if self.population_based_training or self.config.get('interval_summaries', False):
                 self.writer = IntervalSummaryWriter(writer, self.config)
             else:
                 self.writer = writer
@@ -257,8 +322,99 @@ class A2CBase(BaseAlgorithm):
         # soft augmentation not yet supported
         assert not self.has_soft_aug
 
+    def init_distributed_models(self):
+        '''
+        starts all ranks from the parameters and normalizer statistics of rank 0 and keeps the normalizers in sync
+        '''
+        models = [self.model]
+        if self.has_central_value:
+            models.append(self.central_value_net)
+        for model in models:
+            distributed_utils.broadcast_module(model, 0)
+            # with local SGD normalizers are averaged together with the parameters
+            distributed_utils.sync_normalizers(model, enabled=not self.local_sgd)
+
+    def init_param_averager(self):
+        if self.local_sgd:
+            self.param_averager = ParameterAverager(self.model, self.optimizer, self.rank_size, self.local_sgd_period)
+            if self.has_central_value:
+                # the central value is trained in one go per epoch and averaged afterwards
+                self.cv_param_averager = ParameterAverager(self.central_value_net.model, self.central_value_net.optimizer, self.rank_size)
+
+    def sync_local_models(self):
+        '''
+        averages the models and combines the normalizer statistics of all ranks at the end of the epoch
+        '''
+        if self.multi_gpu and not self.local_sgd:
+            models = [self.model]
+            if self.has_central_value:
+                models.append(self.central_value_net)
+            distributed_utils.sync_normalizer_stats(models)
+        if self.param_averager is not None:
+            self.param_averager.sync()
+            self.last_lr = self.optimizer.param_groups[0]['lr']
+        if self.cv_param_averager is not None:
+            self.cv_param_averager.sync()
+
+    def broadcast_exit_and_saves(self, should_exit):
+        '''
+        broadcasts the exit decision of rank 0 and writes the checkpoints deferred by save(), has to be called on all ranks
+        '''
+        flags = torch.tensor([should_exit, len(self.deferred_saves) > 0], device=self.device).float()
+        dist.broadcast(flags, 0)
+        should_exit, has_saves = flags.bool().tolist()
+        if has_saves:
+            self.optimizer.consolidate_state_dict(0)
+            for fn in self.deferred_saves:
+                torch_ext.save_checkpoint(fn, self.get_full_state_weights())
+            self.deferred_saves = []
+        return should_exit
+
+    def create_optimizer(self, parameters, lr):
+        if self.zero_optimizer:
+            max_grad_norm = self.grad_norm if self.truncate_grads else None
+            return ZeroRedundancyAdam(parameters, lr, eps=1e-08, weight_decay=self.weight_decay, max_grad_norm=max_grad_norm)
+        return torch.optim.Adam(parameters, lr, eps=1e-08, weight_decay=self.weight_decay)
+
+    def init_flat_params(self):
+        if self.use_flat_params:
+            self.flat_params = torch_ext.FlatParameters(self.model.parameters())
+
+    def init_grad_bucketer(self):
+        if self.multi_gpu and self.grad_bucket_size_mb is not None:
+            self.grad_bucketer = GradientBucketer(self.model.parameters(), self.rank_size, self.grad_bucket_size_mb)
+
+    def zero_grads(self):
+        if self.flat_params is not None:
+            self.flat_params.zero_grad()
+        elif self.multi_gpu:
+            self.optimizer.zero_grad()
+        else:
+            for param in self.model.parameters():
+                param.grad = None
+
     def trancate_gradients_and_step(self):
-        if self.multi_gpu:
+        if self.zero_optimizer:
+            # the sharded optimizer reduces and clips the gradients
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            return
+
+        if self.local_sgd:
+            # ranks step on their local gradients
+            pass
+        elif self.multi_gpu and self.grad_compressor is not None:
+            # parameters unused on this rank still take part, so the collectives match on all ranks
+            params = [param for param in self.model.parameters() if param.requires_grad]
+            for param in params:
+                if param.grad is None:
+                    param.grad = torch.zeros_like(param)
+            self.grad_compressor.all_reduce([param.grad for param in params], self.rank_size)
+        elif self.multi_gpu and self.grad_bucketer is not None:
+            self.grad_bucketer.wait()
+        elif self.multi_gpu and self.flat_params is not None:
+            self.flat_params.all_reduce(self.rank_size)
+        elif self.multi_gpu:
             # batch allreduce ops: see https://github.com/entity-neural-network/incubator/pull/220
             all_grads_list = []
             for param in self.model.parameters():
@@ -276,10 +432,15 @@ class A2CBase(BaseAlgorithm):
 
         if self.truncate_grads:
             self.scaler.unscale_(self.optimizer)
-            nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_norm)
+            if self.flat_params is not None:
+                self.flat_params.clip_grad_norm_(self.grad_norm)
+            else:
+                nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_norm)
 
         self.scaler.step(self.optimizer)
         self.scaler.update()
+        if self.param_averager is not None:
+            self.param_averager.step()
 
     def load_networks(self, params):
         builder = model_builder.ModelBuilder()
@@ -295,20 +456,33 @@ class A2CBase(BaseAlgorithm):
     def write_stats(self, total_time, epoch_num, step_time, play_time, update_time, a_losses, c_losses, entropies, kls, last_lr, lr_mul, frame, scaled_time, scaled_play_time, curr_frames):
         # do we need scaled time?
         self.diagnostics.send_info(self.writer)
+        if self.grad_compressor is not None:
+            compression_stats = self.grad_compressor.get_stats()
+            if compression_stats is not None:
+                self.writer.add_scalar('distributed/compression_ratio', compression_stats[0], frame)
+                self.writer.add_scalar('distributed/compression_error', compression_stats[1], frame)
+        if self.param_averager is not None:
+            averager_stats = self.param_averager.get_stats()
+            if averager_stats is not None:
+                self.writer.add_scalar('distributed/param_drift', averager_stats[0], frame)
+                self.writer.add_scalar('distributed/param_syncs', averager_stats[1], frame)
+        if hasattr(self.vec_env, 'get_env_stats'):
+            for k, v in self.vec_env.get_env_stats().items():
+                self.writer.add_scalar('env/' + k, v, frame)
         self.writer.add_scalar('performance/step_inference_rl_update_fps', curr_frames / scaled_time, frame)
         self.writer.add_scalar('performance/step_inference_fps', curr_frames / scaled_play_time, frame)
         self.writer.add_scalar('performance/step_fps', curr_frames / step_time, frame)
         self.writer.add_scalar('performance/rl_update_time', update_time, frame)
         self.writer.add_scalar('performance/step_inference_time', play_time, frame)
         self.writer.add_scalar('performance/step_time', step_time, frame)
-        self.writer.add_scalar('losses/a_loss', torch_ext.mean_list(a_losses).item(), frame)
-        self.writer.add_scalar('losses/c_loss', torch_ext.mean_list(c_losses).item(), frame)
+        self.writer.add_scalar('losses/a_loss', torch_ext.mean_list(a_losses), frame)
+        self.writer.add_scalar('losses/c_loss', torch_ext.mean_list(c_losses), frame)
                 
-        self.writer.add_scalar('losses/entropy', torch_ext.mean_list(entropies).item(), frame)
+        self.writer.add_scalar('losses/entropy', torch_ext.mean_list(entropies), frame)
         self.writer.add_scalar('info/last_lr', last_lr * lr_mul, frame)
         self.writer.add_scalar('info/lr_mul', lr_mul, frame)
         self.writer.add_scalar('info/e_clip', self.e_clip * lr_mul, frame)
-        self.writer.add_scalar('info/kl', torch_ext.mean_list(kls).item(), frame)
+        self.writer.add_scalar('info/kl', torch_ext.mean_list(kls), frame)
         self.writer.add_scalar('info/epochs', epoch_num, frame)
         self.algo_observer.after_print_stats(frame, epoch_num, total_time)
 
@@ -323,10 +497,13 @@ class A2CBase(BaseAlgorithm):
             self.advantage_mean_std.train()
 
     def update_lr(self, lr):
-        if self.multi_gpu:
+        if self.multi_gpu and not self.local_sgd:
             lr_tensor = torch.tensor([lr], device=self.device)
             dist.broadcast(lr_tensor, 0)
             lr = lr_tensor.item()
+        elif self.local_sgd and self.rank != 0:
+            # with local SGD the parameter averager sets the learning rate of rank 0 on all ranks
+            lr = self.optimizer.param_groups[0]['lr']
 
         for param_group in self.optimizer.param_groups:
             param_group['lr'] = lr
@@ -404,6 +581,7 @@ class A2CBase(BaseAlgorithm):
         self.current_lengths = torch.zeros(batch_size, dtype=torch.float32, device=self.ppo_device)
         self.dones = torch.ones((batch_size,), dtype=torch.uint8, device=self.ppo_device)
 
+        assert not (self.pingpong and self.is_rnn), 'pingpong does not support rnn models'
         if self.is_rnn:
             self.rnn_states = self.model.get_default_rnn_state()
             self.rnn_states = [s.to(self.ppo_device) for s in self.rnn_states]
@@ -456,7 +634,17 @@ class A2CBase(BaseAlgorithm):
     def env_step(self, actions):
         actions = self.preprocess_actions(actions)
         obs, rewards, dones, infos = self.vec_env.step(actions)
+        return self._env_results_to_tensors(obs, rewards, dones, infos)
+
+    def env_step_async(self, actions, env_slice):
+        actions = self.preprocess_actions(actions)
+        self.vec_env.step_async(actions, env_slice)
+
+    def env_step_wait(self, env_slice):
+        obs, rewards, dones, infos = self.vec_env.step_wait(env_slice)
+        return self._env_results_to_tensors(obs, rewards, dones, infos)
 
+    def _env_results_to_tensors(self, obs, rewards, dones, infos):
         if self.is_tensor_obses:
             if self.value_size == 1:
                 rewards = rewards.unsqueeze(1)
@@ -674,6 +862,75 @@ class A2CBase(BaseAlgorithm):
 
         return batch_dict
 
+    def _pingpong_act(self, n, env_slice, agent_slice):
+        obs = slice_obs(self.obs, agent_slice)
+        res_dict = self.get_action_values(obs)
+        self.experience_buffer.update_data_slice('obses', n, agent_slice, obs['obs'])
+        self.experience_buffer.update_data_slice('dones', n, agent_slice, self.dones[agent_slice])
+        for k in self.update_list:
+            self.experience_buffer.update_data_slice(k, n, agent_slice, res_dict[k])
+        self.env_step_async(res_dict['actions'], env_slice)
+        return res_dict
+
+    def play_steps_pingpong(self):
+        '''
+        play_steps with the envs split into two groups: while one group is stepped asynchronously by the vec env,
+        the policy runs on the other one. Both groups write into the same experience buffer columns.
+        '''
+        half = self.num_actors // 2
+        env_slices = [slice(0, half), slice(half, self.num_actors)]
+        agent_slices = [slice(s.start * self.num_agents, s.stop * self.num_agents) for s in env_slices]
+        step_time = 0.0
+
+        res_dicts = [self._pingpong_act(0, env_slice, agent_slice) for env_slice, agent_slice in zip(env_slices, agent_slices)]
+        for n in range(self.horizon_length):
+            for g, (env_slice, agent_slice) in enumerate(zip(env_slices, agent_slices)):
+                step_time_start = time.time()
+                obs, rewards, dones, infos = self.env_step_wait(env_slice)
+                step_time_end = time.time()
+
+                step_time += (step_time_end - step_time_start)
+                assign_obs(self.obs, agent_slice, obs)
+                self.dones[agent_slice] = dones
+
+                shaped_rewards = self.rewards_shaper(rewards)
+                if self.value_bootstrap and 'time_outs' in infos:
+                    shaped_rewards += self.gamma * res_dicts[g]['values'] * self.cast_obs(infos['time_outs']).unsqueeze(1).float()
+
+                self.experience_buffer.update_data_slice('rewards', n, agent_slice, shaped_rewards)
+
+                current_rewards = self.current_rewards[agent_slice] + rewards
+                current_lengths = self.current_lengths[agent_slice] + 1
+                env_done_indices = dones.view(-1, self.num_agents).all(dim=1).nonzero(as_tuple=False)
+
+                self.game_rewards.update(current_rewards[env_done_indices])
+                self.game_lengths.update(current_lengths[env_done_indices])
+                self.algo_observer.process_infos(infos, env_done_indices)
+
+                not_dones = 1.0 - dones.float()
+
+                self.current_rewards[agent_slice] = current_rewards * not_dones.unsqueeze(1)
+                self.current_lengths[agent_slice] = current_lengths * not_dones
+
+                if n + 1 < self.horizon_length:
+                    res_dicts[g] = self._pingpong_act(n + 1, env_slice, agent_slice)
+
+        last_values = self.get_values(self.obs)
+
+        fdones = self.dones.float()
+        mb_fdones = self.experience_buffer.tensor_dict['dones'].float()
+        mb_values = self.experience_buffer.tensor_dict['values']
+        mb_rewards = self.experience_buffer.tensor_dict['rewards']
+        mb_advs = self.discount_values(fdones, last_values, mb_fdones, mb_values, mb_rewards)
+        mb_returns = mb_advs + mb_values
+
+        batch_dict = self.experience_buffer.get_transformed_list(swap_and_flatten01, self.tensor_list)
+        batch_dict['returns'] = swap_and_flatten01(mb_returns)
+        batch_dict['played_frames'] = self.batch_size
+        batch_dict['step_time'] = step_time
+
+        return batch_dict
+
     def play_steps_rnn(self):
         update_list = self.update_list
         mb_rnn_states = self.mb_rnn_states
@@ -786,6 +1043,8 @@ class DiscreteA2CBase(A2CBase):
         with torch.no_grad():
             if self.is_rnn:
                 batch_dict = self.play_steps_rnn()
+            elif self.pingpong:
+                batch_dict = self.play_steps_pingpong()
             else:
                 batch_dict = self.play_steps()
 
@@ -843,7 +1102,8 @@ class DiscreteA2CBase(A2CBase):
         neglogpacs = batch_dict['neglogpacs']
         dones = batch_dict['dones']
         rnn_states = batch_dict.get('rnn_states', None)
-        advantages = returns - values
+        # off-policy corrected advantages (e.g. V-trace) can be passed in directly
+        advantages = batch_dict['advantages'] if 'advantages' in batch_dict else returns - values
 
         obses = batch_dict['obses']
         if self.normalize_value:
@@ -903,11 +1163,8 @@ class DiscreteA2CBase(A2CBase):
         self.obs = self.env_reset()
 
         if self.multi_gpu:
-            torch.cuda.set_device(self.rank)
             print("====================broadcasting parameters")
-            model_params = [self.model.state_dict()]
-            dist.broadcast_object_list(model_params, 0)
-            self.model.load_state_dict(model_params[0])
+            self.init_distributed_models()
 
         while True:
             epoch_num = self.update_epoch()
@@ -915,6 +1172,7 @@ class DiscreteA2CBase(A2CBase):
 
             # cleaning memory to optimize space
             self.dataset.update_values_dict(None)
+            self.sync_local_models()
             total_time += sum_time
             curr_frames = self.curr_frames * self.rank_size if self.multi_gpu else self.curr_frames
             self.frame += curr_frames
@@ -985,11 +1243,10 @@ class DiscreteA2CBase(A2CBase):
                     print('MAX EPOCHS NUM!')
                     should_exit = True
                 update_time = 0
+                self.writer.flush()
 
             if self.multi_gpu:
-                should_exit_t = torch.tensor(should_exit, device=self.device).float()
-                dist.broadcast(should_exit_t, 0)
-                should_exit = should_exit_t.bool().item()
+                should_exit = self.broadcast_exit_and_saves(should_exit)
             if should_exit:
                 return self.last_mean_rewards, epoch_num
 
@@ -1033,6 +1290,8 @@ class ContinuousA2CBase(A2CBase):
         with torch.no_grad():
             if self.is_rnn:
                 batch_dict = self.play_steps_rnn()
+            elif self.pingpong:
+                batch_dict = self.play_steps_pingpong()
             else:
                 batch_dict = self.play_steps()
 
@@ -1067,7 +1326,7 @@ class ContinuousA2CBase(A2CBase):
                 self.dataset.update_mu_sigma(cmu, csigma)
                 if self.schedule_type == 'legacy':
                     av_kls = kl
-                    if self.multi_gpu:
+                    if self.multi_gpu and not self.local_sgd:
                         dist.all_reduce(kl, op=dist.ReduceOp.SUM)
                         av_kls /= self.rank_size
                     self.last_lr, self.entropy_coef = self.scheduler.update(self.last_lr, self.entropy_coef, self.epoch_num, 0, av_kls.item())
@@ -1105,7 +1364,8 @@ class ContinuousA2CBase(A2CBase):
         rnn_states = batch_dict.get('rnn_states', None)
         rnn_masks = batch_dict.get('rnn_masks', None)
 
-        advantages = returns - values
+        # off-policy corrected advantages (e.g. V-trace) can be passed in directly
+        advantages = batch_dict['advantages'] if 'advantages' in batch_dict else returns - values
 
         if self.normalize_value:
             self.value_mean_std.train()
@@ -1164,9 +1424,7 @@ class ContinuousA2CBase(A2CBase):
 
         if self.multi_gpu:
             print("====================broadcasting parameters")
-            model_params = [self.model.state_dict()]
-            dist.broadcast_object_list(model_params, 0)
-            self.model.load_state_dict(model_params[0])
+            self.init_distributed_models()
 
         while True:
             epoch_num = self.update_epoch()
@@ -1176,6 +1434,7 @@ class ContinuousA2CBase(A2CBase):
 
             # cleaning memory to optimize space
             self.dataset.update_values_dict(None)
+            self.sync_local_models()
             should_exit = False
 
             if self.rank == 0:
@@ -1195,7 +1454,7 @@ class ContinuousA2CBase(A2CBase):
 
                 self.write_stats(total_time, epoch_num, step_time, play_time, update_time, a_losses, c_losses, entropies, kls, last_lr, lr_mul, frame, scaled_time, scaled_play_time, curr_frames)
                 if len(b_losses) > 0:
-                    self.writer.add_scalar('losses/bounds_loss', torch_ext.mean_list(b_losses).item(), frame)
+                    self.writer.add_scalar('losses/bounds_loss', torch_ext.mean_list(b_losses), frame)
 
                 if self.has_soft_aug:
                     self.writer.add_scalar('losses/aug_loss', np.mean(aug_losses), frame)
@@ -1244,11 +1503,10 @@ class ContinuousA2CBase(A2CBase):
                     should_exit = True
 
                 update_time = 0
+                self.writer.flush()
 
             if self.multi_gpu:
-                should_exit_t = torch.tensor(should_exit, device=self.device).float()
-                dist.broadcast(should_exit_t, 0)
-                should_exit = should_exit_t.float().item()
+                should_exit = self.broadcast_exit_and_saves(should_exit)
             if should_exit:
                 return self.last_mean_rewards, epoch_num
 
@@ -1,4 +1,5 @@
 from rl_games.algos_torch import torch_ext
+from rl_games.common import tr_helpers
 import torch
 import numpy as np
 
@@ -30,46 +31,53 @@ class DefaultAlgoObserver(AlgoObserver):
     def after_init(self, algo):
         self.algo = algo
         self.game_scores = torch_ext.AverageMeter(1, self.algo.games_to_track).to(self.algo.ppo_device)  
+        self.score_sum = torch.zeros((), device=self.algo.ppo_device)
+        self.score_count = torch.zeros((), device=self.algo.ppo_device)
         self.writer = self.algo.writer
 
     def process_infos(self, infos, done_indices):
         if not infos:
             return
+        if not isinstance(infos, dict):
+            # per env info dicts of vec envs without columnar infos
+            if not isinstance(infos[0], dict):
+                return
+            dones = np.zeros(len(infos), dtype=bool)
+            dones[done_indices.cpu().numpy().reshape(-1)] = True
+            infos = tr_helpers.infos_to_columns(infos, dones)
+
+        if 'scores' in infos:
+            game_res = infos['scores']
+        elif 'battle_won' in infos:
+            game_res = infos['battle_won']
+        else:
+            return
 
-        done_indices = done_indices.cpu().numpy()
-
-        if not isinstance(infos, dict) and len(infos) > 0 and isinstance(infos[0], dict):
-            for ind in done_indices:
-                ind = ind.item()
-                if len(infos) <= ind//self.algo.num_agents:
-                    continue
-                info = infos[ind//self.algo.num_agents]
-                game_res = None
-                if 'battle_won' in info:
-                    game_res = info['battle_won']
-                if 'scores' in info:
-                    game_res = info['scores']
-
-                if game_res is not None:
-                    self.game_scores.update(torch.from_numpy(np.asarray([game_res])).to(self.algo.ppo_device))
-
-        elif isinstance(infos, dict):
-            if 'lives' in infos:
-                # envpool
-                done_indices = np.argwhere(infos['lives'] == 0).squeeze(1)
-
-            for ind in done_indices:
-                ind = ind.item()
-                game_res = None
-                if 'battle_won' in infos:
-                    game_res = infos['battle_won']
-                if 'scores' in infos:
-                    game_res = infos['scores']
-                if game_res is not None and len(game_res) > ind//self.algo.num_agents:
-                    self.game_scores.update(torch.from_numpy(np.asarray([game_res[ind//self.algo.num_agents]])).to(self.algo.ppo_device))
+        device = self.algo.ppo_device
+        game_res = torch.as_tensor(game_res, device=device).float().reshape(-1)
+        if 'done_mask' in infos:
+            done_mask = torch.as_tensor(infos['done_mask'], device=device).bool().reshape(-1)
+        else:
+            done_mask = torch.zeros(game_res.size(0), dtype=torch.bool, device=device)
+            done_mask[done_indices.reshape(-1)] = True
+        if done_mask.size(0) != game_res.size(0):
+            return
+        # accumulated on device, reduced once per epoch in after_steps
+        done_mask = done_mask.float()
+        self.score_sum += (game_res * done_mask).sum()
+        self.score_count += done_mask.sum()
+
+    def after_steps(self):
+        count = int(self.score_count.item())
+        if count > 0:
+            self.game_scores.update_mean(self.score_sum / count, count)
+        self.score_sum.zero_()
+        self.score_count.zero_()
 
     def after_clear_stats(self):
         self.game_scores.clear()
+        self.score_sum.zero_()
+        self.score_count.zero_()
 
     def after_print_stats(self, frame, epoch_num, total_time):
         if self.game_scores.current_size > 0 and self.writer is not None:
@@ -88,7 +96,7 @@ class IsaacAlgoObserver(AlgoObserver):
     def after_init(self, algo):
         self.algo = algo
         self.mean_scores = torch_ext.AverageMeter(1, self.algo.games_to_track).to(self.algo.ppo_device)
-        self.ep_infos = []
+        self.ep_infos = {}
         self.direct_info = {}
         self.writer = self.algo.writer
 
@@ -96,9 +104,11 @@ class IsaacAlgoObserver(AlgoObserver):
         if not isinstance(infos, dict):
             classname = self.__class__.__name__
             raise ValueError(f"{classname} expected 'infos' as dict. Received: {type(infos)}")
-        # store episode information
+        # store episode information as flat device tensors per key, concatenated once per epoch
         if "episode" in infos:
-            self.ep_infos.append(infos["episode"])
+            for key, value in infos["episode"].items():
+                value = torch.as_tensor(value, device=self.algo.device).float().reshape(-1)
+                self.ep_infos.setdefault(key, []).append(value)
         # log other variables directly
         if len(infos) > 0 and isinstance(infos, dict):  # allow direct logging from env
             self.direct_info = {}
@@ -113,19 +123,10 @@ class IsaacAlgoObserver(AlgoObserver):
 
     def after_print_stats(self, frame, epoch_num, total_time):
         # log scalars from the episode
-        if self.ep_infos:
-            for key in self.ep_infos[0]:
-                info_tensor = torch.tensor([], device=self.algo.device)
-                for ep_info in self.ep_infos:
-                    # handle scalar and zero dimensional tensor infos
-                    if not isinstance(ep_info[key], torch.Tensor):
-                        ep_info[key] = torch.Tensor([ep_info[key]])
-                    if len(ep_info[key].shape) == 0:
-                        ep_info[key] = ep_info[key].unsqueeze(0)
-                    info_tensor = torch.cat((info_tensor, ep_info[key].to(self.algo.device)))
-                value = torch.mean(info_tensor)
-                self.writer.add_scalar("Episode/" + key, value, epoch_num)
-            self.ep_infos.clear()
+        for key, values in self.ep_infos.items():
+            value = torch.cat(values).mean()
+            self.writer.add_scalar("Episode/" + key, value, epoch_num)
+        self.ep_infos.clear()
         # log scalars from env information
         for k, v in self.direct_info.items():
             self.writer.add_scalar(f"{k}/frame", v, frame)
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 
 class CategoricalQ:
@@ -48,4 +49,34 @@ class CategoricalQ:
             if ne_dones.any():
                 proj_distr[ne_dones, l[ne_mask]] = (u - b_j)[ne_mask]
                 proj_distr[ne_dones, u[ne_mask]] = (b_j - l)[ne_mask]
-        return proj_distr
\ No newline at end of file
+        return proj_distr
+
+    def distr_projection_torch(self, next_distr, rewards, dones, gamma):
+        """
+        Same projection as distr_projection, computed for the whole (batch, atoms) grid at once
+        on the device of next_distr. Inputs can be torch tensors or numpy arrays, returns a torch tensor.
+        """
+        next_distr = torch.as_tensor(next_distr, dtype=torch.float32)
+        device = next_distr.device
+        rewards = torch.as_tensor(rewards, dtype=torch.float32, device=device).reshape(-1, 1)
+        dones = torch.as_tensor(dones, dtype=torch.bool, device=device).reshape(-1, 1)
+        n_atoms = self.n_atoms
+
+        support = self.v_min + torch.arange(n_atoms, dtype=torch.float32, device=device) * self.delta_z
+        # done rows project only the reward: all mass moves to atom 0 whose target is the reward itself
+        z = rewards + support * gamma * (~dones)
+        done_distr = torch.zeros_like(next_distr)
+        done_distr[:, 0] = 1.0
+        probs = torch.where(dones, done_distr, next_distr)
+
+        b_j = (z.clamp(self.v_min, self.v_max) - self.v_min) / self.delta_z
+        l = b_j.floor().long()
+        u = b_j.ceil().long()
+        # when b_j hits an atom exactly u == l and the whole probability goes to l
+        l_weight = (u - b_j) + (u == l).float()
+        u_weight = b_j - l
+
+        proj_distr = torch.zeros_like(next_distr)
+        proj_distr.scatter_add_(1, l, probs * l_weight)
+        proj_distr.scatter_add_(1, u, probs * u_weight)
+        return proj_distr
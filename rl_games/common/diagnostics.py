@@ -25,7 +25,7 @@ class PpoDiagnostics(DefaultDiagnostics):
         if writter is None:
             return
         for k,v in self.diag_dict.items():
-            writter.add_scalar(k, v.cpu().numpy(), self.current_epoch)
+            writter.add_scalar(k, v, self.current_epoch)
     
     def epoch(self, agent, current_epoch):
         self.current_epoch = current_epoch
@@ -1,5 +1,8 @@
+import os
+import json
+import queue
+import threading
 import numpy as np
-import random
 import gym
 import torch
 from rl_games.common.segment_tree import SumSegmentTree, MinSegmentTree
@@ -7,24 +10,64 @@ import torch
 
 from rl_games.algos_torch.torch_ext import numpy_to_torch_dtype_dict
 
+def create_obs_storage(obs_space, base_shape, device):
+    """Allocates replay storage for observations.
+    obs_space is a shape tuple (float32 storage) or a gym space. gym.spaces.Dict gets a dict
+    of per-key tensors and uint8 spaces keep uint8 storage.
+    """
+    if isinstance(obs_space, gym.spaces.Dict):
+        return {k: create_obs_storage(v, base_shape, device) for k, v in obs_space.spaces.items()}
+    if isinstance(obs_space, gym.spaces.Space):
+        dtype = torch.uint8 if obs_space.dtype == np.uint8 else torch.float32
+        return torch.empty((*base_shape, *obs_space.shape), dtype=dtype, device=device)
+    return torch.empty((*base_shape, *obs_space), dtype=torch.float32, device=device)
+
+
+def obs_map(obs, func):
+    if isinstance(obs, dict):
+        return {k: obs_map(v, func) for k, v in obs.items()}
+    return func(obs)
+
+
+def obs_get(obs, idx):
+    return obs_map(obs, lambda v: v[idx])
+
+
+def obs_set(storage, idx, value):
+    if isinstance(storage, dict):
+        for k, v in storage.items():
+            obs_set(v, idx, value[k])
+    else:
+        storage[idx] = value
+
+
 class ReplayBuffer(object):
-    def __init__(self, size, ob_space):
+    def __init__(self, size, ob_space, n_step=1, gamma=0.99):
         """Create Replay buffer.
         Parameters
         ----------
         size: int
             Max number of transitions to store in the buffer. When the buffer
             overflows the old memories are dropped.
+        n_step: int
+            Number of transitions summed into the sampled return. With n_step > 1 samples also contain
+            the discount of the bootstrap value.
+        gamma: float
+            Discount factor of the n-step return.
         """
+        assert n_step >= 1
         self._obses = np.zeros((size,) + ob_space.shape, dtype=ob_space.dtype)
         self._next_obses = np.zeros((size,) + ob_space.shape, dtype=ob_space.dtype)
         self._rewards = np.zeros(size)
         self._actions = np.zeros(size, dtype=np.int32)
-        self._dones = np.zeros(size, dtype=np.bool)
+        self._dones = np.zeros(size, dtype=bool)
 
         self._maxsize = size
         self._next_idx = 0
         self._curr_size = 0
+        self._n_step = n_step
+        self._gamma = gamma
+        self._step_discounts = gamma ** np.arange(n_step)
 
     def __len__(self):
         return self._curr_size
@@ -45,19 +88,30 @@ class ReplayBuffer(object):
         return self._obses[idx], self._actions[idx], self._rewards[idx], self._next_obses[idx], self._dones[idx]
 
     def _encode_sample(self, idxes):
-        batch_size = len(idxes)
-        obses_t, actions, rewards, obses_tp1, dones = [None] * batch_size, [None] * batch_size, [None] * batch_size, [None] * batch_size, [None] * batch_size
-        it = 0
-        for i in idxes:
-            data = self._get(i)
-            obs_t, action, reward, obs_tp1, done = data
-            obses_t[it] = np.array(obs_t, copy=False)
-            actions[it] = np.array(action, copy=False)
-            rewards[it] = reward
-            obses_tp1[it] = np.array(obs_tp1, copy=False)
-            dones[it] = done
-            it = it + 1
-        return np.array(obses_t), np.array(actions), np.array(rewards), np.array(obses_tp1), np.array(dones)
+        idxes = np.asarray(idxes, dtype=np.int64)
+        if self._n_step > 1:
+            return self._encode_n_step_sample(idxes)
+        return self._get(idxes)
+
+    def _encode_n_step_sample(self, idxes):
+        """Gathers n-step returns for a batch of start indices with one window gather.
+        A window stops at the first done and at the newest stored transition, so it never
+        crosses an episode boundary or the write head of the ring.
+        """
+        offsets = np.arange(self._n_step)
+        window = (idxes[:, None] + offsets) % self._maxsize
+        # number of transitions stored after each start index
+        available = (self._next_idx - 1 - idxes) % self._maxsize
+        dones = self._dones[window]
+        done_before = (np.cumsum(dones, axis=1) - dones) > 0
+        include = (offsets <= available[:, None]) & ~done_before
+
+        rewards = (self._rewards[window] * self._step_discounts * include).sum(axis=1)
+        num_steps = include.sum(axis=1)
+        last = window[np.arange(len(idxes)), num_steps - 1]
+        done = (dones & include).any(axis=1)
+        discounts = self._gamma ** num_steps
+        return self._obses[idxes], self._actions[idxes], rewards, self._next_obses[last], done, discounts
 
     def sample(self, batch_size):
         """Sample a batch of experiences.
@@ -78,13 +132,16 @@ class ReplayBuffer(object):
         done_mask: np.array
             done_mask[i] = 1 if executing act_batch[i] resulted in
             the end of an episode and 0 otherwise.
+        discounts: np.array
+            only with n_step > 1, gamma ** (number of summed steps), the discount of the value of next_obs_batch.
+            rew_batch and next_obs_batch are the n-step return and the observation it bootstraps from.
         """
-        idxes = [random.randint(0, self._curr_size - 1) for _ in range(batch_size)]
+        idxes = np.random.randint(0, self._curr_size, size=batch_size)
         return self._encode_sample(idxes)
 
 
 class PrioritizedReplayBuffer(ReplayBuffer):
-    def __init__(self, size, alpha, ob_space):
+    def __init__(self, size, alpha, ob_space, n_step=1, gamma=0.99):
         """Create Prioritized Replay buffer.
         Parameters
         ----------
@@ -98,7 +155,7 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         --------
         ReplayBuffer.__init__
         """
-        super(PrioritizedReplayBuffer, self).__init__(size, ob_space)
+        super(PrioritizedReplayBuffer, self).__init__(size, ob_space, n_step, gamma)
         assert alpha >= 0
         self._alpha = alpha
 
@@ -118,14 +175,13 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         self._it_min[idx] = self._max_priority ** self._alpha
 
     def _sample_proportional(self, batch_size):
-        res = []
-        p_total = self._it_sum.sum(0, self._curr_size - 1)
+        p_total = self._it_sum.sum(0, self._curr_size)
         every_range_len = p_total / batch_size
-        for i in range(batch_size):
-            mass = random.random() * every_range_len + i * every_range_len
-            idx = self._it_sum.find_prefixsum_idx(mass)
-            res.append(idx)
-        return res
+        # one mass per stratum, all of them are searched in a single batched descent
+        mass = (np.random.random(batch_size) + np.arange(batch_size)) * every_range_len
+        idxes = self._it_sum.find_prefixsum_idx(mass)
+        # guards against float round off pushing a search past the filled part of the tree
+        return np.minimum(idxes, self._curr_size - 1)
 
     def sample(self, batch_size, beta):
         """Sample a batch of experiences.
@@ -152,26 +208,25 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         done_mask: np.array
             done_mask[i] = 1 if executing act_batch[i] resulted in
             the end of an episode and 0 otherwise.
+        discounts: np.array
+            only with n_step > 1, see ReplayBuffer.sample
         weights: np.array
             Array of shape (batch_size,) and dtype np.float32
             denoting importance weight of each sampled transition
         idxes: np.array
-            Array of shape (batch_size,) and dtype np.int32
+            Array of shape (batch_size,) and dtype np.int64
             idexes in buffer of sampled experiences
         """
         assert beta > 0
 
         idxes = self._sample_proportional(batch_size)
 
-        weights = []
-        p_min = self._it_min.min() / self._it_sum.sum()
+        p_total = self._it_sum.sum()
+        p_min = self._it_min.min() / p_total
         max_weight = (p_min * self._curr_size) ** (-beta)
 
-        for idx in idxes:
-            p_sample = self._it_sum[idx] / self._it_sum.sum()
-            weight = (p_sample * self._curr_size) ** (-beta)
-            weights.append(weight / max_weight)
-        weights = np.array(weights)
+        p_sample = self._it_sum[idxes] / p_total
+        weights = (p_sample * self._curr_size) ** (-beta) / max_weight
         encoded_sample = self._encode_sample(idxes)
         return tuple(list(encoded_sample) + [weights, idxes])
 
@@ -188,14 +243,17 @@ class PrioritizedReplayBuffer(ReplayBuffer):
             transitions at the sampled idxes denoted by
             variable `idxes`.
         """
+        idxes = np.asarray(idxes, dtype=np.int64)
+        priorities = np.asarray(priorities, dtype=np.float64)
         assert len(idxes) == len(priorities)
-        for idx, priority in zip(idxes, priorities):
-            assert priority > 0
-            assert 0 <= idx < self._curr_size
-            self._it_sum[idx] = priority ** self._alpha
-            self._it_min[idx] = priority ** self._alpha
+        if len(idxes) == 0:
+            return
+        assert np.all(priorities > 0)
+        assert np.all(idxes >= 0) and np.all(idxes < self._curr_size)
+        self._it_sum[idxes] = priorities ** self._alpha
+        self._it_min[idxes] = priorities ** self._alpha
 
-            self._max_priority = max(self._max_priority, priority)
+        self._max_priority = max(self._max_priority, float(priorities.max()))
 
 
 class VectorizedReplayBuffer:
@@ -203,6 +261,8 @@ class VectorizedReplayBuffer:
         """Create Vectorized Replay buffer.
         Parameters
         ----------
+        obs_shape: tuple or gym.Space
+            Observation shape, or space to keep uint8 images and per-key storage of dict observations.
         size: int
             Max number of transitions to store in the buffer. When the buffer
             overflows the old memories are dropped.
@@ -213,8 +273,8 @@ class VectorizedReplayBuffer:
 
         self.device = device
 
-        self.obses = torch.empty((capacity, *obs_shape), dtype=torch.float32, device=self.device)
-        self.next_obses = torch.empty((capacity, *obs_shape), dtype=torch.float32, device=self.device)
+        self.obses = create_obs_storage(obs_shape, (capacity,), self.device)
+        self.next_obses = create_obs_storage(obs_shape, (capacity,), self.device)
         self.actions = torch.empty((capacity, *action_shape), dtype=torch.float32, device=self.device)
         self.rewards = torch.empty((capacity, 1), dtype=torch.float32, device=self.device)
         self.dones = torch.empty((capacity, 1), dtype=torch.bool, device=self.device)
@@ -223,23 +283,25 @@ class VectorizedReplayBuffer:
         self.idx = 0
         self.full = False
         
+    def __len__(self):
+        return self.capacity if self.full else self.idx
 
-    def add(self, obs, action, reward, next_obs, done):
+    def add(self, obs, action, reward, next_obs, done, terminal=None):
 
-        num_observations = obs.shape[0]
+        num_observations = action.shape[0]
         remaining_capacity = min(self.capacity - self.idx, num_observations)
         overflow = num_observations - remaining_capacity
         if remaining_capacity < num_observations:
-            self.obses[0: overflow] = obs[-overflow:]
+            obs_set(self.obses, slice(0, overflow), obs_get(obs, slice(-overflow, None)))
             self.actions[0: overflow] = action[-overflow:]
             self.rewards[0: overflow] = reward[-overflow:]
-            self.next_obses[0: overflow] = next_obs[-overflow:]
+            obs_set(self.next_obses, slice(0, overflow), obs_get(next_obs, slice(-overflow, None)))
             self.dones[0: overflow] = done[-overflow:]
             self.full = True
-        self.obses[self.idx: self.idx + remaining_capacity] = obs[:remaining_capacity]
+        obs_set(self.obses, slice(self.idx, self.idx + remaining_capacity), obs_get(obs, slice(0, remaining_capacity)))
         self.actions[self.idx: self.idx + remaining_capacity] = action[:remaining_capacity]
         self.rewards[self.idx: self.idx + remaining_capacity] = reward[:remaining_capacity]
-        self.next_obses[self.idx: self.idx + remaining_capacity] = next_obs[:remaining_capacity]
+        obs_set(self.next_obses, slice(self.idx, self.idx + remaining_capacity), obs_get(next_obs, slice(0, remaining_capacity)))
         self.dones[self.idx: self.idx + remaining_capacity] = done[:remaining_capacity]
 
         self.idx = (self.idx + num_observations) % self.capacity
@@ -270,16 +332,460 @@ class VectorizedReplayBuffer:
         idxs = torch.randint(0,
                             self.capacity if self.full else self.idx, 
                             (batch_size,), device=self.device)
-        obses = self.obses[idxs]
+        obses = obs_get(self.obses, idxs)
         actions = self.actions[idxs]
         rewards = self.rewards[idxs]
-        next_obses = self.next_obses[idxs]
+        next_obses = obs_get(self.next_obses, idxs)
         dones = self.dones[idxs]
 
         return obses, actions, rewards, next_obses, dones
 
 
+class TrajectoryReplayBuffer:
+    def __init__(self, obs_shape, action_shape, capacity, num_envs, device):
+        """Create a replay buffer which stores every observation once.
+        Transitions are kept in one circular trajectory per env and the next observation
+        of a transition is the observation in the following slot of the same env. The final
+        observation of an episode (done or timeout) is stored in its own slot, which is never
+        sampled as the start of a transition.
+        Parameters
+        ----------
+        capacity: int
+            Max number of transitions to store in the buffer. When the buffer
+            overflows the old memories are dropped.
+        num_envs: int
+            Number of envs, every add call receives one transition per env.
+        See Also
+        --------
+        VectorizedReplayBuffer.__init__
+        """
+        self.device = device
+        self.num_envs = num_envs
+        self.capacity = capacity
+        # one extra slot per env holds the next observation of the latest transition
+        self.length = capacity // num_envs + 1
+
+        self.obses = create_obs_storage(obs_shape, (self.length, num_envs), self.device)
+        self.actions = torch.empty((self.length, num_envs, *action_shape), dtype=torch.float32, device=self.device)
+        self.rewards = torch.empty((self.length, num_envs, 1), dtype=torch.float32, device=self.device)
+        self.dones = torch.empty((self.length, num_envs, 1), dtype=torch.bool, device=self.device)
+        # slots which start a transition
+        self.valid = torch.zeros((self.length, num_envs), dtype=torch.bool, device=self.device)
+
+        self.env_ids = torch.arange(num_envs, device=self.device)
+        self.ptr = torch.zeros(num_envs, dtype=torch.long, device=self.device)
+        self.last_slots = torch.zeros(num_envs, dtype=torch.long, device=self.device)
+        # number of slots per env which can start a transition, tracked on the device
+        self.num_slots = torch.zeros(num_envs, dtype=torch.long, device=self.device)
+        self.num_transitions = 0
+
+    def __len__(self):
+        # counted on the host, final observations of overwritten episodes are not subtracted
+        return self.num_transitions
+
+    def add(self, obs, action, reward, next_obs, done, terminal=None):
+        """Add one transition per env.
+        Parameters
+        ----------
+        terminal: torch tensor or None
+            Marks transitions after which the env was reset (done or timeout), their next
+            observation gets its own slot. None treats done as terminal.
+        """
+        if terminal is None:
+            terminal = done
+        terminal = terminal.view(-1).bool()
+
+        ptr = self.ptr
+        next_ptr = (ptr + 1) % self.length
+        obs_set(self.obses, (ptr, self.env_ids), obs)
+        self.actions[ptr, self.env_ids] = action
+        self.rewards[ptr, self.env_ids] = reward
+        self.dones[ptr, self.env_ids] = done
+        self.valid[ptr, self.env_ids] = True
+        obs_set(self.obses, (next_ptr, self.env_ids), next_obs)
+        self.valid[next_ptr, self.env_ids] = False
+
+        # after a terminal transition the final observation keeps its slot and the next episode starts after it
+        self.last_slots = ptr
+        self.ptr = (next_ptr + terminal.long()) % self.length
+        self.num_slots = (self.num_slots + 1 + terminal.long()).clamp_(max=self.length)
+        self.num_transitions = min(self.capacity, self.num_transitions + self.num_envs)
+
+    def sample(self, batch_size, num_candidates=4):
+        """Sample a batch of experiences.
+        Every sample draws num_candidates slots and keeps the first one which starts
+        a transition, so no host synchronization is needed. Samples without a valid
+        candidate fall back to the latest transition of their env.
+        See Also
+        --------
+        VectorizedReplayBuffer.sample
+        """
+        envs = torch.randint(0, self.num_envs, (batch_size, num_candidates), device=self.device)
+        slots = (torch.rand((batch_size, num_candidates), device=self.device) * self.num_slots[envs]).long()
+        slots = slots.clamp_(max=self.length - 1)
+        valid = self.valid[slots, envs]
+        first_valid = torch.argmax(valid.int(), dim=1, keepdim=True)
+        slots = slots.gather(1, first_valid).squeeze(1)
+        envs = envs.gather(1, first_valid).squeeze(1)
+        slots = torch.where(valid.any(dim=1), slots, self.last_slots[envs])
+        next_slots = (slots + 1) % self.length
+
+        obses = obs_get(self.obses, (slots, envs))
+        actions = self.actions[slots, envs]
+        rewards = self.rewards[slots, envs]
+        next_obses = obs_get(self.obses, (next_slots, envs))
+        dones = self.dones[slots, envs]
 
+        return obses, actions, rewards, next_obses, dones
+
+
+class MemmapReplayBuffer:
+    def __init__(self, obs_shape, action_shape, capacity, device, directory, hot_size=1024, num_prefetch=2):
+        """Create a replay buffer whose columns are memory mapped .npy files.
+        Recent writes are collected in a small in-memory tail and written to disk in contiguous
+        chunks. A background thread gathers the next sampled batches into pinned tensors.
+        The files and a meta file with the write position persist, so opening a directory
+        which already holds a buffer of the same capacity continues it.
+        Parameters
+        ----------
+        obs_shape: tuple or gym.Space
+            Observation shape, or space to keep uint8 images and per-key storage of dict observations.
+        capacity: int
+            Max number of transitions to store in the buffer. When the buffer
+            overflows the old memories are dropped.
+        directory: str
+            Directory of the column files.
+        hot_size: int
+            Number of transitions kept in memory before they are written to disk.
+        num_prefetch: int
+            Number of batches sampled ahead, 0 samples synchronously. Prefetched batches
+            can miss transitions added after they were drawn.
+        """
+        self.device = device
+        self.capacity = capacity
+        self.directory = directory
+        self.hot_size = min(hot_size, capacity)
+        self.num_prefetch = num_prefetch
+        self.pin_memory = torch.device(device).type == 'cuda'
+        os.makedirs(directory, exist_ok=True)
+
+        self.meta_path = os.path.join(directory, 'meta.json')
+        meta = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            assert meta['capacity'] == capacity, 'replay buffer in {} has capacity {}, expected {}'.format(directory, meta['capacity'], capacity)
+        mode = 'r+' if meta is not None else 'w+'
+
+        specs = {
+            'obses': self._obs_spec(obs_shape),
+            'next_obses': self._obs_spec(obs_shape),
+            'actions': (tuple(action_shape), np.float32),
+            'rewards': ((1,), np.float32),
+            'dones': ((1,), np.bool_),
+        }
+        self.columns = {name: self._open_columns(name, spec, mode) for name, spec in specs.items()}
+        self.hot = {name: obs_map(column, lambda c: np.empty((self.hot_size, *c.shape[1:]), dtype=c.dtype))
+                    for name, column in self.columns.items()}
+
+        # write position on disk, the hot tail holds the hot_count transitions following it
+        self.disk_idx = meta['idx'] if meta is not None else 0
+        self.full = meta['full'] if meta is not None else False
+        self.hot_count = 0
+
+        self.lock = threading.Lock()
+        self.prefetch_queue = None
+        self.prefetch_batch_size = None
+        self.prefetch_thread = None
+        self.stop_event = threading.Event()
+
+    def _obs_spec(self, obs_space):
+        if isinstance(obs_space, gym.spaces.Dict):
+            return {k: self._obs_spec(v) for k, v in obs_space.spaces.items()}
+        if isinstance(obs_space, gym.spaces.Space):
+            return tuple(obs_space.shape), (np.uint8 if obs_space.dtype == np.uint8 else np.float32)
+        return tuple(obs_space), np.float32
+
+    def _open_columns(self, name, spec, mode):
+        if isinstance(spec, dict):
+            return {k: self._open_columns(name + '_' + k, v, mode) for k, v in spec.items()}
+        shape, dtype = spec
+        path = os.path.join(self.directory, name + '.npy')
+        column = np.lib.format.open_memmap(path, mode=mode, dtype=dtype, shape=(self.capacity, *shape))
+        assert column.shape[1:] == shape and column.dtype == dtype, 'column {} does not match the buffer layout'.format(path)
+        return column
+
+    @property
+    def idx(self):
+        return (self.disk_idx + self.hot_count) % self.capacity
+
+    def __len__(self):
+        if self.full:
+            return self.capacity
+        return self.disk_idx + self.hot_count
+
+    def add(self, obs, action, reward, next_obs, done, terminal=None):
+        values = {
+            'obses': obs,
+            'next_obses': next_obs,
+            'actions': action,
+            'rewards': reward,
+            'dones': done,
+        }
+        values = {name: obs_map(v, lambda t: t.detach().cpu().numpy() if isinstance(t, torch.Tensor) else np.asarray(t))
+                  for name, v in values.items()}
+        num_observations = action.shape[0]
+        start = 0
+        with self.lock:
+            while start < num_observations:
+                count = min(num_observations - start, self.hot_size - self.hot_count)
+                for name, value in values.items():
+                    obs_set(self.hot[name], slice(self.hot_count, self.hot_count + count), obs_get(value, slice(start, start + count)))
+                self.hot_count += count
+                start += count
+                if self.hot_count == self.hot_size:
+                    self._write_hot()
+
+    def _write_hot(self):
+        count = self.hot_count
+        first = min(count, self.capacity - self.disk_idx)
+        for name, column in self.columns.items():
+            hot = self.hot[name]
+            obs_set(column, slice(self.disk_idx, self.disk_idx + first), obs_get(hot, slice(0, first)))
+            if first < count:
+                obs_set(column, slice(0, count - first), obs_get(hot, slice(first, count)))
+        self.full = self.full or self.disk_idx + count >= self.capacity
+        self.disk_idx = (self.disk_idx + count) % self.capacity
+        self.hot_count = 0
+
+    def flush(self):
+        """Writes the hot tail and the write position to disk."""
+        with self.lock:
+            self._write_hot()
+            for column in self.columns.values():
+                obs_map(column, lambda c: c.flush())
+            with open(self.meta_path + '.tmp', 'w') as f:
+                json.dump({'capacity': self.capacity, 'idx': self.disk_idx, 'full': self.full}, f)
+            os.replace(self.meta_path + '.tmp', self.meta_path)
+
+    def _gather(self, batch_size):
+        with self.lock:
+            size = len(self)
+            idxs = np.random.randint(0, size, size=batch_size)
+            # sorted reads keep the disk access sequential, rows are put back in the sampled order
+            order = np.argsort(idxs)
+            sorted_idxs = idxs[order]
+            hot_offsets = (sorted_idxs - self.disk_idx) % self.capacity
+            in_hot = hot_offsets < self.hot_count
+
+            batch = {}
+            for name, column in self.columns.items():
+                def gather(c, h):
+                    rows = np.empty((batch_size, *c.shape[1:]), dtype=c.dtype)
+                    rows[order] = c[sorted_idxs]
+                    if in_hot.any():
+                        rows[order[in_hot]] = h[hot_offsets[in_hot]]
+                    tensor = torch.from_numpy(rows)
+                    return tensor.pin_memory() if self.pin_memory else tensor
+                if isinstance(column, dict):
+                    batch[name] = {k: gather(c, self.hot[name][k]) for k, c in column.items()}
+                else:
+                    batch[name] = gather(column, self.hot[name])
+        return batch
+
+    def _prefetch(self):
+        while not self.stop_event.is_set():
+            batch = self._gather(self.prefetch_batch_size)
+            while not self.stop_event.is_set():
+                try:
+                    self.prefetch_queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def _next_batch(self, batch_size):
+        if self.num_prefetch == 0:
+            return self._gather(batch_size)
+        if self.prefetch_thread is None:
+            self.prefetch_batch_size = batch_size
+            self.prefetch_queue = queue.Queue(maxsize=self.num_prefetch)
+            self.prefetch_thread = threading.Thread(target=self._prefetch, daemon=True)
+            self.prefetch_thread.start()
+        if batch_size != self.prefetch_batch_size:
+            return self._gather(batch_size)
+        return self.prefetch_queue.get()
+
+    def sample(self, batch_size):
+        """Sample a batch of experiences, see VectorizedReplayBuffer.sample."""
+        batch = self._next_batch(batch_size)
+        batch = {name: obs_map(v, lambda t: t.to(self.device, non_blocking=True)) for name, v in batch.items()}
+        return batch['obses'], batch['actions'], batch['rewards'], batch['next_obses'], batch['dones']
+
+    def close(self):
+        if self.prefetch_thread is not None:
+            self.stop_event.set()
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+        self.flush()
+
+
+class DAggerDataset:
+    def __init__(self, device, capacity=None, initial_capacity=4096, uint8_keys=(), spill_dir=None, max_device_size=None):
+        """Aggregated DAgger dataset kept in preallocated per-key tensors.
+        Parameters
+        ----------
+        device: torch.device
+            Device of the in-memory tier, minibatches are returned on it.
+        capacity: int or None
+            None grows the storage by doubling its capacity, an int keeps a fixed-capacity FIFO
+            where the oldest samples are overwritten.
+        initial_capacity: int
+            Number of rows allocated on the first add when the storage is growable.
+        uint8_keys: iterable of str
+            Image keys with values in [0, 1]. They are stored as uint8 and returned as uint8,
+            to be converted with BasePlayer._preproc_obs.
+        spill_dir: str or None
+            Directory of the memory-mapped tier which receives all rows that do not fit on the device.
+        max_device_size: int or None
+            Maximum number of rows kept on the device, None keeps rows on the device until an allocation fails.
+        """
+        self.device = torch.device(device)
+        self.is_fifo = capacity is not None
+        self.capacity = capacity if self.is_fifo else initial_capacity
+        self.uint8_keys = set(uint8_keys)
+        self.spill_dir = spill_dir
+        self.max_device_size = max_device_size
+
+        self.device_tensors = {}
+        self.disk_tensors = {}
+        self.disk_files = []
+        self.disk_generation = 0
+        self.device_rows = 0
+        self.spilled = False
+        self.allocated = False
+        self.size = 0
+        self.idx = 0
+
+    def __len__(self):
+        return self.size
+
+    def _to_storage(self, key, value):
+        value = value.detach()
+        if key in self.uint8_keys and value.dtype != torch.uint8:
+            value = value.mul(255.0).round_().clamp_(0, 255).to(torch.uint8)
+        return value
+
+    def _allocate_device(self, rows, templates):
+        tensors = {}
+        try:
+            for k, v in templates.items():
+                tensors[k] = torch.empty((rows, *v.shape[1:]), dtype=v.dtype, device=self.device)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            del tensors
+            if self.device.type == 'cuda':
+                torch.cuda.empty_cache()
+            return None
+        return tensors
+
+    def _allocate_disk(self, rows, templates):
+        assert self.spill_dir is not None, 'DAggerDataset: device memory is exhausted, set spill_dir to spill to disk'
+        os.makedirs(self.spill_dir, exist_ok=True)
+        tensors = {}
+        # every resize maps new files, the old ones back the tensors that are copied from
+        self.disk_generation += 1
+        for k, v in templates.items():
+            filename = os.path.join(self.spill_dir, 'dagger_{}_{}.bin'.format(k, self.disk_generation))
+            self.disk_files.append(filename)
+            numel = rows * int(np.prod(v.shape[1:]))
+            tensors[k] = torch.from_file(filename, shared=True, size=numel, dtype=v.dtype).view(rows, *v.shape[1:])
+        return tensors
+
+    def _resize(self, capacity, templates):
+        if not self.spilled:
+            device_rows = capacity if self.max_device_size is None else min(capacity, self.max_device_size)
+            if device_rows > self.device_rows:
+                tensors = self._allocate_device(device_rows, templates)
+                if tensors is not None:
+                    for k, v in self.device_tensors.items():
+                        tensors[k][:self.device_rows] = v
+                    self.device_tensors = tensors
+                    self.device_rows = device_rows
+            if self.device_rows < capacity:
+                print('DAggerDataset: spilling', capacity - self.device_rows, 'rows to', self.spill_dir)
+                self.spilled = True
+
+        if self.spilled:
+            old_files = self.disk_files
+            self.disk_files = []
+            tensors = self._allocate_disk(capacity - self.device_rows, templates)
+            for k, v in self.disk_tensors.items():
+                tensors[k][:v.shape[0]] = v
+            self.disk_tensors = tensors
+            for filename in old_files:
+                if filename not in self.disk_files:
+                    os.remove(filename)
+        self.capacity = capacity
+
+    def add(self, values):
+        """Appends a batch of samples.
+        Parameters
+        ----------
+        values: dict of torch tensors
+            Tensors sharing the leading batch dimension, the keys must be the same for every call.
+        """
+        values = {k: self._to_storage(k, v) for k, v in values.items()}
+        num_samples = next(iter(values.values())).shape[0]
+        if self.is_fifo and num_samples > self.capacity:
+            values = {k: v[-self.capacity:] for k, v in values.items()}
+            num_samples = self.capacity
+
+        if not self.allocated:
+            self._resize(self.capacity, values)
+            self.allocated = True
+        if not self.is_fifo and self.size + num_samples > self.capacity:
+            capacity = self.capacity
+            while self.size + num_samples > capacity:
+                capacity *= 2
+            self._resize(capacity, values)
+
+        rows = (self.idx + torch.arange(num_samples)) % self.capacity
+        on_device = rows < self.device_rows
+        for k, v in values.items():
+            if self.spilled:
+                self.disk_tensors[k][rows[~on_device] - self.device_rows] = v[(~on_device).to(v.device)].cpu()
+                v = v[on_device.to(v.device)]
+            self.device_tensors[k][rows[on_device].to(self.device)] = v.to(self.device)
+
+        self.idx = (self.idx + num_samples) % self.capacity
+        self.size = min(self.size + num_samples, self.capacity)
+
+    def get(self, rows):
+        """Gathers the samples at rows, a long tensor, into new tensors on the device.
+        """
+        if not self.spilled:
+            return {k: v[rows] for k, v in self.device_tensors.items()}
+        rows = rows.cpu()
+        on_device = rows < self.device_rows
+        rows_device = rows[on_device].to(self.device)
+        rows_disk = rows[~on_device] - self.device_rows
+        on_device = on_device.to(self.device)
+        result = {}
+        for k, v in self.device_tensors.items():
+            batch = torch.empty((len(rows), *v.shape[1:]), dtype=v.dtype, device=self.device)
+            batch[on_device] = v[rows_device]
+            batch[~on_device] = self.disk_tensors[k][rows_disk].to(self.device)
+            result[k] = batch
+        return result
+
+    def sample(self, batch_size):
+        rows = torch.randint(0, self.size, (batch_size,), device=self.device)
+        return self.get(rows)
+
+    def clear(self):
+        self.size = 0
+        self.idx = 0
 
 
 class ExperienceBuffer:
@@ -340,7 +846,7 @@ class ExperienceBuffer:
         if self.is_discrete or self.is_multi_discrete:
             self.tensor_dict['actions'] = self._create_tensor_from_space(gym.spaces.Box(low=0, high=1,shape=self.actions_shape, dtype=np.long), obs_base_shape)
         if self.use_action_masks:
-            self.tensor_dict['action_masks'] = self._create_tensor_from_space(gym.spaces.Box(low=0, high=1,shape=self.actions_shape + (np.sum(self.actions_num),), dtype=np.bool), obs_base_shape)
+            self.tensor_dict['action_masks'] = self._create_tensor_from_space(gym.spaces.Box(low=0, high=1,shape=self.actions_shape + (np.sum(self.actions_num),), dtype=bool), obs_base_shape)
         if self.is_continuous:
             self.tensor_dict['actions'] = self._create_tensor_from_space(gym.spaces.Box(low=0, high=1,shape=self.actions_shape, dtype=np.float32), obs_base_shape)
             self.tensor_dict['mus'] = self._create_tensor_from_space(gym.spaces.Box(low=0, high=1,shape=self.actions_shape, dtype=np.float32), obs_base_shape)
@@ -379,6 +885,13 @@ class ExperienceBuffer:
             self.tensor_dict[name][index,:] = val
 
 
+    def update_data_slice(self, name, index, env_slice, val):
+        if type(val) is dict:
+            for k,v in val.items():
+                self.tensor_dict[name][k][index,env_slice] = v
+        else:
+            self.tensor_dict[name][index,env_slice] = val
+
     def update_data_rnn(self, name, indices,play_mask, val):
         if type(val) is dict:
             for k,v in val:
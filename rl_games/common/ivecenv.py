@@ -5,6 +5,19 @@ class IVecEnv:
     def reset(self):
         raise NotImplementedError
 
+    def step_async(self, actions, env_slice=None):
+        """
+        Start stepping the envs of env_slice without waiting for the results, they are returned by step_wait.
+        Allows the algo to run the policy on other envs in the meantime (see A2CBase.play_steps_pingpong).
+        """
+        raise NotImplementedError
+
+    def step_wait(self, env_slice=None):
+        raise NotImplementedError
+
+    def supports_step_async(self):
+        return False
+
     def has_action_masks(self):
         return False
 
@@ -17,6 +30,12 @@ class IVecEnv:
     def seed(self, seed):
         pass
 
+    def get_env_stats(self):
+        """
+        Return a dict of scalar env statistics (e.g. reset latency) since the last call, logged under env/.
+        """
+        return {}
+
     def set_train_info(self, env_frames, *args, **kwargs):
         """
         Send the information in the direction algo->environment.
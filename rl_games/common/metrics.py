@@ -0,0 +1,201 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+import torch
+from tensorboardX import SummaryWriter
+
+'''
+Asynchronous metrics pipeline.
+MetricsWriter is a drop-in for the SummaryWriter of the agents: add_scalar takes python numbers or (device)
+tensors and only buffers them, so training never waits for a device to host copy per scalar. flush() (once per
+epoch) moves all buffered tensors to the host with one batched non-blocking copy per device and hands the
+records to a background thread which waits for the copy and writes them to the sinks.
+
+config:
+    metrics_sinks: list of 'tensorboard' (default), 'jsonl' and 'wandb'
+    interval_summaries: rate limit the summaries with IntervalSummaryWriter (always on with PBT)
+'''
+
+
+class TensorboardSink:
+    def __init__(self, log_dir):
+        self.writer = SummaryWriter(log_dir)
+
+    def write(self, records):
+        for tag, value, step in records:
+            # multi element values are only written by the jsonl and wandb sinks
+            if isinstance(value, list):
+                continue
+            self.writer.add_scalar(tag, value, step)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+class JsonlSink:
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def write(self, records):
+        now = time.time()
+        for tag, value, step in records:
+            self.file.write(json.dumps({'tag': tag, 'value': value, 'step': step, 'time': now}) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class WandbSink:
+    '''
+    logs every flush as one wandb step, wandb has to be initialized by the caller
+    '''
+    def __init__(self):
+        import wandb
+        assert wandb.run is not None, 'call wandb.init() before using the wandb metrics sink'
+        self.wandb = wandb
+
+    def write(self, records):
+        self.wandb.log({tag: value for tag, value, _ in records})
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _to_python(value):
+    if isinstance(value, list):
+        return value[0] if len(value) == 1 else value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class MetricsWriter:
+    def __init__(self, sinks, max_queue_size=16):
+        self.sinks = sinks
+        self.pending = []
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+        self.closed = False
+        atexit.register(self.close)
+
+    def add_scalar(self, tag, value, step, *args, **kwargs):
+        self.pending.append((tag, value, step))
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        records, self.pending = self.pending, []
+
+        # one batched copy per device, tensors are snapshotted here even if they are modified in place later
+        copies = []
+        by_device = {}
+        for i, (_, value, _) in enumerate(records):
+            if isinstance(value, torch.Tensor):
+                by_device.setdefault(value.device, []).append(i)
+        for device, indices in by_device.items():
+            flat = torch.cat([records[i][1].detach().float().reshape(-1) for i in indices])
+            event = None
+            if device.type == 'cuda':
+                host = torch.empty(flat.shape, dtype=flat.dtype, pin_memory=True)
+                host.copy_(flat, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+            else:
+                host = flat.clone()
+            sizes = [records[i][1].numel() for i in indices]
+            copies.append((indices, sizes, host, event))
+        self._put((records, copies))
+
+    def _put(self, item):
+        # a dead writer thread must not block training once the queue is full
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            records, copies = item
+            try:
+                records = self._to_records(records, copies)
+            except Exception:
+                print('MetricsWriter: dropping a batch of metrics')
+                traceback.print_exc()
+                continue
+            # a failing sink skips the batch, the other sinks and later batches are still written
+            for sink in self.sinks:
+                try:
+                    sink.write(records)
+                    sink.flush()
+                except Exception:
+                    print('MetricsWriter: {} failed'.format(type(sink).__name__))
+                    traceback.print_exc()
+
+    def _to_records(self, records, copies):
+        records = list(records)
+        for indices, sizes, host, event in copies:
+            if event is not None:
+                event.synchronize()
+            values = host.tolist()
+            offset = 0
+            for i, size in zip(indices, sizes):
+                tag, _, step = records[i]
+                records[i] = (tag, values[offset:offset + size], step)
+                offset += size
+        return [(tag, _to_python(value), step) for tag, value, step in records]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        if self._put(None):
+            self.thread.join()
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception:
+                traceback.print_exc()
+
+    def __getattr__(self, attr):
+        # other SummaryWriter methods (histograms, text, ...) go to tensorboard directly
+        for sink in self.__dict__.get('sinks', []):
+            if isinstance(sink, TensorboardSink):
+                return getattr(sink.writer, attr)
+        raise AttributeError(attr)
+
+
+def create_metrics_writer(summaries_dir, config):
+    sinks = []
+    for name in config.get('metrics_sinks', ['tensorboard']):
+        if name == 'tensorboard':
+            sinks.append(TensorboardSink(summaries_dir))
+        elif name == 'jsonl':
+            sinks.append(JsonlSink(os.path.join(summaries_dir, 'metrics.jsonl')))
+        elif name == 'wandb':
+            sinks.append(WandbSink())
+        else:
+            assert False, 'unknown metrics sink: {}'.format(name)
+    return MetricsWriter(sinks)
@@ -3,7 +3,9 @@ import gym
 import numpy as np
 import torch
 import copy
+import torch.nn.functional as F
 from rl_games.common import env_configurations
+from rl_games.common import experience
 from rl_games.algos_torch import  model_builder
 
 class BasePlayer(object):
@@ -50,6 +52,12 @@ class BasePlayer(object):
         self.max_steps = 108000 // 4
         self.device = torch.device(self.device_name)
 
+        # int8 cpu inference: None, 'dynamic' (mlp layers) or 'static' (mlp layers + resnet conv stack)
+        self.quantize = self.player_config.get('quantize', None)
+        self.quantize_calibration_steps = self.player_config.get('quantize_calibration_steps', 512)
+        # number of games to compare the quantized policy against fp32, 0 disables the check
+        self.quantize_check_games = self.player_config.get('quantize_check_games', 0)
+
     def load_networks(self, params):
         builder = model_builder.ModelBuilder()
         self.config['network'] = builder.load(params)
@@ -159,7 +167,156 @@ class BasePlayer(object):
             self.states = [torch.zeros((s.size()[0], self.batch_size, s.size(
             )[2]), dtype=torch.float32).to(self.device) for s in rnn_states]
 
+    def has_action_masks(self):
+        has_masks_func = getattr(self.env, "has_action_mask", None) is not None
+        return has_masks_func and self.env.has_action_mask()
+
+    def get_env_action(self, obses, masks, is_determenistic):
+        if masks is not None:
+            return self.get_masked_action(obses, masks, is_determenistic)
+        return self.get_action(obses, is_determenistic)
+
+    def record_observations(self, num_steps):
+        has_masks = self.has_action_masks()
+        obses = self.env_reset(self.env)
+        batch_size = self.get_batch_size(obses, 1)
+        self.init_rnn()
+        recorded = []
+        for _ in range(num_steps):
+            if isinstance(obses, dict):
+                recorded.append({k: v.clone() for k, v in obses.items()})
+            else:
+                recorded.append(obses.clone())
+            masks = self.env.get_action_mask() if has_masks else None
+            action = self.get_env_action(obses, masks, self.is_determenistic)
+            obses, _, done, _ = self.env_step(self.env, action)
+            all_done_indices = done.nonzero(as_tuple=False)
+            if len(all_done_indices) > 0:
+                if self.is_rnn:
+                    for s in self.states:
+                        s[:, all_done_indices, :] = s[:, all_done_indices, :] * 0.0
+                if batch_size // self.num_agents == 1:
+                    obses = self.env_reset(self.env)
+        return recorded
+
+    def quantize_model(self):
+        from rl_games.algos_torch import quantization
+        assert self.quantize in quantization.QUANTIZATION_MODES, 'unknown quantization mode: ' + str(self.quantize)
+        assert self.device.type == 'cpu', 'quantized inference is supported only on cpu, set device_name: cpu'
+
+        fp32_model = self.model
+        self.model = copy.deepcopy(fp32_model)
+        if self.quantize == 'static' and quantization.get_resnet_network(self.model) is not None:
+            print('calibrating conv stack on', self.quantize_calibration_steps, 'recorded steps')
+            self.model = fp32_model
+            calibration_obses = self.record_observations(self.quantize_calibration_steps)
+            self.model = copy.deepcopy(fp32_model)
+            self.init_rnn()
+            example_input = quantization.capture_cnn_input(self.model,
+                lambda: self.get_action(copy.copy(calibration_obses[0]), True))
+            quantization.prepare_static_cnn(self.model, example_input)
+            self.init_rnn()
+            for obses in calibration_obses:
+                self.get_action(obses, self.is_determenistic)
+            quantization.convert_static_cnn(self.model)
+        elif self.quantize == 'static':
+            print('quantization: static quantization is supported only for resnet_actor_critic conv stacks')
+        self.model = quantization.quantize_dynamic_mlp(self.model, inplace=True)
+        self.model.eval()
+        self.init_rnn()
+
+        if self.quantize_check_games > 0:
+            self.check_quantization(fp32_model, self.quantize_check_games)
+
+    def evaluate_policy(self, n_games, reference_model=None):
+        '''
+        plays n_games deterministically, if reference_model is given its actions are computed on the same observations
+        '''
+        has_masks = self.has_action_masks()
+        obses = self.env_reset(self.env)
+        batch_size = self.get_batch_size(obses, 1)
+        self.init_rnn()
+        reference_states = None if self.states is None else [s.clone() for s in self.states]
+
+        cr = torch.zeros(batch_size, dtype=torch.float32)
+        steps = torch.zeros(batch_size, dtype=torch.float32)
+        games_played = 0
+        sum_rewards = 0
+        sum_steps = 0
+        inference_time = 0
+        num_inferences = 0
+        sum_action_diff = 0
+        sum_action_match = 0
+
+        while games_played < n_games:
+            masks = self.env.get_action_mask() if has_masks else None
+            start = time.perf_counter()
+            action = self.get_env_action(obses, masks, True)
+            inference_time += time.perf_counter() - start
+            num_inferences += 1
+
+            if reference_model is not None:
+                model, states = self.model, self.states
+                self.model, self.states = reference_model, reference_states
+                reference_action = self.get_env_action(copy.copy(obses), masks, True)
+                reference_states = self.states
+                self.model, self.states = model, states
+                diff = (action.float() - reference_action.float()).abs()
+                sum_action_diff += diff.mean().item()
+                sum_action_match += (diff == 0).float().mean().item()
+
+            obses, r, done, _ = self.env_step(self.env, action)
+            cr += r
+            steps += 1
+
+            all_done_indices = done.nonzero(as_tuple=False)
+            done_indices = all_done_indices[::self.num_agents]
+            done_count = len(done_indices)
+            if done_count > 0:
+                if self.is_rnn:
+                    for s in self.states:
+                        s[:, all_done_indices, :] = s[:, all_done_indices, :] * 0.0
+                    if reference_states is not None:
+                        for s in reference_states:
+                            s[:, all_done_indices, :] = s[:, all_done_indices, :] * 0.0
+                games_played += done_count
+                sum_rewards += cr[done_indices].sum().item()
+                sum_steps += steps[done_indices].sum().item()
+                cr = cr * (1.0 - done.float())
+                steps = steps * (1.0 - done.float())
+                if batch_size // self.num_agents == 1:
+                    obses = self.env_reset(self.env)
+
+        stats = {
+            'reward': sum_rewards / games_played,
+            'steps': sum_steps / games_played,
+            'inference_ms': 1000.0 * inference_time / num_inferences,
+        }
+        if reference_model is not None:
+            stats['action_diff'] = sum_action_diff / num_inferences
+            stats['action_match'] = sum_action_match / num_inferences
+        return stats
+
+    def check_quantization(self, fp32_model, n_games):
+        quantized_model = self.model
+        self.model = fp32_model
+        fp32_stats = self.evaluate_policy(n_games)
+        self.model = quantized_model
+        int8_stats = self.evaluate_policy(n_games, reference_model=fp32_model)
+
+        print('fp32 av reward:', fp32_stats['reward'], 'av steps:', fp32_stats['steps'],
+              'inference ms:', fp32_stats['inference_ms'])
+        print('int8 av reward:', int8_stats['reward'], 'av steps:', int8_stats['steps'],
+              'inference ms:', int8_stats['inference_ms'])
+        print('int8 vs fp32 mean abs action diff:', int8_stats['action_diff'],
+              'identical actions:', int8_stats['action_match'],
+              'speedup:', fp32_stats['inference_ms'] / int8_stats['inference_ms'])
+        return fp32_stats, int8_stats
+
     def run(self):
+        if self.quantize is not None:
+            self.quantize_model()
+
         n_games = self.games_num
         render = self.render_env
         n_game_life = self.n_game_life
@@ -264,7 +421,6 @@ class BasePlayer(object):
                   'av steps:', sum_steps / games_played * n_game_life)
 
     def teach(self, student_observation: str = 'privileged'):
-        import torch.nn.functional as F
         from tqdm import tqdm
         from torch.utils.data import DataLoader
         from collections import defaultdict
@@ -284,11 +440,22 @@ class BasePlayer(object):
 
         need_init_rnn = self.is_rnn
 
+        dagger_config = self.player_config.get('dagger', {})
+        num_epochs = dagger_config.get('num_epochs', 1000)
+        save_every = dagger_config.get('save_every', 10)
+        rollout_steps = dagger_config.get('rollout_steps', 32)
+        num_updates = dagger_config.get('num_updates', 10000)
+        minibatch_size = dagger_config.get('minibatch_size', 64)
+        aggregate_dataset = dagger_config.get('aggregate_dataset', True)
+        # async mode trains the student in a background thread while rollouts continue
+        async_mode = dagger_config.get('async', False)
+        sync_weights_every = dagger_config.get('sync_weights_every', 1)
+
         obses = self.env.reset()
         batch_size = 1
         batch_size = self.get_batch_size(obses['obs'], batch_size)
         student = self.create_student(student_observation, obses)
-        student_optimizer = torch.optim.Adam(student.parameters(), lr=0.00001)
+        student_optimizer = torch.optim.Adam(student.parameters(), lr=dagger_config.get('learning_rate', 0.00001))
 
         if need_init_rnn:
             self.init_rnn()
@@ -297,21 +464,43 @@ class BasePlayer(object):
         cr = torch.zeros(batch_size, dtype=torch.float32, device=obses['obs'].device)
         steps = torch.zeros(batch_size, dtype=torch.float32, device=obses['obs'].device)
 
-        dataset_dict = {}
-        for epoch in range(1, 1001):
+        # uint8_keys: float image keys with values in [0, 1] which are stored quantized to uint8, none by default
+        self.dagger_dataset = experience.DAggerDataset(obses['obs'].device,
+                                                       capacity=dagger_config.get('capacity', None),
+                                                       initial_capacity=dagger_config.get('initial_capacity', 4096),
+                                                       uint8_keys=dagger_config.get('uint8_keys', []),
+                                                       spill_dir=dagger_config.get('spill_dir', None),
+                                                       max_device_size=dagger_config.get('max_device_size', None))
+
+        def update_student(batch):
+            return self.dagger_update(student, student_optimizer, batch, student_observation)
+
+        acting_student = student
+        if async_mode:
+            from rl_games.algos_torch.dagger import AsyncDAggerTrainer
+            # by default keep the update to data ratio of the synchronous schedule
+            update_to_data_ratio = dagger_config.get('update_to_data_ratio', num_updates / (rollout_steps * batch_size))
+            acting_student = copy.deepcopy(student)
+            trainer = AsyncDAggerTrainer(student, self.dagger_dataset, update_student, minibatch_size,
+                                         update_to_data_ratio=update_to_data_ratio, preproc_fn=self._preproc_obs)
+            trainer.start()
+
+        for epoch in range(1, num_epochs + 1):
             #print("DAgger epoch:", epoch)
-            save_every = 10
+            if async_mode:
+                trainer.check_error()
+                if epoch % sync_weights_every == 0:
+                    trainer.copy_weights_to(acting_student)
             if epoch % save_every == 0:
-                torch.save(student.state_dict(), f"./student_dagger_epoch_{epoch}.pt")
-
+                weights = trainer.get_weights() if async_mode else student.state_dict()
+                torch.save(weights, f"./student_dagger_epoch_{epoch}.pt")
 
-            rollout_steps = 32
             obs_dict = defaultdict(list)
             expert_actions = []
             for step in range(rollout_steps):
                 obs_dict = self.append_obs(obs_dict, obses, student_observation)
 
-                act = self.mix_act(student, obs_dict, student_observation, p=1.0)
+                act = self.mix_act(acting_student, obs_dict, student_observation, p=1.0)
                 expert_act = self.get_action(obses['obs'], self.is_determenistic)
                 expert_actions.append(expert_act)
 
@@ -339,42 +528,42 @@ class BasePlayer(object):
                         print('reward:', cur_rewards / done_count,
                               'steps:', cur_steps / done_count)
 
-            # After taking 32 rollout steps
-
+            # After taking the rollout steps
             for k, v in obs_dict.items():
-                obs_dict[k] = torch.cat(v).detach()
-            expert_actions = torch.cat(expert_actions).detach()
-
-            aggregate_dataset = True
-            if aggregate_dataset:
-                for k, v in obs_dict.items():
-                    if k in dataset_dict.keys():
-                        dataset_dict[k] = torch.cat([dataset_dict[k], v])
-                    else:
-                        dataset_dict[k] = v
-                if "expert_actions" in dataset_dict.keys():
-                    dataset_dict["expert_actions"] = torch.cat([dataset_dict["expert_actions"], expert_actions])
-                else:
-                    dataset_dict["expert_actions"] = expert_actions
-            else:
-                dataset_dict = obs_dict
-                dataset_dict["expert_actions"] = expert_actions
+                obs_dict[k] = torch.cat(v)
+            obs_dict["expert_actions"] = torch.cat(expert_actions)
+
+            if async_mode:
+                trainer.add(obs_dict, clear=not aggregate_dataset)
+                wandb.log({"dagger_dataset_size": len(self.dagger_dataset), "dagger_updates": trainer.num_updates})
+                if trainer.last_loss is not None:
+                    wandb.log({"dagger_loss": trainer.last_loss})
+                continue
 
-            dataset_size = dataset_dict['obs'].shape[0]
+            if not aggregate_dataset:
+                self.dagger_dataset.clear()
+            self.dagger_dataset.add(obs_dict)
 
-            wandb.log({"dagger_dataset_size": dataset_dict['obs'].shape[0]})
+            wandb.log({"dagger_dataset_size": len(self.dagger_dataset)})
 
-            num_updates = 10000
             for update_step in range(num_updates):
-                batch_i = torch.randint(0, dataset_size, size=(64,), device=dataset_dict['obs'].device)
-                student_actions = self.get_student_action(student, dataset_dict, student_observation, batch_i)
-                dagger_loss = F.mse_loss(student_actions, dataset_dict["expert_actions"][batch_i])
-                dagger_loss.backward()
-                student_optimizer.step()
+                batch = self._preproc_obs(self.dagger_dataset.sample(minibatch_size))
+                dagger_loss = update_student(batch)
                 if update_step % 1000 == 0:
                     wandb.log({"dagger_loss": dagger_loss})
                     print("dagger_loss:", dagger_loss.item())
 
+        if async_mode:
+            trainer.stop()
+
+    def dagger_update(self, student, optimizer, batch, student_observation):
+        student_actions = self.get_student_action(student, batch, student_observation)
+        dagger_loss = F.mse_loss(student_actions, batch["expert_actions"])
+        optimizer.zero_grad()
+        dagger_loss.backward()
+        optimizer.step()
+        return dagger_loss
+
     def get_batch_size(self, obses, batch_size):
         obs_shape = self.obs_shape
         if type(self.obs_shape) is dict:
@@ -462,7 +651,7 @@ class BasePlayer(object):
 
     def get_student_action(self, student, obs_dict, student_observation, batch_i = None):
         if batch_i is None:
-            batch_i = torch.arange(0, obs_dict['obs'].shape[0], device=obs_dict['obs'].device)
+            batch_i = slice(None)
         if student_observation == 'privileged':
             act = student(obs_dict['obs'][batch_i])
         elif student_observation == 'image_and_joint_pos':
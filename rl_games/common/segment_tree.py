@@ -1,8 +1,11 @@
 import operator
 
+import numpy as np
+import torch
+
 
 class SegmentTree(object):
-    def __init__(self, capacity, operation, neutral_element):
+    def __init__(self, capacity, operation, neutral_element, device=None):
         """Build a Segment Tree data structure.
         https://en.wikipedia.org/wiki/Segment_tree
         Can be used as regular array, but with two
@@ -12,37 +15,44 @@ class SegmentTree(object):
             b) user has access to an efficient ( O(log segment size) )
                `reduce` operation which reduces `operation` over
                a contiguous subsequence of items in the array.
+        Nodes are stored in a flat array (root at 1, children of node i at 2i and 2i + 1),
+        so batches of items can be set and searched with vectorized level by level passes.
         Paramters
         ---------
         capacity: int
             Total size of the array - must be a power of two.
-        operation: lambda obj, obj -> obj
+        operation: elementwise binary function on arrays (eg. np.add, np.minimum)
             and operation for combining elements (eg. sum, max)
             must form a mathematical group together with the set of
             possible values for array elements (i.e. be associative)
         neutral_element: obj
             neutral element for the operation above. eg. float('-inf')
             for max and 0 for sum.
+        device: str or torch.device
+            if set nodes are kept in a float64 torch tensor on this device, otherwise in a numpy array.
         """
         assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
         self._capacity = capacity
-        self._value = [neutral_element for _ in range(2 * capacity)]
+        self._depth = capacity.bit_length() - 1
         self._operation = operation
-
-    def _reduce_helper(self, start, end, node, node_start, node_end):
-        if start == node_start and end == node_end:
-            return self._value[node]
-        mid = (node_start + node_end) // 2
-        if end <= mid:
-            return self._reduce_helper(start, end, 2 * node, node_start, mid)
+        # single item updates run on python floats, which is cheaper than numpy scalar calls
+        self._scalar_operation = {np.add: operator.add, np.minimum: min}.get(operation, operation)
+        self._neutral_element = neutral_element
+        self._device = device
+        if device is None:
+            self._value = np.full(2 * capacity, neutral_element, dtype=np.float64)
         else:
-            if mid + 1 <= start:
-                return self._reduce_helper(start, end, 2 * node + 1, mid + 1, node_end)
-            else:
-                return self._operation(
-                    self._reduce_helper(start, mid, 2 * node, node_start, mid),
-                    self._reduce_helper(mid + 1, end, 2 * node + 1, mid + 1, node_end)
-                )
+            self._value = torch.full((2 * capacity,), neutral_element, dtype=torch.float64, device=device)
+
+    def _as_index(self, idx):
+        if self._device is None:
+            return np.asarray(idx, dtype=np.int64)
+        return torch.as_tensor(idx, dtype=torch.int64, device=self._device)
+
+    def _unique(self, idx):
+        if self._device is None:
+            return np.unique(idx)
+        return torch.unique(idx)
 
     def reduce(self, start=0, end=None):
         """Returns result of applying `self.operation`
@@ -63,32 +73,68 @@ class SegmentTree(object):
             end = self._capacity
         if end < 0:
             end += self._capacity
-        end -= 1
-        return self._reduce_helper(start, end, 1, 0, self._capacity - 1)
+        if start == 0 and end == self._capacity:
+            return float(self._value[1])
+
+        # bottom up walk over the half open leaf range [start, end)
+        nodes = []
+        start += self._capacity
+        end += self._capacity
+        while start < end:
+            if start & 1:
+                nodes.append(start)
+                start += 1
+            if end & 1:
+                end -= 1
+                nodes.append(end)
+            start //= 2
+            end //= 2
+        if len(nodes) == 0:
+            return self._neutral_element
+        values = self._value[self._as_index(nodes)]
+        result = values[0]
+        for value in values[1:]:
+            result = self._operation(result, value)
+        return float(result)
 
     def __setitem__(self, idx, val):
-        # index of the leaf
-        idx += self._capacity
-        self._value[idx] = val
-        idx //= 2
-        while idx >= 1:
-            self._value[idx] = self._operation(
-                self._value[2 * idx],
-                self._value[2 * idx + 1]
-            )
+        """Sets one item or a batch of items, with duplicated indices the last value wins (numpy storage)."""
+        if self._device is None and np.isscalar(idx):
+            # index of the leaf
+            value = self._value
+            idx += self._capacity
+            value[idx] = val
             idx //= 2
+            while idx >= 1:
+                value[idx] = self._scalar_operation(
+                    float(value[2 * idx]),
+                    float(value[2 * idx + 1])
+                )
+                idx //= 2
+            return
 
-    def __getitem__(self, idx):
-        assert 0 <= idx < self._capacity
-        return self._value[self._capacity + idx]
+        idx = self._as_index(idx).reshape(-1) + self._capacity
+        if self._device is not None and isinstance(val, np.ndarray):
+            val = torch.from_numpy(val).to(self._device)
+        self._value[idx] = val
+        # all leaves are on the same level, so parents are refreshed one level at a time
+        for _ in range(self._depth):
+            idx = self._unique(idx // 2)
+            self._value[idx] = self._operation(self._value[2 * idx], self._value[2 * idx + 1])
 
+    def __getitem__(self, idx):
+        if np.isscalar(idx):
+            assert 0 <= idx < self._capacity
+            return float(self._value[self._capacity + idx])
+        return self._value[self._as_index(idx) + self._capacity]
 
 class SumSegmentTree(SegmentTree):
-    def __init__(self, capacity):
+    def __init__(self, capacity, device=None):
         super(SumSegmentTree, self).__init__(
             capacity=capacity,
-            operation=operator.add,
-            neutral_element=0.0
+            operation=np.add if device is None else torch.add,
+            neutral_element=0.0,
+            device=device
         )
 
     def sum(self, start=0, end=None):
@@ -101,35 +147,48 @@ class SumSegmentTree(SegmentTree):
         if array values are probabilities, this function
         allows to sample indexes according to the discrete
         probability efficiently.
+        A batch of prefix sums descends the tree together, one level per step.
         Parameters
         ----------
-        perfixsum: float
+        perfixsum: float or array of floats
             upperbound on the sum of array prefix
         Returns
         -------
-        idx: int
+        idx: int or array of ints
             highest index satisfying the prefixsum constraint
         """
-        assert 0 <= prefixsum <= self.sum() + 1e-5
-        idx = 1
-        while idx < self._capacity:  # while non-leaf
-            if self._value[2 * idx] > prefixsum:
-                idx = 2 * idx
-            else:
-                prefixsum -= self._value[2 * idx]
-                idx = 2 * idx + 1
-        return idx - self._capacity
+        is_scalar = np.isscalar(prefixsum)
+        if self._device is None:
+            prefixsum = np.array(prefixsum, dtype=np.float64).reshape(-1)
+            assert 0 <= prefixsum.min() and prefixsum.max() <= self.sum() + 1e-5
+            idx = np.ones(prefixsum.shape[0], dtype=np.int64)
+        else:
+            prefixsum = torch.as_tensor(prefixsum, dtype=torch.float64, device=self._device).reshape(-1).clone()
+            idx = torch.ones(prefixsum.shape[0], dtype=torch.int64, device=self._device)
+
+        for _ in range(self._depth):
+            left = 2 * idx
+            left_value = self._value[left]
+            go_right = left_value <= prefixsum
+            prefixsum -= left_value * go_right
+            idx = left + go_right
+        idx -= self._capacity
+
+        if is_scalar:
+            return int(idx[0])
+        return idx
 
 
 class MinSegmentTree(SegmentTree):
-    def __init__(self, capacity):
+    def __init__(self, capacity, device=None):
         super(MinSegmentTree, self).__init__(
             capacity=capacity,
-            operation=min,
-            neutral_element=float('inf')
+            operation=np.minimum if device is None else torch.minimum,
+            neutral_element=float('inf'),
+            device=device
         )
 
     def min(self, start=0, end=None):
         """Returns min(arr[start], ...,  arr[end])"""
 
-        return super(MinSegmentTree, self).reduce(start, end)
\ No newline at end of file
+        return super(MinSegmentTree, self).reduce(start, end)
@@ -60,6 +60,27 @@ def dicts_to_dict_with_arrays(dicts, add_batch_dim = True):
     res = {k : concat_func(v)  for k,v in res.items()}
     return res
 
+def infos_to_columns(infos, dones):
+    """
+    converts a list of per env info dicts into columnar infos: a dict of arrays stacked over the envs.
+    Numeric values missing in some of the infos (e.g. only set at the end of an episode) are filled with zeros,
+    values which can't be stacked are dropped. 'done_mask' marks the envs which finished an episode.
+    """
+    columns = {}
+    keys = dict.fromkeys(k for info in infos for k in info)
+    for key in keys:
+        values = [info.get(key) for info in infos]
+        first = np.asarray(next(v for v in values if v is not None))
+        if first.dtype.kind not in 'biuf':
+            continue
+        fill = np.zeros_like(first)
+        try:
+            columns[key] = np.stack([fill if v is None else np.asarray(v) for v in values])
+        except ValueError:
+            continue
+    columns['done_mask'] = np.asarray(dones).reshape(len(infos), -1).all(axis=1)
+    return columns
+
 def unsqueeze_obs(obs):
     if type(obs) is dict:
         for k,v in obs.items():
@@ -1,16 +1,36 @@
 import ray
 from rl_games.common.ivecenv import IVecEnv
 from rl_games.common.env_configurations import configurations
-from rl_games.common.tr_helpers import dicts_to_dict_with_arrays
+from rl_games.common.tr_helpers import dicts_to_dict_with_arrays, infos_to_columns
 import numpy as np
 import gym
 import random
+import queue
+import threading
+import time
 from time import sleep
 import torch
 
 class RayWorker:
-    def __init__(self, config_name, config):
+    '''
+    pre_reset_pool: number of spare env instances which are reset by a background thread. When an episode ends
+    the worker swaps in a spare env which is already reset instead of resetting inline, the finished env is reset
+    in the background. Hides the latency of expensive resets, the envs have to tolerate being reset from another
+    thread.
+    '''
+    def __init__(self, config_name, config, pre_reset_pool=0):
+        self.config_name = config_name
+        self.config = config
         self.env = configurations[config_name]['env_creator'](**config)
+        self.pre_reset_pool = pre_reset_pool
+        self.reset_thread = None
+        self.env_seed = None
+        self.weights = None
+        # sum, count and max of the reset latencies since the last get_reset_stats, constant size for workers
+        # whose stats are never collected (impala actors)
+        self.reset_latency_stats = [0.0, 0, 0.0]
+        # the next action mask is returned with the step and reset results, so it needs no extra remote call
+        self.has_action_mask = hasattr(self.env, 'get_action_mask')
 
     def _obs_to_fp32(self, obs):
         if isinstance(obs, dict):
@@ -35,11 +55,58 @@ class RayWorker:
         else:
             episode_done = is_done.all()
         if episode_done:
-            next_state = self.reset()
+            next_state = self._reset_finished_env()
         next_state = self._obs_to_fp32(next_state)
-        return next_state, reward, is_done, info
+        return next_state, reward, is_done, info, self._get_next_action_mask()
+
+    def _get_next_action_mask(self):
+        if not self.has_action_mask:
+            return None
+        return np.asarray(self.env.get_action_mask(), dtype=bool)
+
+    def _start_pre_reset_pool(self):
+        self.reset_requests = queue.Queue()
+        self.ready_envs = queue.Queue()
+        for i in range(self.pre_reset_pool):
+            env = configurations[self.config_name]['env_creator'](**self.config)
+            if self.env_seed is not None and hasattr(env, 'seed'):
+                env.seed(self.env_seed + 1000003 * (i + 1))
+            self.reset_requests.put(env)
+        self.reset_thread = threading.Thread(target=self._reset_loop, daemon=True)
+        self.reset_thread.start()
+
+    def _reset_loop(self):
+        while True:
+            env = self.reset_requests.get()
+            obs = env.reset()
+            self.ready_envs.put((env, obs))
+
+    def _reset_finished_env(self):
+        start = time.time()
+        if self.reset_thread is not None:
+            self.reset_requests.put(self.env)
+            self.env, obs = self.ready_envs.get()
+            if self.weights is not None:
+                self.env.update_weights(self.weights)
+        else:
+            obs = self.env.reset()
+        latency = time.time() - start
+        stats = self.reset_latency_stats
+        stats[0] += latency
+        stats[1] += 1
+        stats[2] = max(stats[2], latency)
+        return obs
+
+    def get_reset_stats(self):
+        '''
+        returns sum, count and max of the step latencies caused by resets since the last call
+        '''
+        stats = self.reset_latency_stats
+        self.reset_latency_stats = [0.0, 0, 0.0]
+        return stats
 
     def seed(self, seed):
+        self.env_seed = seed
         if hasattr(self.env, 'seed'):
             torch.manual_seed(seed)
             torch.cuda.manual_seed_all(seed)
@@ -51,9 +118,12 @@ class RayWorker:
         self.env.render()
 
     def reset(self):
+        if self.pre_reset_pool > 0 and self.reset_thread is None:
+            # started on the first reset, so the spare envs are seeded after seed()
+            self._start_pre_reset_pool()
         obs = self.env.reset()
         obs = self._obs_to_fp32(obs)
-        return obs
+        return obs, self._get_next_action_mask()
 
     def get_action_mask(self):
         return self.env.get_action_mask()
@@ -65,6 +135,7 @@ class RayWorker:
             return 1
 
     def set_weights(self, weights):
+        self.weights = weights
         self.env.update_weights(weights)
 
     def can_concat_infos(self):
@@ -101,8 +172,11 @@ class RayVecEnv(IVecEnv):
         self.num_actors = num_actors
         self.use_torch = False
         self.seed = kwargs.pop('seed', None)
+        pre_reset_pool = kwargs.pop('pre_reset_pool', 0)
         self.remote_worker = ray.remote(RayWorker)
-        self.workers = [self.remote_worker.remote(self.config_name, kwargs) for i in range(self.num_actors)]
+        self.workers = [self.remote_worker.remote(self.config_name, kwargs, pre_reset_pool) for i in range(self.num_actors)]
+        self.pending_steps = {}
+        self.action_masks = None
 
         if self.seed is not None:
             seeds = range(self.seed, self.seed + self.num_actors)
@@ -128,18 +202,34 @@ class RayVecEnv(IVecEnv):
             self.concat_func = np.concatenate
     
     def step(self, actions):
-        newobs, newstates, newrewards, newdones, newinfos = [], [], [], [], []
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions, env_slice=None):
+        '''
+        sends actions to the envs of env_slice (all envs by default) without waiting for the results,
+        actions only hold the actions of these envs
+        '''
+        if env_slice is None:
+            env_slice = slice(0, self.num_actors)
+        workers = self.workers[env_slice]
         res_obs = []
         if self.num_agents == 1:
-            for (action, worker) in zip(actions, self.workers):	        
+            for (action, worker) in zip(actions, workers):
                 res_obs.append(worker.step.remote(action))
         else:
-            for num, worker in enumerate(self.workers):
+            for num, worker in enumerate(workers):
                 res_obs.append(worker.step.remote(actions[self.num_agents * num: self.num_agents * num + self.num_agents]))
+        self.pending_steps[(env_slice.start, env_slice.stop)] = res_obs
 
+    def step_wait(self, env_slice=None):
+        if env_slice is None:
+            env_slice = slice(0, self.num_actors)
+        res_obs = self.pending_steps.pop((env_slice.start, env_slice.stop))
+        newobs, newstates, newrewards, newdones, newinfos, newmasks = [], [], [], [], [], []
         all_res = ray.get(res_obs)
         for res in all_res:
-            cobs, crewards, cdones, cinfos = res
+            cobs, crewards, cdones, cinfos, cmasks = res
             if self.use_global_obs:
                 newobs.append(cobs["obs"])
                 newstates.append(cobs["state"])
@@ -148,6 +238,8 @@ class RayVecEnv(IVecEnv):
             newrewards.append(crewards)
             newdones.append(cdones)
             newinfos.append(cinfos)
+            newmasks.append(cmasks)
+        self._cache_action_masks(newmasks, env_slice)
 
         if self.obs_type_dict:
             ret_obs = dicts_to_dict_with_arrays(newobs, self.num_agents == 1)
@@ -163,9 +255,14 @@ class RayVecEnv(IVecEnv):
             else:
                 newobsdict["states"] = np.stack(newstates)            
             ret_obs = newobsdict
-        if self.concat_infos:
-            newinfos = dicts_to_dict_with_arrays(newinfos, False)
-        return ret_obs, self.concat_func(newrewards), self.concat_func(newdones), newinfos
+        # columnar infos: dict of arrays stacked over the envs with a done_mask
+        ret_dones = self.concat_func(newdones)
+        if self.concat_infos and len(newinfos) > 1:
+            ret_infos = dicts_to_dict_with_arrays(newinfos, False)
+            ret_infos['done_mask'] = ret_dones.reshape(len(newinfos), -1).all(axis=1)
+        else:
+            ret_infos = infos_to_columns(newinfos, ret_dones)
+        return ret_obs, self.concat_func(newrewards), ret_dones, ret_infos
 
     def get_env_info(self):
         res = self.workers[0].get_env_info.remote()
@@ -180,21 +277,46 @@ class RayVecEnv(IVecEnv):
     def has_action_masks(self):
         return True
 
+    def supports_step_async(self):
+        return True
+
+    def get_env_stats(self):
+        stats = [s for s in ray.get([worker.get_reset_stats.remote() for worker in self.workers]) if s[1] > 0]
+        if len(stats) == 0:
+            return {}
+        num_resets = sum(count for _, count, _ in stats)
+        return {
+            'reset_latency_mean': sum(total for total, _, _ in stats) / num_resets,
+            'reset_latency_max': max(latency_max for _, _, latency_max in stats),
+            'reset_latency_slowest_env': max(total / count for total, count, _ in stats),
+            'resets': num_resets,
+        }
+
+    def _cache_action_masks(self, masks, env_slice):
+        # a partial (ping-pong) step leaves the cache stale, get_action_masks falls back to a remote call
+        if any(m is None for m in masks) or (env_slice.start, env_slice.stop) != (0, self.num_actors):
+            self.action_masks = None
+        else:
+            self.action_masks = np.concatenate(masks, axis=0)
+
     def get_action_masks(self):
+        if self.action_masks is not None:
+            return self.action_masks
         mask = [worker.get_action_mask.remote() for worker in self.workers]
         masks = ray.get(mask)
-        return np.concatenate(masks, axis=0)
+        return np.concatenate(masks, axis=0).astype(bool)
 
     def reset(self):
-        res_obs = [worker.reset.remote() for worker in self.workers]
-        newobs, newstates = [],[]
-        for res in res_obs:
-            cobs = ray.get(res)
+        res_obs = ray.get([worker.reset.remote() for worker in self.workers])
+        newobs, newstates, newmasks = [], [], []
+        for cobs, cmasks in res_obs:
+            newmasks.append(cmasks)
             if self.use_global_obs:
                 newobs.append(cobs["obs"])
                 newstates.append(cobs["state"])
             else:
                 newobs.append(cobs)
+        self._cache_action_masks(newmasks, slice(0, self.num_actors))
 
         if self.obs_type_dict:
             ret_obs = dicts_to_dict_with_arrays(newobs, self.num_agents == 1)
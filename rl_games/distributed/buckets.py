@@ -0,0 +1,77 @@
+import torch
+import torch.distributed as dist
+
+
+class GradientBucketer:
+    '''
+    All-reduces gradients in size bounded buckets while backward is still running.
+    Parameters are put into buckets in reverse registration order, which is roughly the order in which backward
+    produces their gradients. A bucket's async all-reduce is launched once all of its gradients were accumulated
+    and every earlier bucket was launched, so all ranks issue the collectives in the same order.
+    wait() has to be called after backward and before the optimizer (or GradScaler) step, it averages the
+    gradients in place.
+    '''
+    def __init__(self, parameters, world_size, bucket_size_mb=25.0):
+        assert hasattr(torch.Tensor, 'register_post_accumulate_grad_hook'), 'bucketed all-reduce needs torch>=2.1'
+        self.world_size = world_size
+        self.params = [p for p in parameters if p.requires_grad]
+        bucket_cap = int(bucket_size_mb * 1024 * 1024)
+
+        self.buckets = []
+        bucket, bucket_bytes = [], 0
+        for p in reversed(self.params):
+            if len(bucket) > 0 and (bucket_bytes >= bucket_cap or p.dtype != bucket[0].dtype or p.device != bucket[0].device):
+                self.buckets.append(bucket)
+                bucket, bucket_bytes = [], 0
+            bucket.append(p)
+            bucket_bytes += p.numel() * p.element_size()
+        if len(bucket) > 0:
+            self.buckets.append(bucket)
+
+        self.param_to_bucket = {}
+        for i, bucket in enumerate(self.buckets):
+            for p in bucket:
+                self.param_to_bucket[p] = i
+        self.hooks = [p.register_post_accumulate_grad_hook(self._on_grad_ready) for p in self.params]
+        self._reset()
+
+    def _reset(self):
+        self.num_ready = [0] * len(self.buckets)
+        self.next_bucket = 0
+        self.pending = []
+
+    def _on_grad_ready(self, param):
+        i = self.param_to_bucket[param]
+        self.num_ready[i] += 1
+        while self.next_bucket < len(self.buckets) and self.num_ready[self.next_bucket] >= len(self.buckets[self.next_bucket]):
+            self._launch(self.next_bucket)
+            self.next_bucket += 1
+
+    def _launch(self, i):
+        bucket = self.buckets[i]
+        for p in bucket:
+            # parameters which did not take part in the loss still need a slot in the collective
+            if p.grad is None:
+                p.grad = torch.zeros_like(p)
+        flat = torch.cat([p.grad.reshape(-1) for p in bucket])
+        handle = dist.all_reduce(flat, op=dist.ReduceOp.SUM, async_op=True)
+        self.pending.append((i, flat, handle))
+
+    def wait(self):
+        while self.next_bucket < len(self.buckets):
+            self._launch(self.next_bucket)
+            self.next_bucket += 1
+        for i, flat, handle in self.pending:
+            handle.wait()
+            flat /= self.world_size
+            offset = 0
+            for p in self.buckets[i]:
+                n = p.numel()
+                p.grad.copy_(flat[offset:offset + n].view_as(p.grad))
+                offset += n
+        self._reset()
+
+    def remove(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
@@ -0,0 +1,195 @@
+import torch
+import torch.distributed as dist
+
+'''
+Gradient compressors for multi process training over slow links.
+A compressor replaces the fp32 all-reduce of the gradients: all_reduce(grads, world_size) averages the list of
+gradient tensors in place. Every compressor tracks how many bytes it sent compared to an fp32 all-reduce and
+the relative error of the compressed gradients, get_stats() returns both averaged since the last call.
+
+fp16/bf16: gradients are cast before the collective
+topk:      each rank sends the ratio largest entries (values and indices), the rest is kept as error feedback
+powersgd:  rank r approximation P Q^T of every matrix gradient with warm started Q and error feedback,
+           vectors and small tensors are all-reduced uncompressed
+'''
+
+
+class GradientCompressor:
+    def __init__(self):
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.error_sq = None
+        self.norm_sq = None
+
+    def _record(self, raw_bytes, sent_bytes, error_sq, norm_sq):
+        self.raw_bytes += raw_bytes
+        self.sent_bytes += sent_bytes
+        self.error_sq = error_sq if self.error_sq is None else self.error_sq + error_sq
+        self.norm_sq = norm_sq if self.norm_sq is None else self.norm_sq + norm_sq
+
+    def get_stats(self):
+        '''
+        returns compression ratio and relative compression error since the last call
+        '''
+        if self.sent_bytes == 0:
+            return None
+        ratio = self.raw_bytes / self.sent_bytes
+        error = (self.error_sq / self.norm_sq.clamp(min=1e-12)).sqrt().item()
+        self._reset_stats()
+        return ratio, error
+
+    def all_reduce(self, grads, world_size):
+        raise NotImplementedError()
+
+
+def _flatten(grads):
+    return torch.cat([g.reshape(-1) for g in grads])
+
+
+def _unflatten_to(flat, grads):
+    offset = 0
+    for g in grads:
+        n = g.numel()
+        g.copy_(flat[offset:offset + n].view_as(g))
+        offset += n
+
+
+class CastCompressor(GradientCompressor):
+    def __init__(self, dtype):
+        GradientCompressor.__init__(self)
+        self.dtype = dtype
+
+    def all_reduce(self, grads, world_size):
+        # averaging before the cast keeps the fp16 sum from overflowing
+        flat = _flatten(grads).float() / world_size
+        compressed = flat.to(self.dtype)
+        self._record(flat.numel() * 4, compressed.numel() * compressed.element_size(),
+                     (flat - compressed.float()).pow(2).sum(), flat.pow(2).sum())
+        dist.all_reduce(compressed, op=dist.ReduceOp.SUM)
+        _unflatten_to(compressed.float(), grads)
+
+
+class TopKCompressor(GradientCompressor):
+    def __init__(self, ratio=0.01):
+        GradientCompressor.__init__(self)
+        self.ratio = ratio
+        self.residual = None
+
+    def all_reduce(self, grads, world_size):
+        flat = _flatten(grads).float()
+        if self.residual is None:
+            self.residual = torch.zeros_like(flat)
+        accumulated = flat + self.residual
+        k = max(1, int(accumulated.numel() * self.ratio))
+        _, indices = accumulated.abs().topk(k, sorted=False)
+        values = accumulated[indices]
+
+        self.residual = accumulated.clone()
+        self.residual[indices] = 0.0
+        # overflowing (amp) steps must not poison the error feedback
+        self.residual = torch.nan_to_num(self.residual, nan=0.0, posinf=0.0, neginf=0.0)
+        self._record(flat.numel() * 4, k * (values.element_size() + indices.element_size()),
+                     self.residual.pow(2).sum(), accumulated.pow(2).sum())
+
+        all_values = [torch.empty_like(values) for _ in range(world_size)]
+        all_indices = [torch.empty_like(indices) for _ in range(world_size)]
+        dist.all_gather(all_values, values)
+        dist.all_gather(all_indices, indices)
+        result = torch.zeros_like(flat)
+        for v, i in zip(all_values, all_indices):
+            result.index_add_(0, i, v)
+        _unflatten_to(result / world_size, grads)
+
+
+class PowerSGDCompressor(GradientCompressor):
+    def __init__(self, rank=4, min_compression_numel=4096, seed=0):
+        GradientCompressor.__init__(self)
+        self.rank = rank
+        self.min_compression_numel = min_compression_numel
+        self.seed = seed
+        self.qs = {}
+        self.errors = {}
+
+    def _is_compressed(self, g):
+        if g.dim() < 2 or g.numel() < self.min_compression_numel:
+            return False
+        matrix_rank = min(g.shape[0], g.numel() // g.shape[0])
+        return self.rank < matrix_rank
+
+    def _get_q(self, i, m, device):
+        if i not in self.qs:
+            # identical on every rank, Q is warm started from the previous step afterwards
+            generator = torch.Generator().manual_seed(self.seed + i)
+            self.qs[i] = torch.randn((m, self.rank), generator=generator).to(device)
+        return self.qs[i]
+
+    def all_reduce(self, grads, world_size):
+        compressed = [i for i, g in enumerate(grads) if self._is_compressed(g)]
+        uncompressed = [grads[i] for i in range(len(grads)) if not self._is_compressed(grads[i])]
+        raw_bytes = sum(g.numel() for g in grads) * 4
+        sent_numel = sum(g.numel() for g in uncompressed)
+
+        matrices, ps, qs = [], [], []
+        for i in compressed:
+            g = grads[i]
+            matrix = g.reshape(g.shape[0], -1).float()
+            if i in self.errors:
+                matrix = matrix + self.errors[i]
+            q = self._get_q(i, matrix.shape[1], matrix.device)
+            matrices.append(matrix)
+            ps.append(matrix @ q)
+            qs.append(q)
+
+        if len(ps) > 0:
+            flat_p = _flatten(ps)
+            dist.all_reduce(flat_p, op=dist.ReduceOp.SUM)
+            _unflatten_to(flat_p, ps)
+            ps = [torch.linalg.qr(p).Q for p in ps]
+            qs = [matrix.t() @ p for matrix, p in zip(matrices, ps)]
+            flat_q = _flatten(qs) / world_size
+            dist.all_reduce(flat_q, op=dist.ReduceOp.SUM)
+            _unflatten_to(flat_q, qs)
+            sent_numel += flat_p.numel() + flat_q.numel()
+
+        error_sq, norm_sq = 0.0, 0.0
+        for i, matrix, p, q in zip(compressed, matrices, ps, qs):
+            approx = p @ q.t()
+            error = torch.nan_to_num(matrix - approx, nan=0.0, posinf=0.0, neginf=0.0)
+            self.errors[i] = error
+            self.qs[i] = q
+            error_sq = error_sq + error.pow(2).sum()
+            norm_sq = norm_sq + matrix.pow(2).sum()
+            grads[i].copy_(approx.view_as(grads[i]))
+
+        if len(uncompressed) > 0:
+            flat = _flatten(uncompressed)
+            dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+            _unflatten_to(flat / world_size, uncompressed)
+
+        if len(compressed) > 0:
+            self._record(raw_bytes, sent_numel * 4, error_sq, norm_sq)
+        else:
+            device = grads[0].device
+            self._record(raw_bytes, sent_numel * 4, torch.zeros((), device=device), torch.ones((), device=device))
+
+
+def create_compressor(config):
+    '''
+    config: compressor name ('fp16', 'bf16', 'topk', 'powersgd') or a dict with 'type' and its arguments
+    '''
+    if isinstance(config, str):
+        config = {'type': config}
+    config = dict(config)
+    name = config.pop('type')
+    if name == 'fp16':
+        return CastCompressor(torch.float16)
+    if name == 'bf16':
+        return CastCompressor(torch.bfloat16)
+    if name == 'topk':
+        return TopKCompressor(**config)
+    if name == 'powersgd':
+        return PowerSGDCompressor(**config)
+    assert False, 'unknown gradient compression: {}'.format(name)
@@ -0,0 +1,106 @@
+import torch
+import torch.distributed as dist
+
+
+class ParameterAverager:
+    '''
+    Local SGD: every rank trains on its own data without gradient all-reduces, parameters are averaged
+    periodically instead.
+    average() replaces parameters, Adam moments and RunningMeanStd statistics of every rank by their mean over all
+    ranks, with one all-reduce per dtype. The relative drift sqrt(mean_r |w_r - w|^2) / |w| of the parameters from
+    their average is measured in the same collective. Learning rates are not averaged, all ranks take the ones of
+    rank 0, which runs the lr schedule.
+    period: average every period optimizer steps, with 0 only sync() at the end of the epoch averages
+    '''
+    def __init__(self, model, optimizer, world_size, period=0):
+        from rl_games.algos_torch.running_mean_std import RunningMeanStd
+
+        self.model = model
+        self.optimizer = optimizer
+        self.world_size = world_size
+        self.period = period
+        self.params = [p for p in model.parameters() if p.requires_grad]
+        self.normalizers = [m for m in model.modules() if isinstance(m, RunningMeanStd)]
+        self.steps_since_sync = 0
+        self.drifts = []
+
+    def step(self):
+        '''
+        call after every optimizer step
+        '''
+        self.steps_since_sync += 1
+        if self.period > 0 and self.steps_since_sync >= self.period:
+            self.average()
+
+    def sync(self):
+        '''
+        averages if there were optimizer steps since the last average, has to be called on all ranks
+        '''
+        if self.steps_since_sync > 0:
+            self.average()
+
+    def _optimizer_tensors(self):
+        tensors = []
+        for p in self.params:
+            state = self.optimizer.state.get(p, {})
+            for key in ['exp_avg', 'exp_avg_sq']:
+                if key in state:
+                    tensors.append(state[key])
+        return tensors
+
+    @torch.no_grad()
+    def average(self):
+        params = [p.data for p in self.params]
+        device = params[0].device
+        sq_norm = torch.stack([p.float().pow(2).sum() for p in params]).sum().double().reshape(1)
+        lrs = torch.tensor([group['lr'] for group in self.optimizer.param_groups], dtype=torch.float64, device=device)
+        stats = []
+        for m in self.normalizers:
+            stats += [m.running_mean, m.running_var + m.running_mean ** 2, m.count.reshape(1)]
+
+        groups = {}
+        for t in params + self._optimizer_tensors():
+            groups.setdefault(t.dtype, []).append(t)
+        groups.setdefault(torch.float64, []).extend([sq_norm] + stats)
+
+        averaged = {}
+        for dtype, group in groups.items():
+            flat = torch.cat([t.reshape(-1) for t in group])
+            dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+            flat /= self.world_size
+            offset = 0
+            for t in group:
+                n = t.numel()
+                averaged[id(t)] = flat[offset:offset + n].view_as(t)
+                offset += n
+
+        # mean_r |w_r - w|^2 = mean_r |w_r|^2 - |w|^2
+        mean_sq_norm = averaged[id(sq_norm)]
+        for p in params:
+            p.copy_(averaged[id(p)])
+        for t in self._optimizer_tensors():
+            t.copy_(averaged[id(t)])
+        avg_sq_norm = torch.stack([p.float().pow(2).sum() for p in params]).sum().double()
+        drift = (mean_sq_norm - avg_sq_norm).clamp(min=0.0).sqrt() / avg_sq_norm.sqrt().clamp(min=1e-12)
+        self.drifts.append(drift.reshape(()))
+
+        dist.broadcast(lrs, 0)
+        for group, lr in zip(self.optimizer.param_groups, lrs.tolist()):
+            group['lr'] = lr
+        for i, m in enumerate(self.normalizers):
+            mean, sq_mean, count = [averaged[id(t)] for t in stats[3 * i:3 * i + 3]]
+            m.running_mean.copy_(mean)
+            m.running_var.copy_((sq_mean - mean ** 2).clamp(min=0.0))
+            m.count.copy_(count.reshape(()))
+        self.steps_since_sync = 0
+
+    def get_stats(self):
+        '''
+        returns the mean drift and the number of averages since the last call
+        '''
+        if len(self.drifts) == 0:
+            return None
+        drift = torch.stack(self.drifts).mean().item()
+        num_syncs = len(self.drifts)
+        self.drifts = []
+        return drift, num_syncs
@@ -0,0 +1,116 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+'''
+Helpers of the distributed (multi process) training mode, see A2CBase.
+Processes are started with torchrun, which sets RANK, LOCAL_RANK and WORLD_SIZE.
+'''
+
+
+def get_rank():
+    return int(os.getenv('RANK', os.getenv('LOCAL_RANK', '0')))
+
+
+def get_local_rank():
+    return int(os.getenv('LOCAL_RANK', '0'))
+
+
+def get_world_size():
+    return int(os.getenv('WORLD_SIZE', '1'))
+
+
+def get_local_world_size():
+    return int(os.getenv('LOCAL_WORLD_SIZE', os.getenv('WORLD_SIZE', '1')))
+
+
+def get_backend(device):
+    return 'nccl' if torch.device(device).type == 'cuda' else 'gloo'
+
+
+def init_distributed(device, num_threads=None):
+    '''
+    joins the process group, nccl for cuda devices and gloo for cpu
+    returns rank, world size and the device of this process: cuda:<local rank> for cuda devices, cpu otherwise
+    num_threads: intra-op threads of a cpu learner, by default the cores are split between the local ranks
+    '''
+    rank = get_rank()
+    world_size = get_world_size()
+    if torch.device(device).type == 'cuda':
+        device = 'cuda:' + str(get_local_rank())
+        torch.cuda.set_device(device)
+    else:
+        device = 'cpu'
+        if num_threads is None:
+            num_threads = max(1, (os.cpu_count() or 1) // get_local_world_size())
+        torch.set_num_threads(num_threads)
+    if not dist.is_initialized():
+        dist.init_process_group(get_backend(device), rank=rank, world_size=world_size)
+    return rank, world_size, device
+
+
+def split_per_rank(value, world_size, name):
+    assert value % world_size == 0, '{} ({}) must be divisible by the number of processes ({})'.format(name, value, world_size)
+    return value // world_size
+
+
+def broadcast_tensors(tensors, src=0):
+    '''
+    broadcasts tensors in place with one collective per dtype
+    '''
+    groups = {}
+    for t in tensors:
+        groups.setdefault(t.dtype, []).append(t)
+    for dtype, group in groups.items():
+        # gloo has no bool collectives
+        flat = torch.cat([t.reshape(-1) for t in group])
+        if dtype == torch.bool:
+            flat = flat.to(torch.uint8)
+        dist.broadcast(flat, src)
+        offset = 0
+        for t in group:
+            n = t.numel()
+            t.copy_(flat[offset:offset + n].view_as(t))
+            offset += n
+
+
+def broadcast_module(module, src=0):
+    '''
+    makes parameters and buffers (e.g. normalizer statistics) of module equal to the ones of rank src
+    '''
+    with torch.no_grad():
+        broadcast_tensors([t.data for t in module.parameters()] + [t.data for t in module.buffers()], src)
+
+
+def sync_normalizers(module, enabled=True):
+    '''
+    RunningMeanStd layers of module collect the moments of their batches, sync_normalizer_stats combines them over
+    all ranks so normalizers stay identical across ranks
+    '''
+    from rl_games.algos_torch.running_mean_std import RunningMeanStd
+
+    for m in module.modules():
+        if isinstance(m, RunningMeanStd):
+            m.sync_stats = enabled
+
+
+def sync_normalizer_stats(modules):
+    '''
+    combines the batch moments which the synced RunningMeanStd layers of modules collected since the last call over
+    all ranks with one all-reduce, the normalizers are identical on all ranks afterwards.
+    Has to be called on all ranks, within an epoch every rank only updates its statistics with its own batches.
+    '''
+    from rl_games.algos_torch.running_mean_std import RunningMeanStd
+
+    normalizers = [m for module in modules for m in module.modules() if isinstance(m, RunningMeanStd) and m.sync_stats]
+    if len(normalizers) == 0:
+        return
+    moments = [m.pop_moments() for m in normalizers]
+    flat = torch.cat(moments)
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    offset = 0
+    for m, local in zip(normalizers, moments):
+        n = local.numel()
+        m.apply_moments(flat[offset:offset + n])
+        offset += n
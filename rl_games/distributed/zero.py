@@ -0,0 +1,131 @@
+import math
+
+import torch
+import torch.distributed as dist
+
+
+class ZeroRedundancyAdam(torch.optim.Optimizer):
+    '''
+    Adam with optimizer state sharding across ranks (ZeRO stage 1).
+    Parameters and gradients are views into padded flat buffers which are split into one shard per rank.
+    step() reduce-scatters the gradients (all-reduce with gloo), updates the local shard with the Adam moments
+    owned by this rank and all-gathers the updated parameters. Gradients have to be zeroed with zero_grad(), which
+    keeps the flat buffer views alive.
+    max_grad_norm: clips the averaged gradients to this global norm before the update
+    state_dict() returns the full moments on rank dst after consolidate_state_dict(dst), which has to be called
+    on all ranks.
+    '''
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.0, max_grad_norm=None):
+        params = [p for p in params if p.requires_grad]
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        torch.optim.Optimizer.__init__(self, params, defaults)
+        assert len(set((p.dtype, p.device) for p in params)) == 1, 'all parameters need the same dtype and device'
+
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.max_grad_norm = max_grad_norm
+        self.params = params
+        self.numel = sum(p.numel() for p in params)
+        self.shard_size = math.ceil(self.numel / self.world_size)
+        dtype, device = params[0].dtype, params[0].device
+
+        self.flat_param = torch.zeros(self.shard_size * self.world_size, dtype=dtype, device=device)
+        self.flat_grad = torch.zeros_like(self.flat_param)
+        offset = 0
+        for p in params:
+            n = p.numel()
+            self.flat_param[offset:offset + n].copy_(p.data.view(-1))
+            p.data = self.flat_param[offset:offset + n].view_as(p)
+            p.grad = self.flat_grad[offset:offset + n].view_as(p)
+            offset += n
+
+        shard = slice(self.rank * self.shard_size, (self.rank + 1) * self.shard_size)
+        self.param_shard = self.flat_param[shard]
+        self.grad_shard = self.flat_grad[shard]
+        self.exp_avg = torch.zeros_like(self.param_shard)
+        self.exp_avg_sq = torch.zeros_like(self.param_shard)
+        self.num_steps = 0
+        self.consolidated = None
+        self.use_reduce_scatter = dist.get_backend() == 'nccl'
+
+    def zero_grad(self, set_to_none=False):
+        self.flat_grad.zero_()
+
+    def _reduce_scatter_grads(self):
+        if self.use_reduce_scatter:
+            reduced = torch.empty_like(self.grad_shard)
+            dist.reduce_scatter_tensor(reduced, self.flat_grad, op=dist.ReduceOp.SUM)
+            self.grad_shard.copy_(reduced)
+        else:
+            dist.all_reduce(self.flat_grad, op=dist.ReduceOp.SUM)
+        self.grad_shard /= self.world_size
+
+    def _all_gather_params(self):
+        dist.all_gather(list(self.flat_param.chunk(self.world_size)), self.param_shard.clone())
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        self._reduce_scatter_grads()
+        grad = self.grad_shard
+        if self.max_grad_norm is not None:
+            norm_sq = grad.float().pow(2).sum()
+            dist.all_reduce(norm_sq, op=dist.ReduceOp.SUM)
+            clip_coef = (self.max_grad_norm / (norm_sq.sqrt() + 1e-6)).clamp(max=1.0)
+            grad.mul_(clip_coef.to(grad.dtype))
+
+        group = self.param_groups[0]
+        lr, eps, weight_decay = group['lr'], group['eps'], group['weight_decay']
+        beta1, beta2 = group['betas']
+        self.num_steps += 1
+        if weight_decay != 0:
+            grad = grad.add(self.param_shard, alpha=weight_decay)
+        self.exp_avg.lerp_(grad, 1 - beta1)
+        self.exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        bias_correction1 = 1 - beta1 ** self.num_steps
+        bias_correction2 = 1 - beta2 ** self.num_steps
+        denom = (self.exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
+        self.param_shard.addcdiv_(self.exp_avg, denom, value=-lr / bias_correction1)
+
+        self._all_gather_params()
+        return loss
+
+    def consolidate_state_dict(self, dst=0):
+        '''
+        gathers the moments of all shards, must be called on every rank
+        '''
+        moments = torch.stack([self.exp_avg, self.exp_avg_sq])
+        gathered = [torch.empty_like(moments) for _ in range(self.world_size)]
+        dist.all_gather(gathered, moments)
+        if self.rank == dst:
+            full = torch.cat(gathered, dim=1)[:, :self.numel]
+            self.consolidated = {'exp_avg': full[0].cpu(), 'exp_avg_sq': full[1].cpu()}
+
+    def state_dict(self):
+        assert self.consolidated is not None, 'call consolidate_state_dict on all ranks first'
+        return {
+            'zero_redundancy': True,
+            'step': self.num_steps,
+            'exp_avg': self.consolidated['exp_avg'],
+            'exp_avg_sq': self.consolidated['exp_avg_sq'],
+            'param_groups': [{k: v for k, v in group.items() if k != 'params'} for group in self.param_groups],
+        }
+
+    def load_state_dict(self, state_dict):
+        '''
+        loads a state saved by a ZeroRedundancyAdam with any number of ranks
+        '''
+        assert state_dict.get('zero_redundancy', False), 'checkpoint optimizer state was not saved by ZeroRedundancyAdam'
+        self.num_steps = state_dict['step']
+        shard = slice(self.rank * self.shard_size, min((self.rank + 1) * self.shard_size, self.numel))
+        num_valid = max(0, shard.stop - shard.start)
+        self.exp_avg.zero_()
+        self.exp_avg_sq.zero_()
+        self.exp_avg[:num_valid].copy_(state_dict['exp_avg'][shard])
+        self.exp_avg_sq[:num_valid].copy_(state_dict['exp_avg_sq'][shard])
+        for group, saved in zip(self.param_groups, state_dict['param_groups']):
+            group.update(saved)
@@ -41,6 +41,8 @@ class BraxEnv(IVecEnv):
         next_obs = jax_to_torch(next_obs)
         reward = jax_to_torch(reward)
         is_done = jax_to_torch(is_done)
+        info = dict(info)
+        info['done_mask'] = is_done.bool()
         return next_obs, reward, is_done, info
 
     def reset(self):
@@ -50,6 +50,7 @@ class Envpool(IVecEnv):
     def step(self, action):
         next_obs, reward, is_done, info = self.env.step(action , self.ids)
         info['time_outs'] = info['TimeLimit.truncated']
+        info['done_mask'] = (info['lives'] == 0) if self.has_lives else is_done.astype(bool)
         self._set_scores(info, is_done)
         if self.use_dict_obs_space:
             next_obs = {
@@ -16,6 +16,7 @@ from rl_games.algos_torch import model_builder
 from rl_games.algos_torch import a2c_continuous
 from rl_games.algos_torch import a2c_discrete
 from rl_games.algos_torch import dapg_agent
+from rl_games.algos_torch import impala
 from rl_games.algos_torch import players
 from rl_games.common.algo_observer import DefaultAlgoObserver
 from rl_games.algos_torch import sac_agent
@@ -41,6 +42,8 @@ class Runner:
         self.algo_factory.register_builder('a2c_discrete', lambda **kwargs : a2c_discrete.DiscreteA2CAgent(**kwargs)) 
         self.algo_factory.register_builder('sac', lambda **kwargs: sac_agent.SACAgent(**kwargs))
         self.algo_factory.register_builder('dapg', lambda **kwargs:dapg_agent.DAPGAgent(**kwargs))
+        self.algo_factory.register_builder('impala_continuous', lambda **kwargs : impala.ImpalaAgent(**kwargs))
+        self.algo_factory.register_builder('impala_discrete', lambda **kwargs : impala.ImpalaDiscreteAgent(**kwargs))
         #self.algo_factory.register_builder('dqn', lambda **kwargs : dqnagent.DQNAgent(**kwargs))
 
         self.player_factory = object_factory.ObjectFactory()
@@ -48,6 +51,8 @@ class Runner:
         self.player_factory.register_builder('a2c_discrete', lambda **kwargs : players.PpoPlayerDiscrete(**kwargs))
         self.player_factory.register_builder('sac', lambda **kwargs : players.SACPlayer(**kwargs))
         self.player_factory.register_builder('dapg', lambda **kwargs: players.PpoPlayerContinuous(**kwargs))
+        self.player_factory.register_builder('impala_continuous', lambda **kwargs : players.PpoPlayerContinuous(**kwargs))
+        self.player_factory.register_builder('impala_discrete', lambda **kwargs : players.PpoPlayerDiscrete(**kwargs))
         #self.player_factory.register_builder('dqn', lambda **kwargs : players.DQNPlayer(**kwargs))
 
         self.algo_observer = algo_observer if algo_observer else DefaultAlgoObserver()
@@ -63,7 +68,9 @@ class Runner:
         if self.seed is None:
             self.seed = int(time.time())
         
-        if params["config"].get('multi_gpu', False):
+        is_distributed = params["config"].get('distributed', False)
+        base_seed = self.seed
+        if params["config"].get('multi_gpu', False) or is_distributed:
             self.seed += int(os.getenv("LOCAL_RANK", "0"))
         print(f"self.seed = {self.seed}")
 
@@ -79,11 +86,17 @@ class Runner:
             
             # deal with environment specific seed if applicable
             if 'env_config' in params['config']:
-                if not 'seed' in params['config']['env_config']:
-                    params['config']['env_config']['seed'] = self.seed
+                env_config = params['config']['env_config']
+                if is_distributed:
+                    # envs of different ranks get disjoint seed ranges, num_actors is the global number of actors
+                    num_actors_per_rank = params['config']['num_actors'] // int(os.getenv("WORLD_SIZE", "1"))
+                    rank = int(os.getenv("RANK", os.getenv("LOCAL_RANK", "0")))
+                    env_config['seed'] = env_config.get('seed', base_seed) + rank * num_actors_per_rank
+                elif not 'seed' in env_config:
+                    env_config['seed'] = self.seed
                 else:
                     if params["config"].get('multi_gpu', False):
-                        params['config']['env_config']['seed'] += int(os.getenv("LOCAL_RANK", "0"))
+                        env_config['seed'] += int(os.getenv("LOCAL_RANK", "0"))
 
         config = params['config']
         config['reward_shaper'] = tr_helpers.DefaultRewardsShaper(**config['reward_shaper'])
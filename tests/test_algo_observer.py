@@ -0,0 +1,89 @@
+import types
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from rl_games.common import tr_helpers
+from rl_games.common.algo_observer import DefaultAlgoObserver
+
+
+def _observer(games_to_track=10):
+    observer = DefaultAlgoObserver()
+    observer.after_init(types.SimpleNamespace(games_to_track=games_to_track, ppo_device='cpu', writer=None))
+    update_calls = []
+    update_mean = observer.game_scores.update_mean
+
+    def counting_update_mean(new_mean, size):
+        update_calls.append(size)
+        update_mean(new_mean, size)
+
+    observer.game_scores.update_mean = counting_update_mean
+    return observer, update_calls
+
+
+def test_infos_to_columns_zero_fills_missing_keys():
+    infos = [{'scores': 3.0, 'pos': [1.0, 2.0]}, {}, {'scores': 5.0, 'pos': [3.0, 4.0]}]
+    columns = tr_helpers.infos_to_columns(infos, [True, False, True])
+    np.testing.assert_array_equal(columns['scores'], [3.0, 0.0, 5.0])
+    np.testing.assert_array_equal(columns['pos'], [[1.0, 2.0], [0.0, 0.0], [3.0, 4.0]])
+    np.testing.assert_array_equal(columns['done_mask'], [True, False, True])
+
+
+def test_infos_to_columns_drops_non_numeric_keys():
+    infos = [{'name': 'a', 'ragged': [1.0], 'flag': True, 'steps': 1},
+             {'name': 'b', 'ragged': [1.0, 2.0], 'flag': False, 'steps': 2}]
+    columns = tr_helpers.infos_to_columns(infos, [False, False])
+    assert set(columns) == {'flag', 'steps', 'done_mask'}
+    np.testing.assert_array_equal(columns['flag'], [True, False])
+    np.testing.assert_array_equal(columns['steps'], [1, 2])
+
+
+def test_infos_to_columns_done_mask_multi_agent():
+    # 3 envs with 2 agents each, an env is done when all of its agents are done
+    dones = np.array([True, True, True, False, False, False])
+    columns = tr_helpers.infos_to_columns([{}, {}, {}], dones)
+    np.testing.assert_array_equal(columns['done_mask'], [True, False, False])
+
+
+def test_observer_reduces_columnar_scores_once_per_after_steps():
+    observer, update_calls = _observer()
+    observer.process_infos({'scores': np.array([1.0, 2.0, 3.0]), 'done_mask': np.array([True, False, True])},
+                           torch.tensor([0, 2]))
+    observer.process_infos({'scores': np.array([5.0, 0.0, 0.0]), 'done_mask': np.array([True, False, False])},
+                           torch.tensor([0]))
+    assert update_calls == []
+
+    observer.after_steps()
+    assert update_calls == [3]
+    assert observer.game_scores.get_mean() == pytest.approx(3.0)
+
+    # nothing finished, no update
+    observer.process_infos({'scores': np.array([7.0, 7.0, 7.0]), 'done_mask': np.zeros(3, dtype=bool)},
+                           torch.tensor([], dtype=torch.long))
+    observer.after_steps()
+    assert update_calls == [3]
+    assert len(observer.game_scores) == 3
+
+
+def test_observer_list_of_dicts_fallback():
+    observer, update_calls = _observer()
+    # only finished envs report a score, the others are zero filled and masked by done_indices
+    observer.process_infos([{'scores': 4.0}, {}, {'scores': 9.0}], torch.tensor([[0], [2]]))
+    observer.process_infos([{}, {'scores': 2.0}, {'scores': 1.0}], torch.tensor([[1]]))
+    observer.process_infos([{'other': 1.0}, {}, {}], torch.tensor([[0]]))
+    assert update_calls == []
+
+    observer.after_steps()
+    assert update_calls == [3]
+    assert observer.game_scores.get_mean() == pytest.approx(5.0)
+
+
+def test_observer_clear_stats_drops_pending_scores():
+    observer, update_calls = _observer()
+    observer.process_infos({'scores': np.array([1.0, 2.0]), 'done_mask': np.array([True, True])}, torch.tensor([0, 1]))
+    observer.after_clear_stats()
+    observer.after_steps()
+    assert update_calls == []
+    assert len(observer.game_scores) == 0
@@ -0,0 +1,67 @@
+import time
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from rl_games.common.categorical import CategoricalQ
+
+
+def _random_inputs(batch_size, n_atoms, done_prob=0.3, seed=0):
+    rng = np.random.RandomState(seed)
+    next_distr = rng.uniform(size=(batch_size, n_atoms)).astype(np.float32)
+    next_distr /= next_distr.sum(axis=1, keepdims=True)
+    rewards = rng.uniform(-3.0, 3.0, size=batch_size).astype(np.float32)
+    dones = rng.uniform(size=batch_size) < done_prob
+    return next_distr, rewards, dones
+
+
+@pytest.mark.parametrize('gamma', [0.99, 0.5])
+@pytest.mark.parametrize('done_prob', [0.0, 0.3, 1.0])
+def test_projection_matches_numpy(gamma, done_prob):
+    categorical = CategoricalQ(51, -10.0, 10.0)
+    next_distr, rewards, dones = _random_inputs(256, 51, done_prob)
+    expected = categorical.distr_projection(next_distr, rewards, dones, gamma)
+    result = categorical.distr_projection_torch(next_distr, rewards, dones, gamma).numpy()
+    np.testing.assert_allclose(result, expected, atol=1e-5)
+    np.testing.assert_allclose(result.sum(axis=1), 1.0, atol=1e-5)
+
+
+def test_projection_exact_atoms_and_clipping():
+    # gamma 1 with integer rewards lands exactly on atoms, large rewards are clipped to the support
+    categorical = CategoricalQ(11, -5.0, 5.0)
+    next_distr, _, _ = _random_inputs(6, 11)
+    rewards = np.array([0.0, 1.0, -2.0, 100.0, -100.0, 3.0], dtype=np.float32)
+    dones = np.array([False, True, False, True, False, True])
+    expected = categorical.distr_projection(next_distr, rewards, dones, 1.0)
+    result = categorical.distr_projection_torch(torch.from_numpy(next_distr), torch.from_numpy(rewards),
+                                                torch.from_numpy(dones), 1.0).numpy()
+    np.testing.assert_allclose(result, expected, atol=1e-5)
+
+
+def benchmark(batch_size=4096, n_atoms=51, iterations=20):
+    categorical = CategoricalQ(n_atoms, -10.0, 10.0)
+    next_distr, rewards, dones = _random_inputs(batch_size, n_atoms)
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        categorical.distr_projection(next_distr, rewards, dones, 0.99)
+    print('numpy loop: {:.3f} ms'.format((time.perf_counter() - start) / iterations * 1000.0))
+
+    for device in devices:
+        inputs = [torch.from_numpy(x).to(device) for x in (next_distr, rewards, dones)]
+        categorical.distr_projection_torch(*inputs, 0.99)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            categorical.distr_projection_torch(*inputs, 0.99)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        print('torch {}: {:.3f} ms'.format(device, (time.perf_counter() - start) / iterations * 1000.0))
+
+
+if __name__ == '__main__':
+    benchmark()
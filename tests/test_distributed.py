@@ -0,0 +1,223 @@
+import copy
+import os
+import socket
+
+import pytest
+
+torch = pytest.importorskip('torch')
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+from rl_games.algos_torch import torch_ext
+from rl_games.algos_torch.running_mean_std import RunningMeanStd
+from rl_games.distributed import utils as distributed_utils
+from rl_games.distributed.buckets import GradientBucketer
+from rl_games.distributed.compression import create_compressor
+from rl_games.distributed.local_sgd import ParameterAverager
+
+WORLD_SIZE = 2
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _init_process(rank, port):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    os.environ['RANK'] = str(rank)
+    os.environ['LOCAL_RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = str(WORLD_SIZE)
+    return distributed_utils.init_distributed('cpu', num_threads=1)
+
+
+def _assert_same_on_all_ranks(tensor):
+    gathered = [torch.empty_like(tensor) for _ in range(WORLD_SIZE)]
+    dist.all_gather(gathered, tensor)
+    for other in gathered[1:]:
+        assert torch.equal(gathered[0], other)
+
+
+class Model(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.running_mean_std = RunningMeanStd((8,))
+        self.mlp = nn.Sequential(nn.Linear(8, 32), nn.ELU(), nn.Linear(32, 4))
+
+    def forward(self, x):
+        return self.mlp(self.running_mean_std(x))
+
+
+def _data_parallel_worker(rank, port):
+    _, _, device = _init_process(rank, port)
+    assert device == 'cpu'
+    # different initial weights and data on every rank
+    torch.manual_seed(rank)
+    model = Model()
+    distributed_utils.broadcast_module(model)
+    distributed_utils.sync_normalizers(model)
+    for p in list(model.parameters()) + list(model.buffers()):
+        _assert_same_on_all_ranks(p.detach())
+
+    flat_params = torch_ext.FlatParameters(model.parameters())
+    optimizer = torch.optim.Adam(model.parameters(), 1e-3)
+    for _ in range(3):
+        x = torch.randn(64, 8) * (rank + 1) + rank
+        flat_params.zero_grad()
+        model(x).pow(2).mean().backward()
+        flat_params.all_reduce(WORLD_SIZE)
+        for p in model.parameters():
+            _assert_same_on_all_ranks(p.grad)
+        optimizer.step()
+
+    distributed_utils.sync_normalizer_stats([model])
+    for p in list(model.parameters()) + list(model.buffers()):
+        _assert_same_on_all_ranks(p.detach())
+    # statistics cover the batches of both ranks
+    assert model.running_mean_std.count.item() == pytest.approx(1.0 + 3 * 64 * WORLD_SIZE)
+    dist.destroy_process_group()
+
+
+def test_gloo_data_parallel_keeps_ranks_identical():
+    mp.spawn(_data_parallel_worker, args=(_free_port(),), nprocs=WORLD_SIZE, join=True)
+
+
+def _bucketed_allreduce_worker(rank, port):
+    _init_process(rank, port)
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(8, 64), nn.ELU(), nn.Linear(64, 64), nn.ELU(), nn.Linear(64, 4), nn.Linear(4, 4))
+    model[-1].requires_grad_(False)
+    reference = copy.deepcopy(model)
+    # tiny buckets, so the gradients are spread over several collectives
+    bucketer = GradientBucketer(model.parameters(), WORLD_SIZE, bucket_size_mb=0.005)
+    assert len(bucketer.buckets) > 2
+    scaler = torch.cuda.amp.GradScaler(enabled=False)
+
+    for step in range(2):
+        torch.manual_seed(10 * step + rank)
+        x = torch.randn(32, 8)
+        model.zero_grad(set_to_none=True)
+        scaler.scale(model(x).pow(2).mean()).backward()
+        bucketer.wait()
+
+        reference.zero_grad(set_to_none=True)
+        reference(x).pow(2).mean().backward()
+        for p, ref in zip(model.parameters(), reference.parameters()):
+            if not p.requires_grad:
+                continue
+            dist.all_reduce(ref.grad)
+            ref.grad /= WORLD_SIZE
+            assert torch.allclose(p.grad, ref.grad, atol=1e-6)
+            _assert_same_on_all_ranks(p.grad)
+    bucketer.remove()
+    dist.destroy_process_group()
+
+
+def test_gloo_bucketed_allreduce_matches_flat_allreduce():
+    if not hasattr(torch.Tensor, 'register_post_accumulate_grad_hook'):
+        pytest.skip('needs torch>=2.1')
+    mp.spawn(_bucketed_allreduce_worker, args=(_free_port(),), nprocs=WORLD_SIZE, join=True)
+
+
+def _local_sgd_worker(rank, port):
+    _init_process(rank, port)
+    # ranks train independently and drift apart
+    torch.manual_seed(rank)
+    model = Model()
+    optimizer = torch.optim.Adam(model.parameters(), 1e-3 * (rank + 1))
+    averager = ParameterAverager(model, optimizer, WORLD_SIZE, period=2)
+    for _ in range(3):
+        x = torch.randn(64, 8) * (rank + 1) + rank
+        optimizer.zero_grad()
+        model(x).pow(2).mean().backward()
+        optimizer.step()
+        averager.step()
+    assert averager.steps_since_sync == 1
+    expected = [p.detach().clone() for p in model.parameters()]
+    for p in expected:
+        dist.all_reduce(p)
+        p /= WORLD_SIZE
+    averager.sync()
+
+    for p, ref in zip(model.parameters(), expected):
+        assert torch.allclose(p, ref, atol=1e-6)
+    for t in list(model.parameters()) + list(model.buffers()) + averager._optimizer_tensors():
+        _assert_same_on_all_ranks(t.detach())
+    # learning rates are taken from rank 0
+    assert optimizer.param_groups[0]['lr'] == 1e-3
+    drift, num_syncs = averager.get_stats()
+    assert num_syncs == 2 and drift > 0.0
+    dist.destroy_process_group()
+
+
+def test_gloo_local_sgd_averages_parameters_and_state():
+    mp.spawn(_local_sgd_worker, args=(_free_port(),), nprocs=WORLD_SIZE, join=True)
+
+
+def _local_sgd_lr_worker(rank, port):
+    _init_process(rank, port)
+    torch.manual_seed(0)
+    model = Model()
+    optimizer = torch.optim.Adam(model.parameters(), 1e-3)
+    averager = ParameterAverager(model, optimizer, WORLD_SIZE)
+    for epoch in range(3):
+        x = torch.randn(64, 8) + rank
+        optimizer.zero_grad()
+        model(x).pow(2).mean().backward()
+        optimizer.step()
+        averager.step()
+        # only rank 0 runs the schedule
+        if rank == 0:
+            optimizer.param_groups[0]['lr'] = 1e-3 * 0.7 ** (epoch + 1)
+        averager.sync()
+        assert optimizer.param_groups[0]['lr'] == 1e-3 * 0.7 ** (epoch + 1)
+    dist.destroy_process_group()
+
+
+def test_gloo_local_sgd_takes_the_learning_rate_of_rank_0():
+    mp.spawn(_local_sgd_lr_worker, args=(_free_port(),), nprocs=WORLD_SIZE, join=True)
+
+
+def _compression_worker(rank, port):
+    _init_process(rank, port)
+    torch.manual_seed(rank)
+    # a rank one matrix per rank, so the averaged matrix has rank 2 and PowerSGD with rank 4 is exact
+    grads = [torch.randn(64, 1) @ torch.randn(1, 32), torch.randn(32)]
+    expected = [g.clone() for g in grads]
+    for g in expected:
+        dist.all_reduce(g)
+        g /= WORLD_SIZE
+
+    configs = [('fp16', 2e-2), ('bf16', 2e-2), ({'type': 'topk', 'ratio': 1.0}, 1e-6),
+               ({'type': 'powersgd', 'rank': 4, 'min_compression_numel': 0}, 1e-4)]
+    for config, tolerance in configs:
+        compressor = create_compressor(config)
+        result = [g.clone() for g in grads]
+        compressor.all_reduce(result, WORLD_SIZE)
+        for r, e in zip(result, expected):
+            assert torch.allclose(r, e, rtol=tolerance, atol=tolerance)
+            _assert_same_on_all_ranks(r)
+        ratio, error = compressor.get_stats()
+        if config == 'fp16':
+            assert ratio == pytest.approx(2.0) and error < 1e-2
+        if isinstance(config, dict) and config['type'] == 'powersgd':
+            # the error feedback of PowerSGD is the difference between the local and the averaged gradient
+            assert ratio > 1.0
+
+    # top-k sends the largest entries and keeps the rest as error feedback
+    compressor = create_compressor({'type': 'topk', 'ratio': 0.1})
+    result = [g.clone() for g in grads]
+    compressor.all_reduce(result, WORLD_SIZE)
+    sent = torch.cat([g.reshape(-1) for g in grads]) - compressor.residual
+    assert (compressor.residual != 0).sum() <= sent.numel() - int(sent.numel() * 0.1)
+    dist.all_reduce(sent)
+    sent /= WORLD_SIZE
+    assert torch.allclose(torch.cat([r.reshape(-1) for r in result]), sent, atol=1e-6)
+    dist.destroy_process_group()
+
+
+def test_gloo_gradient_compression():
+    mp.spawn(_compression_worker, args=(_free_port(),), nprocs=WORLD_SIZE, join=True)
@@ -0,0 +1,70 @@
+import math
+import types
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('ray')
+
+from rl_games.algos_torch.impala import ImpalaMixin
+
+
+def _vtrace_params(horizon_length, gamma, vtrace_lambda, rho_clip=1.0, c_clip=1.0):
+    return types.SimpleNamespace(horizon_length=horizon_length, gamma=gamma, vtrace_lambda=vtrace_lambda,
+                                 rho_clip=rho_clip, c_clip=c_clip)
+
+
+def _gae(values, last_values, rewards, dones, last_dones, gamma, tau):
+    advantages = torch.zeros_like(values)
+    last_gae_lam = torch.zeros_like(last_values)
+    horizon_length = values.size(0)
+    for t in reversed(range(horizon_length)):
+        if t == horizon_length - 1:
+            next_nonterminal = 1.0 - last_dones.float().unsqueeze(1)
+            next_values = last_values
+        else:
+            next_nonterminal = 1.0 - dones[t + 1].float().unsqueeze(1)
+            next_values = values[t + 1]
+        delta = rewards[t] + gamma * next_values * next_nonterminal - values[t]
+        last_gae_lam = delta + gamma * tau * next_nonterminal * last_gae_lam
+        advantages[t] = last_gae_lam
+    return advantages
+
+
+def test_vtrace_hand_computed_with_episode_end():
+    # one env, the episode ends after step 1 (dones marks the first observation of the next episode)
+    values = torch.tensor([1.0, 2.0, 3.0]).view(3, 1, 1)
+    last_values = torch.tensor([[4.0]])
+    rewards = torch.ones(3, 1, 1)
+    dones = torch.tensor([0, 0, 1], dtype=torch.uint8).view(3, 1)
+    last_dones = torch.tensor([0], dtype=torch.uint8)
+    # rho = 2 is truncated to 1
+    log_rhos = torch.tensor([math.log(2.0), math.log(0.5), 0.0]).view(3, 1)
+
+    vs, advantages = ImpalaMixin.vtrace(_vtrace_params(3, 0.5, 1.0), values, last_values, rewards, dones, last_dones, log_rhos)
+    # t = 2: delta = 1 + 0.5 * 4 - 3 = 0
+    # t = 1: terminal, delta = 0.5 * (1 - 2) = -0.5
+    # t = 0: delta = 1 + 0.5 * 2 - 1 = 1, vs - V = 1 + 0.5 * 1 * (-0.5) = 0.75
+    assert torch.allclose(vs.view(-1), torch.tensor([1.75, 1.5, 3.0]))
+    assert torch.allclose(advantages.view(-1), torch.tensor([1.0 + 0.5 * 1.5 - 1.0, -0.5, 0.0]))
+
+
+def test_on_policy_vtrace_equals_gae():
+    torch.manual_seed(0)
+    horizon_length, num_envs, gamma, tau = 8, 4, 0.99, 0.95
+    values = torch.randn(horizon_length, num_envs, 1)
+    last_values = torch.randn(num_envs, 1)
+    rewards = torch.randn(horizon_length, num_envs, 1)
+    dones = (torch.rand(horizon_length, num_envs) < 0.2).to(torch.uint8)
+    last_dones = (torch.rand(num_envs) < 0.2).to(torch.uint8)
+    log_rhos = torch.zeros(horizon_length, num_envs)
+
+    vs, advantages = ImpalaMixin.vtrace(_vtrace_params(horizon_length, gamma, tau), values, last_values, rewards,
+                                        dones, last_dones, log_rhos)
+    gae_advantages = _gae(values, last_values, rewards, dones, last_dones, gamma, tau)
+    assert torch.allclose(vs, values + gae_advantages, atol=1e-5)
+
+    # with lambda = 1 the policy gradient advantages are the GAE(1) advantages
+    vs, advantages = ImpalaMixin.vtrace(_vtrace_params(horizon_length, gamma, 1.0), values, last_values, rewards,
+                                        dones, last_dones, log_rhos)
+    assert torch.allclose(advantages, _gae(values, last_values, rewards, dones, last_dones, gamma, 1.0), atol=1e-5)
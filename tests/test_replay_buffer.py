@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+gym = pytest.importorskip('gym')
+
+from rl_games.common.experience import ReplayBuffer
+
+
+def _filled_buffer(size, num_transitions, n_step, gamma, done_every=7):
+    buffer = ReplayBuffer(size, gym.spaces.Box(low=-np.inf, high=np.inf, shape=(1,)), n_step=n_step, gamma=gamma)
+    for t in range(num_transitions):
+        buffer.add([t], 0, float(t + 1), [t + 1], t % done_every == done_every - 1)
+    return buffer
+
+
+def _reference_n_step(buffer, idx, n_step, gamma):
+    '''
+    walks the ring from idx and stops at a done or at the newest transition
+    '''
+    newest = (buffer._next_idx - 1) % buffer._maxsize
+    reward, done, j = 0.0, False, idx
+    for k in range(n_step):
+        j = (idx + k) % buffer._maxsize
+        reward += gamma ** k * buffer._rewards[j]
+        if buffer._dones[j]:
+            done = True
+            break
+        if j == newest:
+            break
+    return reward, buffer._next_obses[j], done, gamma ** (k + 1)
+
+
+@pytest.mark.parametrize('num_transitions', [6, 10, 23])
+def test_n_step_matches_reference(num_transitions):
+    size, n_step, gamma = 10, 3, 0.9
+    buffer = _filled_buffer(size, num_transitions, n_step, gamma)
+    idxes = np.arange(len(buffer))
+    _, _, rewards, next_obses, dones, discounts = buffer._encode_sample(idxes)
+    for i, idx in enumerate(idxes):
+        reward, next_obs, done, discount = _reference_n_step(buffer, idx, n_step, gamma)
+        assert rewards[i] == pytest.approx(reward)
+        np.testing.assert_array_equal(next_obses[i], next_obs)
+        assert dones[i] == done
+        assert discounts[i] == pytest.approx(discount)
+
+
+def test_n_step_stops_at_episode_end_and_write_head():
+    gamma = 0.5
+    # 23 transitions in a ring of 10: slots hold t = 20, 21, 22, 13, ..., 19 and t = 20 ends an episode
+    buffer = _filled_buffer(10, 23, 3, gamma)
+    _, _, rewards, next_obses, dones, discounts = buffer._encode_sample([9, 2, 8])
+
+    # t = 19, 20 with the episode end at t = 20, across the end of the array
+    assert rewards[0] == pytest.approx(20 + gamma * 21)
+    assert next_obses[0][0] == 21 and dones[0] and discounts[0] == pytest.approx(gamma ** 2)
+    # t = 22 is the newest transition, the window must not continue into t = 13
+    assert rewards[1] == pytest.approx(23)
+    assert next_obses[1][0] == 23 and not dones[1] and discounts[1] == pytest.approx(gamma)
+    # t = 18, 19, 20 is a full window ending on the episode end
+    assert rewards[2] == pytest.approx(19 + gamma * 20 + gamma ** 2 * 21)
+    assert next_obses[2][0] == 21 and dones[2] and discounts[2] == pytest.approx(gamma ** 3)
+
+
+def test_one_step_sample_is_unchanged():
+    buffer = _filled_buffer(10, 23, 1, 0.9)
+    obs, _, rewards, next_obs, dones = buffer._encode_sample([4])
+    assert obs[0][0] == 14 and rewards[0] == 15 and next_obs[0][0] == 15 and not dones[0]
@@ -0,0 +1,62 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+import torch.nn as nn
+
+from rl_games.algos_torch.network_builder import DoubleQCritic, EnsembleLinear, EnsembleQCritic
+from rl_games.algos_torch.sac_helper import ensemble_min
+
+OBS_DIM, ACTION_DIM, UNITS = 5, 3, [16, 16]
+
+
+def _mlp_args():
+    return {'input_size': OBS_DIM + ACTION_DIM, 'units': UNITS, 'activation': 'relu', 'dense_func': nn.Linear,
+            'norm_func_name': None, 'norm_only_first_layer': False, 'd2rl': False}
+
+
+def _ensemble_from_double_q(double_q):
+    ensemble = EnsembleQCritic(1, 2, **_mlp_args())
+    ensemble_layers = [m for m in ensemble.Q if isinstance(m, EnsembleLinear)]
+    for i, q in enumerate([double_q.Q1, double_q.Q2]):
+        linear_layers = [m for m in q if isinstance(m, nn.Linear)]
+        assert len(linear_layers) == len(ensemble_layers)
+        with torch.no_grad():
+            for linear, ensemble_layer in zip(linear_layers, ensemble_layers):
+                ensemble_layer.weight[i].copy_(linear.weight)
+                ensemble_layer.bias[i, 0].copy_(linear.bias)
+    return ensemble
+
+
+def test_two_member_ensemble_matches_double_q():
+    torch.manual_seed(0)
+    double_q = DoubleQCritic(1, **_mlp_args())
+    ensemble = _ensemble_from_double_q(double_q)
+    obs, action = torch.randn(32, OBS_DIM), torch.randn(32, ACTION_DIM)
+
+    q1, q2 = double_q(obs, action)
+    qs = ensemble(obs, action)
+    assert qs.shape == (2, 32, 1)
+    assert torch.allclose(qs[0], q1, atol=1e-5)
+    assert torch.allclose(qs[1], q2, atol=1e-5)
+
+    # twin critic target and per critic losses
+    assert torch.allclose(ensemble_min(qs), torch.min(q1, q2), atol=1e-5)
+    assert torch.allclose(ensemble_min(qs, subset_size=2), torch.min(q1, q2), atol=1e-5)
+    target = torch.randn(32, 1)
+    losses = nn.MSELoss(reduction='none')(qs, target.unsqueeze(0).expand_as(qs)).mean(dim=(1, 2))
+    assert torch.allclose(losses[0], nn.MSELoss()(q1, target), atol=1e-5)
+    assert torch.allclose(losses[1], nn.MSELoss()(q2, target), atol=1e-5)
+
+
+def test_ensemble_min_over_random_subset():
+    torch.manual_seed(1)
+    qs = torch.randn(10, 64, 1)
+    assert torch.equal(ensemble_min(qs), qs.min(dim=0)[0])
+    subset_min = ensemble_min(qs, subset_size=2)
+    assert subset_min.shape == (64, 1)
+    # the minimum over a subset is one of the member values and never below the full minimum
+    assert (subset_min >= qs.min(dim=0)[0]).all()
+    assert (qs == subset_min.unsqueeze(0)).any(dim=0).all()
+    # the same subset of members is used for the whole batch
+    members = [set(torch.nonzero(qs[:, b, 0] == subset_min[b, 0]).view(-1).tolist()) for b in range(64)]
+    assert len(set.union(*members)) <= 2
@@ -0,0 +1,143 @@
+import operator
+import time
+
+import numpy as np
+import pytest
+
+from rl_games.common.segment_tree import SumSegmentTree, MinSegmentTree
+
+
+class ListSegmentTree(object):
+    '''
+    list based segment tree with per item updates and searches, the implementation before the array backed trees
+    '''
+    def __init__(self, capacity, operation, neutral_element):
+        self._capacity = capacity
+        self._value = [neutral_element for _ in range(2 * capacity)]
+        self._operation = operation
+
+    def __setitem__(self, idx, val):
+        idx += self._capacity
+        self._value[idx] = val
+        idx //= 2
+        while idx >= 1:
+            self._value[idx] = self._operation(self._value[2 * idx], self._value[2 * idx + 1])
+            idx //= 2
+
+    def reduce_all(self):
+        return self._value[1]
+
+    def find_prefixsum_idx(self, prefixsum):
+        idx = 1
+        while idx < self._capacity:
+            if self._value[2 * idx] > prefixsum:
+                idx = 2 * idx
+            else:
+                prefixsum -= self._value[2 * idx]
+                idx = 2 * idx + 1
+        return idx - self._capacity
+
+
+def _filled_trees(capacity, size, seed=0):
+    rng = np.random.RandomState(seed)
+    values = rng.uniform(0.1, 2.0, size=size)
+    sum_tree, min_tree = SumSegmentTree(capacity), MinSegmentTree(capacity)
+    sum_tree[np.arange(size)] = values
+    min_tree[np.arange(size)] = values
+    return values, sum_tree, min_tree
+
+
+def test_batched_set_matches_single_item_set():
+    capacity = 64
+    values = np.random.RandomState(1).uniform(0.1, 2.0, size=50)
+    batched = SumSegmentTree(capacity)
+    single = SumSegmentTree(capacity)
+    batched[np.arange(50)] = values
+    for i, v in enumerate(values):
+        single[i] = v
+    np.testing.assert_allclose(batched._value, single._value)
+
+
+@pytest.mark.parametrize('start,end', [(0, None), (0, 50), (3, 17), (10, 11), (31, 33), (0, -1)])
+def test_reduce_matches_numpy(start, end):
+    values, sum_tree, min_tree = _filled_trees(64, 64)
+    expected = values[start:end]
+    assert sum_tree.sum(start, end) == pytest.approx(expected.sum())
+    assert min_tree.min(start, end) == pytest.approx(expected.min())
+
+
+def test_getitem():
+    values, sum_tree, _ = _filled_trees(32, 20)
+    assert sum_tree[5] == pytest.approx(values[5])
+    np.testing.assert_allclose(sum_tree[np.array([0, 7, 19])], values[[0, 7, 19]])
+    assert sum_tree[25] == 0.0
+
+
+def test_find_prefixsum_idx_matches_list_tree():
+    capacity, size = 256, 200
+    values, sum_tree, _ = _filled_trees(capacity, size)
+    reference = ListSegmentTree(capacity, operator.add, 0.0)
+    for i, v in enumerate(values):
+        reference[i] = v
+
+    prefixsums = np.random.RandomState(2).uniform(0.0, values.sum(), size=1000)
+    batched = sum_tree.find_prefixsum_idx(prefixsums)
+    expected = [reference.find_prefixsum_idx(p) for p in prefixsums]
+    np.testing.assert_array_equal(batched, expected)
+    assert sum_tree.find_prefixsum_idx(float(prefixsums[0])) == expected[0]
+
+
+def test_torch_tree_matches_numpy_tree():
+    torch = pytest.importorskip('torch')
+    capacity, size = 128, 100
+    values, sum_tree, min_tree = _filled_trees(capacity, size)
+    torch_sum, torch_min = SumSegmentTree(capacity, device='cpu'), MinSegmentTree(capacity, device='cpu')
+    torch_sum[np.arange(size)] = values
+    torch_min[np.arange(size)] = values
+
+    assert torch_sum.sum() == pytest.approx(sum_tree.sum())
+    assert torch_sum.sum(5, 77) == pytest.approx(sum_tree.sum(5, 77))
+    assert torch_min.min(5, 77) == pytest.approx(min_tree.min(5, 77))
+    prefixsums = np.random.RandomState(3).uniform(0.0, values.sum(), size=500)
+    np.testing.assert_array_equal(torch_sum.find_prefixsum_idx(torch.from_numpy(prefixsums)).numpy(),
+                                  sum_tree.find_prefixsum_idx(prefixsums))
+
+
+def benchmark(capacity=2 ** 20, batch_size=256, iterations=20):
+    values = np.random.uniform(0.1, 2.0, size=capacity)
+    legacy = ListSegmentTree(capacity, operator.add, 0.0)
+    tree = SumSegmentTree(capacity)
+    for i in range(capacity):
+        legacy[i] = values[i]
+    tree[np.arange(capacity)] = values
+
+    def timeit(fn):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        return (time.perf_counter() - start) / iterations * 1000.0
+
+    idxes = np.random.randint(0, capacity, size=batch_size)
+    priorities = np.random.uniform(0.1, 2.0, size=batch_size)
+    prefixsums = np.random.uniform(0.0, values.sum(), size=batch_size)
+
+    def legacy_update():
+        for idx, priority in zip(idxes, priorities):
+            legacy[int(idx)] = float(priority)
+
+    def legacy_search():
+        return [legacy.find_prefixsum_idx(p) for p in prefixsums]
+
+    def batched_update():
+        tree[idxes] = priorities
+
+    def batched_search():
+        return tree.find_prefixsum_idx(prefixsums)
+
+    print('capacity {}, batch size {}'.format(capacity, batch_size))
+    print('update: list {:.3f} ms, array {:.3f} ms'.format(timeit(legacy_update), timeit(batched_update)))
+    print('search: list {:.3f} ms, array {:.3f} ms'.format(timeit(legacy_search), timeit(batched_search)))
+
+
+if __name__ == '__main__':
+    benchmark()